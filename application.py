@@ -1,10 +1,13 @@
 from dotenv import load_dotenv
 import os
+import hmac
+import time
 import logging
+import functools
 from queue import Queue  # in python 2 it should be "from Queue"
-from threading import Thread
 
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
+import redis
 import telegram
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import (Updater, Filters, Dispatcher, CommandHandler,
@@ -12,6 +15,19 @@ from telegram.ext import (Updater, Filters, Dispatcher, CommandHandler,
                         PreCheckoutQueryHandler, ShippingQueryHandler)
 
 from main import handle_users_reply, handle_answer_payment, handle_successful_payment, error_callback
+from moltin import get_token_stats
+from catalog import warm_catalog_in_background
+from customers import start_customer_writer
+from replica import start_replicas, get_replicas_stats
+from zones import get_zone_map
+import dispatch
+import metrics
+import tracing
+from telegram_displays import InstrumentedRequest, get_telegram_calls_stats
+from jobs import jobs
+from outbox import outbox
+from ingest import StreamConsumer, ingest_update
+from scheduler import get_update_chat_id
 
 
 load_dotenv()
@@ -19,13 +35,16 @@ load_dotenv()
 
 TG_TOKEN = os.getenv('TG_TOKEN')
 URL = os.getenv('URL')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+OVERLOAD_RETRY_AFTER = 5
+TELEGRAM_POOL_SIZE = 16
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
 
 app = Flask(__name__)
-bot = telegram.Bot(token=TG_TOKEN)
+bot = telegram.Bot(token=TG_TOKEN, base_url=TELEGRAM_API_URL,
+                   request=InstrumentedRequest(con_pool_size=TELEGRAM_POOL_SIZE))
 update_queue = Queue()
 dispatcher = Dispatcher(bot, update_queue)
-thread = Thread(target=dispatcher.start, name='dispatcher')
-thread.start()
 dispatcher.add_handler(CallbackQueryHandler(handle_users_reply, pass_job_queue=True))
 dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply, pass_job_queue=True))
 dispatcher.add_handler(MessageHandler(Filters.location, handle_users_reply, pass_job_queue=True))
@@ -33,18 +52,49 @@ dispatcher.add_handler(CommandHandler('start', handle_users_reply, pass_job_queu
 dispatcher.add_handler(PreCheckoutQueryHandler(handle_answer_payment))
 dispatcher.add_handler(MessageHandler(Filters.successful_payment, handle_successful_payment))
 dispatcher.add_error_handler(error_callback)
+consumer = StreamConsumer(dispatcher.process_update, bot).start()
+outbox.start()
+jobs.start(bot)
+metrics.register_gauge('scheduler_queue_depth', lambda: consumer.scheduler.get_stats()['queue_depth'])
+metrics.register_gauge('ingest_in_flight', lambda: consumer.get_stats()['in_flight'])
+metrics.register_gauge('outbox_backlog', lambda: outbox.get_stats()['backlog'])
+metrics.register_gauge('jobs_due', lambda: jobs.get_stats()['due'])
+warm_catalog_in_background()
+start_customer_writer()
+start_replicas()
+
+
+def admin_only(function):
+    # Admin routes answer only requests with X-Admin-Token header equal to
+    # ADMIN_TOKEN, they are closed if it isn't set.
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return 'not found', 404
+        return function(*args, **kwargs)
+    return wrapper
 
 
 @app.route(f'/{TG_TOKEN}', methods=['POST'])
 def respond():
-    # Creates the Telegram bot, Dispatcher instance, registers all handlers,
-    # get data from Telegram reguest, create update queue and process update.
+    # Puts the update to the shared Redis stream, workers of all processes
+    # handle it later. Telegram repeats the update if it's not accepted.
+    received_at = time.time()
     try:
-        update = telegram.update.Update.de_json(request.get_json(force=True), bot)
-        update_queue.put(update)
-        return 'ok'
+        update_json = request.get_json(force=True)
+        update = telegram.update.Update.de_json(update_json, bot)
+        result = ingest_update(update_json, get_update_chat_id(update),
+                               tracing.new_trace_id(), received_at)
+    except redis.exceptions.RedisError as e:
+        logging.critical(e)
+        return 'unavailable', 503
     except Exception as e:
         logging.critical(e)
+        return 'ok'
+    if result == 'overloaded':
+        return 'overloaded', 429, {'Retry-After': str(OVERLOAD_RETRY_AFTER)}
+    return 'ok'
 
 
 @app.route('/set_webhook', methods=['GET', 'POST'])
@@ -62,6 +112,89 @@ def display_menu_json(file_name):
         return f.read()
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_route():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/traces', methods=['GET'])
+@admin_only
+def slowest_traces():
+    return jsonify([trace.get_summary() for trace in tracing.traces.get_traces()])
+
+
+@app.route('/traces/<trace_id>.json', methods=['GET'])
+@admin_only
+def trace_events(trace_id):
+    trace = tracing.traces.get_trace(trace_id)
+    if trace is None:
+        return 'not found', 404
+    return jsonify(trace.get_trace_events())
+
+
+@app.route('/stats/moltin_token', methods=['GET'])
+@admin_only
+def moltin_token_stats():
+    return jsonify(get_token_stats())
+
+
+@app.route('/stats/scheduler', methods=['GET'])
+@admin_only
+def scheduler_stats():
+    return jsonify(consumer.scheduler.get_stats())
+
+
+@app.route('/stats/ingest', methods=['GET'])
+@admin_only
+def ingest_stats():
+    return jsonify(consumer.get_stats())
+
+
+@app.route('/stats/jobs', methods=['GET'])
+@admin_only
+def jobs_stats():
+    return jsonify(jobs.get_stats())
+
+
+@app.route('/stats/outbox', methods=['GET'])
+@admin_only
+def outbox_stats():
+    return jsonify(outbox.get_stats())
+
+
+@app.route('/stats/telegram', methods=['GET'])
+@admin_only
+def telegram_stats():
+    return jsonify(get_telegram_calls_stats())
+
+
+@app.route('/stats/replicas', methods=['GET'])
+@admin_only
+def replicas_stats():
+    return jsonify(get_replicas_stats())
+
+
+@app.route('/stats/dispatch', methods=['GET'])
+@admin_only
+def dispatch_stats():
+    return jsonify(dispatch.get_stats())
+
+
+@app.route('/stats/zones', methods=['GET'])
+@admin_only
+def zones_stats():
+    zone_map = get_zone_map()
+    return jsonify(zone_map.get_stats() if zone_map else {'building': True})
+
+
+@app.route('/zones.geojson', methods=['GET'])
+def zones_geojson():
+    zone_map = get_zone_map()
+    if zone_map is None:
+        return 'zone map is building, try again later', 503
+    return jsonify(zone_map.get_geojson())
+
+
 @app.route("/")
 def hello():
     return 'hello!'
@@ -0,0 +1,122 @@
+# ASGI alternative to the threaded Flask application, see README.
+import os
+import json
+import asyncio
+import logging
+
+import telegram
+from dotenv import load_dotenv
+
+from async_clients import (TELEGRAM_API_URL, AsyncMoltin, AsyncTelegram,
+                           get_async_database_connection)
+from async_main import AsyncContext, get_chat_id, handle_update
+from customers import start_customer_writer
+from jobs import jobs
+from outbox import outbox
+from replica import start_replicas
+from telegram_displays import InstrumentedRequest
+
+
+load_dotenv()
+
+TG_TOKEN = os.getenv('TG_TOKEN')
+URL = os.getenv('URL')
+JOBS_BOT_POOL_SIZE = 8
+
+context = None
+chat_locks = {}
+tasks = set()
+
+
+async def startup():
+    global context
+    database = get_async_database_connection()
+    # Courier orders and reminders are the same jobs as in the Flask
+    # application, they are sent by the outbox threads.
+    jobs_bot = telegram.Bot(token=TG_TOKEN, base_url=TELEGRAM_API_URL,
+                            request=InstrumentedRequest(con_pool_size=JOBS_BOT_POOL_SIZE))
+    context = AsyncContext(AsyncTelegram(TG_TOKEN), AsyncMoltin(database), database, jobs_bot)
+    outbox.start()
+    jobs.start(jobs_bot)
+    start_customer_writer()
+    start_replicas()
+
+
+async def shutdown():
+    if tasks:
+        await asyncio.wait(tasks)
+    await context.bot.close()
+    await context.moltin.close()
+    await context.database.close()
+
+
+async def process_update(update):
+    # Updates of one chat are processed one by one, so Redis state
+    # transitions keep their order. Different chats run concurrently.
+    chat_id = get_chat_id(update)
+    lock, waiting = chat_locks.get(chat_id, (asyncio.Lock(), 0))
+    chat_locks[chat_id] = (lock, waiting + 1)
+    try:
+        async with lock:
+            await handle_update(context, update)
+    except Exception as e:
+        logging.critical(e)
+    finally:
+        lock, waiting = chat_locks[chat_id]
+        if waiting == 1:
+            del chat_locks[chat_id]
+        else:
+            chat_locks[chat_id] = (lock, waiting - 1)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_response(send, status, text):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8')})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    path, method = scope['path'], scope['method']
+    if path == f'/{TG_TOKEN}' and method == 'POST':
+        try:
+            update = json.loads(await read_body(receive))
+        except ValueError as e:
+            logging.critical(e)
+            await send_response(send, 400, 'bad update')
+            return
+        # Telegram waits for the answer only, the update is handled later.
+        task = asyncio.create_task(process_update(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        await send_response(send, 200, 'ok')
+    elif path == '/set_webhook':
+        result = await context.bot.call('setWebhook', url=f'{URL}/{TG_TOKEN}')
+        await send_response(send, 200, 'webhook setup ok' if result else 'webhook setup failed')
+    elif path == '/':
+        await send_response(send, 200, 'hello!')
+    else:
+        await send_response(send, 404, 'not found')
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+import httpx
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+from moltin import (MoltinError, MOLTIN_API_URL, MOLTIN_API_OAUTH_URL,
+                    MOLTIN_ERR_MSG, MOLTIN_FLOW_ADDRESSES,
+                    MOLTIN_TOKEN_KEY, MOLTIN_TOKEN_LOCK_KEY,
+                    MOLTIN_TOKEN_LOCK_TIMEOUT, MOLTIN_POOL_SIZE,
+                    is_token_fresh, make_headers, parse_cart)
+
+
+load_dotenv()
+
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+TELEGRAM_ERR_MSG = 'Telegram API returns error:'
+HTTP_TIMEOUT = httpx.Timeout(10, connect=3.05)
+
+
+class TelegramError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def get_async_database_connection():
+    db_pwd = os.getenv('REDIS_PWD')
+    db_host = os.getenv('REDIS_HOST')
+    db_port = os.getenv('REDIS_PORT')
+    return aioredis.Redis(host=db_host, port=db_port, password=db_pwd)
+
+
+class AsyncMoltin:
+    # Async twin of moltin.py functions. Shares access token with
+    # the threaded stack through the same Redis key.
+    def __init__(self, database, pool_size=MOLTIN_POOL_SIZE):
+        self.database = database
+        self.client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=pool_size * 4,
+                                max_keepalive_connections=pool_size),
+        )
+        self.token = {'access_token': None, 'expires': 0}
+        self.token_lock = asyncio.Lock()
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def fetch_token(self):
+        data = {'client_id': str(os.getenv('MOLTIN_CLIENT_ID')),
+                'client_secret': str(os.getenv('MOLTIN_CLIENT_SECRET')),
+                'grant_type': 'client_credentials'}
+        resp = await self.client.post(MOLTIN_API_OAUTH_URL, data=data)
+        resp_json = self.check_resp(resp)
+        expires = resp_json.get('expires') or time.time() + resp_json['expires_in']
+        return {'access_token': resp_json['access_token'], 'expires': expires}
+
+    async def refresh_token(self, rejected_token=None):
+        try:
+            shared_token = await self.database.get(MOLTIN_TOKEN_KEY)
+            shared_token = shared_token and json.loads(shared_token)
+            if is_token_fresh(shared_token, rejected_token):
+                return shared_token
+            async with self.database.lock(MOLTIN_TOKEN_LOCK_KEY,
+                                          timeout=MOLTIN_TOKEN_LOCK_TIMEOUT,
+                                          blocking_timeout=MOLTIN_TOKEN_LOCK_TIMEOUT):
+                shared_token = await self.database.get(MOLTIN_TOKEN_KEY)
+                shared_token = shared_token and json.loads(shared_token)
+                if is_token_fresh(shared_token, rejected_token):
+                    return shared_token
+                new_token = await self.fetch_token()
+                ttl = max(int(new_token['expires'] - time.time()), 1)
+                await self.database.set(MOLTIN_TOKEN_KEY, json.dumps(new_token), ex=ttl)
+                return new_token
+        except aioredis.RedisError as e:
+            logging.error(f'Shared Moltin token is unavailable: {e}')
+            return await self.fetch_token()
+
+    async def get_token(self, rejected_token=None):
+        if is_token_fresh(self.token, rejected_token):
+            return self.token['access_token']
+        async with self.token_lock:
+            if not is_token_fresh(self.token, rejected_token):
+                self.token = await self.refresh_token(rejected_token)
+            return self.token['access_token']
+
+    def check_resp(self, resp):
+        if resp.status_code >= 400:
+            raise MoltinError(f'{MOLTIN_ERR_MSG} {resp.status_code} {resp.text}')
+        resp_json = resp.json()
+        if 'errors' in resp_json:
+            raise MoltinError(f'{MOLTIN_ERR_MSG} {resp_json}')
+        return resp_json
+
+    async def request(self, method, path, **kwargs):
+        try:
+            moltin_token = await self.get_token()
+            headers = {**make_headers(moltin_token), **kwargs.pop('headers', {})}
+            resp = await self.client.request(method, f'{MOLTIN_API_URL}{path}',
+                                             headers=headers, **kwargs)
+            if resp.status_code == 401:
+                moltin_token = await self.get_token(rejected_token=moltin_token)
+                headers.update(make_headers(moltin_token))
+                resp = await self.client.request(method, f'{MOLTIN_API_URL}{path}',
+                                                 headers=headers, **kwargs)
+        except httpx.HTTPError as e:
+            raise MoltinError(f'{MOLTIN_ERR_MSG} {e}')
+        return self.check_resp(resp)
+
+    async def get_cart(self, cart_id):
+        return parse_cart(await self.request('GET', f'/carts/{cart_id}/items'))
+
+    async def add_to_cart(self, cart_id, product_id):
+        data = {'data': {'id': product_id, 'type': 'cart_item', 'quantity': 1}}
+        cart = await self.request('POST', f'/carts/{cart_id}/items', json=data,
+                                  headers={'X-MOLTIN-CURRENCY': 'RUB'})
+        return parse_cart(cart)
+
+    async def delete_from_cart(self, cart_id, item_id):
+        return await self.request('DELETE', f'/carts/{cart_id}/items/{item_id}')
+
+    async def get_address(self, id):
+        data = (await self.request(
+            'GET', f'/flows/{MOLTIN_FLOW_ADDRESSES}/entries/{id}'))['data']
+        return data['address'], data['courier_telegram_id']
+
+
+class AsyncTelegram:
+    # Minimal Bot API client, methods take the same arguments as Bot API.
+    def __init__(self, token, base_url=TELEGRAM_API_URL):
+        self.url = f'{base_url}{token}'
+        self.client = httpx.AsyncClient(timeout=HTTP_TIMEOUT)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def call(self, method, **params):
+        # Keyboards of templates.py are serialized already.
+        params = {name: value for name, value in params.items() if value is not None}
+        if not isinstance(params.get('reply_markup', ''), str):
+            params['reply_markup'] = json.dumps(params['reply_markup'])
+        try:
+            resp = await self.client.post(f'{self.url}/{method}', json=params)
+            resp_json = resp.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise TelegramError(f'{TELEGRAM_ERR_MSG} {e}')
+        if not resp_json.get('ok'):
+            raise TelegramError(f'{TELEGRAM_ERR_MSG} {resp_json}')
+        return resp_json['result']
+
+    async def send_message(self, chat_id, text, **params):
+        return await self.call('sendMessage', chat_id=chat_id, text=text, **params)
+
+    async def send_photo(self, chat_id, photo, **params):
+        return await self.call('sendPhoto', chat_id=chat_id, photo=photo, **params)
+
+    async def send_location(self, chat_id, latitude, longitude):
+        return await self.call('sendLocation', chat_id=chat_id,
+                               latitude=latitude, longitude=longitude)
+
+    async def edit_message_text(self, chat_id, message_id, text, **params):
+        return await self.call('editMessageText', chat_id=chat_id, message_id=message_id,
+                               text=text, **params)
+
+    async def edit_message_media(self, chat_id, message_id, media, **params):
+        return await self.call('editMessageMedia', chat_id=chat_id, message_id=message_id,
+                               media=media, **params)
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.call('deleteMessage', chat_id=chat_id, message_id=message_id)
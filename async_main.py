@@ -0,0 +1,384 @@
+import os
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+import catalog
+from carts import (get_cart_async, add_to_cart_async, delete_from_cart_async,
+                   invalidate_cart_async)
+from customers import save_customer
+from dispatch import dispatch_order
+from photos import get_file_id, save_file_id, invalidate_file_id
+from chat_sessions import (load_session_async, save_session_async, next_cart_version,
+                           start_order_async, finish_order)
+from geocoding import GeocoderError, get_coordinates, get_address_by_coordinates
+from main import get_customer_location, schedule_delivery
+from moltin import MoltinError
+from shops import get_shop
+from templates import (DELIVERY_MARKUP, MENU_TEXT, PAYMENT_MARKUP, get_cart_markup,
+                       get_cart_text, get_templates)
+from zones import find_nearest_shop
+from async_clients import TelegramError
+
+
+load_dotenv()
+
+PAYMENT_PAYLOAD = os.getenv('PAYMENT_PAYLOAD')
+
+# Catalog, shop index and geocoding are served from in-process caches and
+# are shared with the threaded stack, so they run in the default executor.
+# Carts, Redis states and Telegram replies are native async. Courier orders
+# and reminders are the jobs of the threaded stack, they are sent by the
+# outbox with sync bot.
+
+
+class AsyncContext:
+    def __init__(self, bot, moltin, database, jobs_bot):
+        self.bot = bot
+        self.moltin = moltin
+        self.database = database
+        self.jobs_bot = jobs_bot
+
+
+def get_query_data(update):
+    # Only text and location messages are handled, as the Flask application
+    # filters them.
+    if 'message' in update:
+        query = update['message']
+        query_data = query.get('location') or query.get('text')
+        if query_data is None:
+            return
+        return query['message_id'], query['chat']['id'], query_data
+    elif 'callback_query' in update:
+        query = update['callback_query']
+        return query['message']['message_id'], query['message']['chat']['id'], query['data']
+
+
+def get_chat_id(update):
+    query_data = get_query_data(update)
+    if query_data:
+        return query_data[1]
+
+
+def is_photo_message(update):
+    # Photo messages can't be edited into text ones.
+    return bool(update.get('callback_query', {}).get('message', {}).get('photo'))
+
+
+async def delete_message(context, chat_id, message_id):
+    try:
+        await context.bot.delete_message(chat_id, message_id)
+    except TelegramError as e:
+        logging.error(f'Message {message_id} is not deleted: {e.message}')
+
+
+async def render(context, chat_id, message_id, text, reply_markup=None, parse_mode=None,
+                 current_is_photo=False):
+    # Shows text screen in place of the current message of the bot, as
+    # telegram_displays.show_text does.
+    if message_id is not None and not current_is_photo:
+        try:
+            return await context.bot.edit_message_text(chat_id, message_id, text,
+                                                       reply_markup=reply_markup,
+                                                       parse_mode=parse_mode)
+        except TelegramError as e:
+            if 'not modified' in e.message:
+                return
+            logging.error(f'Message {message_id} is not edited: {e.message}')
+    message = await context.bot.send_message(chat_id, text, reply_markup=reply_markup,
+                                             parse_mode=parse_mode)
+    if message_id is not None:
+        await delete_message(context, chat_id, message_id)
+    return message
+
+
+async def send_product_photo(context, chat_id, product_id, href_img, file_id, **params):
+    if file_id:
+        try:
+            return await context.bot.send_photo(chat_id, file_id, **params)
+        except TelegramError as e:
+            logging.error(f'Telegram file id of {product_id} is rejected: {e.message}')
+            await asyncio.to_thread(invalidate_file_id, product_id)
+    message = await context.bot.send_photo(chat_id, href_img, **params)
+    await asyncio.to_thread(save_file_id, product_id, href_img,
+                            message['photo'][-1]['file_id'])
+    return message
+
+
+async def render_photo(context, chat_id, message_id, product_id, href_img, caption,
+                       reply_markup=None, current_is_photo=False):
+    # The same for the product photo screen.
+    file_id = await asyncio.to_thread(get_file_id, product_id, href_img)
+    if message_id is not None and current_is_photo:
+        media = {'type': 'photo', 'media': file_id or href_img, 'caption': caption}
+        try:
+            message = await context.bot.edit_message_media(chat_id, message_id, media,
+                                                           reply_markup=reply_markup)
+        except TelegramError as e:
+            if 'not modified' in e.message:
+                return
+            logging.error(f'Message {message_id} is not edited: {e.message}')
+        else:
+            if not file_id and isinstance(message, dict) and message.get('photo'):
+                await asyncio.to_thread(save_file_id, product_id, href_img,
+                                        message['photo'][-1]['file_id'])
+            return message
+    message = await send_product_photo(context, chat_id, product_id, href_img, file_id,
+                                       caption=caption, reply_markup=reply_markup)
+    if message_id is not None:
+        await delete_message(context, chat_id, message_id)
+    return message
+
+
+def get_menu_markup():
+    return get_templates().get_menu_markup(catalog.get_products())
+
+
+def get_card(product_id):
+    details = catalog.get_product(product_id)
+    return details[3], *get_templates().get_card(product_id, details)
+
+
+async def display_menu(context, chat_id, message_id=None, current_is_photo=False):
+    reply_markup = await asyncio.to_thread(get_menu_markup)
+    await render(context, chat_id, message_id, MENU_TEXT, reply_markup=reply_markup,
+                 current_is_photo=current_is_photo)
+
+
+async def display_description(context, product_id, chat_id, message_id=None,
+                              current_is_photo=False):
+    href_img, caption, reply_markup = await asyncio.to_thread(get_card, product_id)
+    await render_photo(context, chat_id, message_id, product_id, href_img, caption,
+                       reply_markup=reply_markup, current_is_photo=current_is_photo)
+
+
+async def display_cart(context, cart, products, total, chat_id, message_id=None,
+                       current_is_photo=False):
+    await render(context, chat_id, message_id, get_cart_text(products, total),
+                 reply_markup=get_cart_markup(cart, total), current_is_photo=current_is_photo)
+
+
+async def display_address(context, chat_id, latitude, longitude, address_customer, session,
+                          message_id=None):
+    if latitude is None and longitude is None:
+        text = 'Не могу определить координаты. Уточните пожалуйста адрес.'
+        await render(context, chat_id, message_id, text)
+        return False
+    nearest_shop, nearest_distance, delivery_price = await asyncio.to_thread(
+        find_nearest_shop, latitude, longitude)
+    if nearest_shop is None:
+        text = 'Простите, сейчас нет ни одной работающей пиццерии :('
+        await render(context, chat_id, message_id, text)
+        return False
+    nearest_distance = round(nearest_distance, 1)
+    nearest_shop_id = nearest_shop['id']
+    nearest_address = nearest_shop['address']
+
+    if delivery_price is None:
+        text = f'Ближайшая пиццерия  аж в {nearest_distance} км от вас! Простите, но так далеко доставить не сможем :('
+        await render(context, chat_id, message_id, text)
+        return False
+    elif delivery_price == 0:
+        text = f'Вы совсем рядом! Ближайшая пиццерия всего в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или можем доставить бесплатно.'
+    elif delivery_price == 100:
+        text = f'Ближайшая пиццерия в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или привезем за самокате за 100 рублей'
+    else:
+        text = f'Ближайшая пиццерия в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или доставим за {delivery_price} рублей'
+    await asyncio.to_thread(save_customer, chat_id, latitude, longitude,
+                            address_customer, nearest_shop_id)
+    session.update({'nearest_shop_id': nearest_shop_id,
+                    'latitude': latitude, 'longitude': longitude})
+    await render(context, chat_id, message_id, text, reply_markup=DELIVERY_MARKUP,
+                 parse_mode='Markdown')
+    return True
+
+
+async def ask_location(context, chat_id, message_id):
+    await render(context, chat_id, message_id, 'ОФОРМЛЕНИЕ ЗАКАЗА:\nДля доставки вашей пиццы'
+                                               ' отправьте нам геолокацию или адрес текстом.')
+
+
+async def get_cart(context, chat_id, session):
+    return await get_cart_async(context.database, context.moltin, chat_id,
+                                session.get('cart_version'))
+
+
+async def handle_start(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    if query_data == '/start':
+        await display_menu(context, chat_id)
+    else:
+        await display_menu(context, chat_id, message_id, is_photo_message(update))
+    return 'HANDLE_MENU'
+
+
+async def handle_menu(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    if query_data == 'goto_cart':
+        cart, products, total = await get_cart(context, chat_id, session)
+        await display_cart(context, cart, products, total, chat_id, message_id,
+                           is_photo_message(update))
+        return 'HANDLE_CART'
+    await display_description(context, query_data, chat_id, message_id,
+                              is_photo_message(update))
+    return 'HANDLE_DESCRIPTION'
+
+
+async def handle_description(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    if query_data == 'goto_menu':
+        await display_menu(context, chat_id, message_id, is_photo_message(update))
+        return 'HANDLE_MENU'
+    elif query_data == 'goto_cart':
+        cart, products, total = await get_cart(context, chat_id, session)
+    else:
+        cart, products, total = await add_to_cart_async(
+            context.database, context.moltin, chat_id, query_data, next_cart_version(session))
+    await display_cart(context, cart, products, total, chat_id, message_id,
+                       is_photo_message(update))
+    return 'HANDLE_CART'
+
+
+async def handle_cart(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    if query_data == 'goto_menu':
+        await display_menu(context, chat_id, message_id)
+        return 'HANDLE_MENU'
+    elif query_data == 'goto_checkout_geo':
+        await start_order_async(context.database, session)
+        await ask_location(context, chat_id, message_id)
+        return 'HANDLE_CHECKOUT_GEO'
+    else:
+        cart, products, total = await delete_from_cart_async(
+            context.database, context.moltin, chat_id, query_data, next_cart_version(session))
+        await display_cart(context, cart, products, total, chat_id, message_id)
+        return 'HANDLE_CART'
+
+
+async def handle_checkout_geo(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    latitude, longitude, address_customer = None, None, None
+    try:
+        if isinstance(query_data, str):
+            coordinates = await asyncio.to_thread(get_coordinates, query_data)
+            if coordinates:
+                latitude, longitude = coordinates
+                address_customer = query_data
+        else:
+            latitude, longitude = query_data['latitude'], query_data['longitude']
+            address_customer = await asyncio.to_thread(
+                get_address_by_coordinates, latitude, longitude) or ''
+    except GeocoderError as e:
+        logging.error(e)
+        if not isinstance(query_data, str):
+            address_customer = ''
+    # The previous message is the bot's request of the address.
+    if await display_address(context, chat_id, latitude, longitude, address_customer, session,
+                             message_id - 1):
+        return 'HANDLE_CHECKOUT_RECEIPT'
+    else:
+        return 'HANDLE_CHECKOUT_GEO'
+
+
+async def handle_checkout_receipt(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    location = await asyncio.to_thread(get_customer_location, chat_id, session)
+    if location is None:
+        await ask_location(context, chat_id, message_id)
+        return 'HANDLE_CHECKOUT_GEO'
+    latitude, longitude, nearest_shop_id = location
+    cart, products, total = await get_cart(context, chat_id, session)
+    shop = await asyncio.to_thread(get_shop, nearest_shop_id)
+    if shop:
+        address, courier_telegram_id = shop['address'], shop['courier_telegram_id']
+    else:
+        address, courier_telegram_id = await context.moltin.get_address(nearest_shop_id)
+    if query_data == 'goto_checkout_delivery':
+        order_id = session.get('order_id') or await start_order_async(context.database, session)
+        dispatched_shop = await asyncio.to_thread(dispatch_order, order_id, latitude, longitude)
+        if dispatched_shop:
+            courier_telegram_id = dispatched_shop['courier_telegram_id']
+        await asyncio.to_thread(schedule_delivery, context.jobs_bot, chat_id, order_id,
+                                courier_telegram_id, latitude, longitude,
+                                f'Заказ:\n{products}\nСумма:{total} руб.')
+        await render(context, chat_id, message_id, 'Заказ принят и скоро будет доставлен! Как будете оплачивать?',
+                     reply_markup=PAYMENT_MARKUP)
+    elif query_data == 'goto_checkout_pickup':
+        await render(context, chat_id, message_id, f'Отлично! Ждем вас по адресу: {address}. Как будете оплачивать?',
+                     reply_markup=PAYMENT_MARKUP)
+    return 'HANDLE_CHECKOUT_PAYMENT'
+
+
+async def handle_checkout_payment(context, update, session):
+    message_id, chat_id, query_data = get_query_data(update)
+    cart, products, total = await get_cart(context, chat_id, session)
+    if query_data == 'goto_payment_cash':
+        await render(context, chat_id, message_id, f'Договорились! Напоминаем, что вы заказали:\n{products}\nСумма:{total} руб.')
+        finish_order(session)
+        await invalidate_cart_async(context.database, chat_id)
+    elif query_data == 'goto_payment_card':
+        # Invoice can't replace a text message, so it is sent as new one.
+        await context.bot.call('sendInvoice', chat_id=chat_id, title='Оплата заказа',
+                               description=f'{products}\nСумма:{total} руб.',
+                               payload=PAYMENT_PAYLOAD,
+                               provider_token=os.getenv('PAYMENT_TOKEN_TRANZZO'),
+                               start_parameter='test-payment', currency='RUB',
+                               prices=[{'label': 'Test', 'amount': total * 100}])
+        await delete_message(context, chat_id, message_id)
+
+
+async def handle_answer_payment(context, update):
+    query = update['pre_checkout_query']
+    if query['invoice_payload'] != PAYMENT_PAYLOAD:
+        await context.bot.call('answerPreCheckoutQuery', pre_checkout_query_id=query['id'],
+                               ok=False, error_message='Что-то пошло не так...')
+    else:
+        await context.bot.call('answerPreCheckoutQuery', pre_checkout_query_id=query['id'], ok=True)
+
+
+async def handle_successful_payment(context, update):
+    session = await load_session_async(context.database, update['message']['chat']['id'])
+    finish_order(session)
+    await save_session_async(context.database, session)
+    await invalidate_cart_async(context.database, update['message']['chat']['id'])
+    await context.bot.send_message(update['message']['chat']['id'], 'Спасибо за заказ!')
+
+
+states_functions = {
+    'HANDLE_START': handle_start,
+    'HANDLE_MENU': handle_menu,
+    'HANDLE_DESCRIPTION': handle_description,
+    'HANDLE_CART': handle_cart,
+    'HANDLE_CHECKOUT_GEO': handle_checkout_geo,
+    'HANDLE_CHECKOUT_RECEIPT': handle_checkout_receipt,
+    'HANDLE_CHECKOUT_PAYMENT': handle_checkout_payment,
+}
+
+
+async def handle_users_reply(context, update):
+    # Handles all user's actions. Gets current statement,
+    # runs relevant function and set new statement.
+    message_id, chat_id, query_data = get_query_data(update)
+    session = await load_session_async(context.database, chat_id)
+    if query_data == '/start' or 'state' not in session:
+        user_state = 'HANDLE_START'
+    else:
+        user_state = session['state']
+    state_handler = states_functions[user_state]
+    try:
+        next_state = await state_handler(context, update, session)
+        if next_state:
+            session['state'] = next_state
+        await save_session_async(context.database, session)
+    except (MoltinError, TelegramError) as e:
+        logging.critical(e)
+
+
+async def handle_update(context, update):
+    if 'pre_checkout_query' in update:
+        await handle_answer_payment(context, update)
+    elif 'successful_payment' in update.get('message', {}):
+        await handle_successful_payment(context, update)
+    elif get_query_data(update):
+        await handle_users_reply(context, update)
@@ -0,0 +1,82 @@
+"""Simulates lunch peak: bursts of growing size of concurrent checkouts are
+dispatched to shops, the board is not emptied between bursts. Shows that
+assignment latency doesn't grow with the number of open orders, that no
+order is lost or counted twice, and how long the longest queue is compared
+with sending every order to the nearest shop.
+
+Redis from REDIS_HOST/REDIS_PORT is used, so point them to a disposable
+instance, dispatch keys are deleted.
+
+Usage: python -m benchmarks.bench_dispatch [shops] [threads] [bursts...]
+"""
+import sys
+import time
+import random
+import statistics
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.bench_nearest_shop import MOSCOW, make_shops
+from benchmarks.bench_get_cart import percentile
+from db import get_database_connection
+from shops import ShopIndex
+import dispatch
+
+
+def dispatch_burst(pool, shop_index, orders):
+    def dispatch_one(order):
+        order_id, point = order
+        candidates = dispatch.get_candidates(shop_index, *point)
+        start = time.perf_counter()
+        shop_id = dispatch.assign(order_id, candidates)
+        return (time.perf_counter() - start) * 1000, shop_id, candidates[0][0]['id']
+    return list(pool.map(dispatch_one, orders))
+
+
+def main():
+    random.seed(1)
+    shop_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    bursts = [int(size) for size in sys.argv[3:]] or [100, 1000, 5000, 20000]
+    shop_index = ShopIndex(make_shops(shop_count, spread=0.2))
+    database = get_database_connection()
+    database.delete(dispatch.DISPATCH_ORDERS_KEY, dispatch.DISPATCH_QUEUES_KEY,
+                    dispatch.DISPATCH_DEADLINES_KEY)
+
+    # Lunch orders come from business districts, so some shops are hot.
+    districts = [(MOSCOW[0] + random.uniform(-0.15, 0.15),
+                  MOSCOW[1] + random.uniform(-0.15, 0.15)) for _ in range(5)]
+    assigned, nearest = Counter(), Counter()
+    order_number = 0
+    print(f'{shop_count} shops, {threads} threads')
+    with ThreadPoolExecutor(threads) as pool:
+        for size in bursts:
+            orders = []
+            for _ in range(size):
+                latitude, longitude = random.choice(districts)
+                orders.append((f'order:{order_number}', (latitude + random.gauss(0, 0.01),
+                                                         longitude + random.gauss(0, 0.01))))
+                order_number += 1
+            start = time.perf_counter()
+            results = dispatch_burst(pool, shop_index, orders)
+            elapsed = time.perf_counter() - start
+            timings = [timing for timing, shop_id, nearest_id in results]
+            assigned.update(shop_id for timing, shop_id, nearest_id in results)
+            nearest.update(nearest_id for timing, shop_id, nearest_id in results)
+            print(f'burst {size:>6}: {size / elapsed:8.0f} orders/s, '
+                  f'p50 {statistics.median(timings):.3f} ms, '
+                  f'p99 {percentile(timings, 99):.3f} ms, open {order_number}')
+
+    # Repeated checkouts don't get the second courier.
+    dispatch.assign('order:0', dispatch.get_candidates(shop_index, *districts[0]))
+    queues = dispatch.get_queues()
+    print(f'open orders on the board: {sum(queues.values())} of {order_number}, '
+          f'board matches assignments: {Counter(queues) == assigned}')
+    print(f'longest queue: {max(queues.values())} load-aware, '
+          f'{max(nearest.values())} nearest only')
+    database.delete(dispatch.DISPATCH_ORDERS_KEY, dispatch.DISPATCH_QUEUES_KEY,
+                    dispatch.DISPATCH_DEADLINES_KEY)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Compares get_cart latency with and without the pooled Moltin session.
+
+Usage: python -m benchmarks.bench_get_cart [requests] [latency_ms]
+"""
+import os
+import sys
+import time
+import statistics
+
+import requests
+
+from benchmarks.stubs import moltin_stub
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def get_cart_before(cart_id):
+    # Old behaviour: new token and new connection for every call.
+    resp = requests.post(os.environ['MOLTIN_API_OAUTH_URL'],
+                         data={'grant_type': 'client_credentials'})
+    headers = {'Authorization': f"Bearer {resp.json()['access_token']}"}
+    resp = requests.get(f"{os.environ['MOLTIN_API_URL']}/carts/{cart_id}/items",
+                        headers=headers)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def measure(func, count):
+    timings = []
+    for number in range(count):
+        start = time.perf_counter()
+        func(str(number))
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0
+    stub = moltin_stub(latency)
+    os.environ['MOLTIN_API_URL'] = f'{stub.url}/v2'
+    os.environ['MOLTIN_API_OAUTH_URL'] = f'{stub.url}/oauth/access_token'
+    import moltin
+
+    for name, func in (('before', get_cart_before), ('after', moltin.get_cart)):
+        timings = measure(func, count)
+        print(f'{name:>6}: p50 {percentile(timings, 50):.2f} ms, '
+              f'p99 {percentile(timings, 99):.2f} ms, '
+              f'mean {statistics.mean(timings):.2f} ms')
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
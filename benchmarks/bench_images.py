@@ -0,0 +1,63 @@
+"""Compares full decode and resize of product photos with images.py
+pipeline which uses JPEG draft mode and writes all variants per decode.
+
+Usage: python -m benchmarks.bench_images [folder_with_jpegs]
+Without folder large synthetic photos are generated.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+
+from PIL import Image
+
+from images import IMAGE_WIDTHS, IMAGE_FORMATS, get_size, process_image
+
+
+SYNTHETIC_PHOTOS = 8
+SYNTHETIC_SIZE = (4000, 3000)
+
+
+def make_photos(folder):
+    random.seed(1)
+    for number in range(SYNTHETIC_PHOTOS):
+        img = Image.effect_noise(SYNTHETIC_SIZE, 64).convert('RGB')
+        img = Image.blend(img, Image.new('RGB', SYNTHETIC_SIZE,
+                                         tuple(random.randrange(256) for _ in range(3))), 0.5)
+        img.save(os.path.join(folder, f'photo_{number}.jpg'), 'JPEG', quality=90)
+
+
+def process_naive(source_path, image_dir):
+    # Full resolution decode for every variant, like resize_image did.
+    for size, width in IMAGE_WIDTHS.items():
+        for extension, (image_format, options) in IMAGE_FORMATS.items():
+            with Image.open(source_path) as img:
+                img = img.convert('RGB')
+                img.resize(get_size(*img.size, width)).save(
+                    os.path.join(image_dir, f'{size}.{extension}'), image_format, **options)
+
+
+def measure(func, photos, output_dir):
+    start = time.perf_counter()
+    for photo in photos:
+        func(photo, output_dir)
+    return (time.perf_counter() - start) / len(photos) * 1000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        folder = sys.argv[1] if len(sys.argv) > 1 else temp_dir
+        if folder == temp_dir:
+            make_photos(folder)
+        photos = [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+                  if name.lower().endswith(('.jpg', '.jpeg'))]
+        output_dir = os.path.join(temp_dir, 'output')
+        os.makedirs(output_dir)
+        print(f'{len(photos)} photos')
+        print(f'   naive: {measure(process_naive, photos, output_dir):.1f} ms per photo')
+        print(f'pipeline: {measure(process_image, photos, output_dir):.1f} ms per photo')
+
+
+if __name__ == '__main__':
+    main()
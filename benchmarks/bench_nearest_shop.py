@@ -0,0 +1,74 @@
+"""Compares nearest shop lookup by zone map and shop index with full
+geodesic scan.
+
+Usage: python -m benchmarks.bench_nearest_shop [shops] [queries]
+"""
+import sys
+import time
+import random
+
+from geopy import distance
+
+from shops import ShopIndex
+from zones import ZoneMap
+
+
+MOSCOW = (55.75, 37.62)
+
+
+def make_shops(count, spread=0.5):
+    return [{'id': str(number),
+             'address': f'Пиццерия {number}',
+             'latitude': MOSCOW[0] + random.uniform(-spread, spread),
+             'longitude': MOSCOW[1] + random.uniform(-spread, spread),
+             'courier_telegram_id': '1'}
+            for number in range(count)]
+
+
+def nearest_by_scan(shops, point):
+    return min((distance.distance(point, (shop['latitude'], shop['longitude'])).km, shop['id'])
+               for shop in shops)
+
+
+def main():
+    random.seed(1)
+    shop_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    query_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    shops = make_shops(shop_count)
+    points = [(MOSCOW[0] + random.uniform(-0.6, 0.6),
+               MOSCOW[1] + random.uniform(-0.6, 0.6))
+              for _ in range(query_count)]
+
+    start = time.perf_counter()
+    index = ShopIndex(shops)
+    print(f'index of {shop_count} shops built in {time.perf_counter() - start:.2f} s')
+
+    start = time.perf_counter()
+    results = [index.nearest(*point)[0] for point in points]
+    per_query = (time.perf_counter() - start) / query_count * 1000
+    print(f'index: {per_query:.3f} ms per query')
+
+    scan_points = points[:10]
+    start = time.perf_counter()
+    expected = [nearest_by_scan(shops, point) for point in scan_points]
+    per_query = (time.perf_counter() - start) / len(scan_points) * 1000
+    print(f' scan: {per_query:.3f} ms per query')
+
+    mismatches = sum(result[1]['id'] != shop_id
+                     for result, (distance_km, shop_id) in zip(results, expected))
+    print(f'mismatches with scan: {mismatches} of {len(scan_points)}')
+
+    zone_map = ZoneMap(index)
+    print(f'zone map: {zone_map.get_stats()}')
+    start = time.perf_counter()
+    zones = [zone_map.lookup(*point) for point in points]
+    per_query = (time.perf_counter() - start) / query_count * 1000
+    print(f'zones: {per_query:.3f} ms per query, '
+          f'{sum(zone is not None for zone in zones)} of {query_count} points in the map')
+    mismatches = sum(zone is not None and zone[0]['id'] != result[1]['id']
+                     for zone, result in zip(zones, results))
+    print(f'mismatches with index: {mismatches}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Compares render cost of menu, product card and cart screens with building
+InlineKeyboardMarkup objects on every update. Time and the peak of memory
+allocated by tracemalloc are per update, the markup is serialized in both
+cases as the bot does before sending.
+
+Usage: python -m benchmarks.bench_templates [products] [updates]
+"""
+import sys
+import time
+import tracemalloc
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from templates import Templates, get_cart_markup, get_cart_text
+
+
+def make_catalog(count):
+    products = {f'product-{number}': f'Пицца {number}' for number in range(count)}
+    details = {product_id: (name, 'Тесто, томатный соус, моцарелла, пепперони и орегано.',
+                            500 + number, f'https://files.example.com/{product_id}.jpg')
+               for number, (product_id, name) in enumerate(products.items())}
+    return products, details
+
+
+def make_cart(products, size):
+    items = [{'id': f'item-{number}', 'name': name}
+             for number, name in enumerate(list(products.values())[:size])]
+    lines = '\n'.join(f"{item['name']}\n1 шт. по 500 руб." for item in items)
+    return {'data': items}, lines, 500 * size
+
+
+def menu_before(products, details, cart):
+    keyboard = [[InlineKeyboardButton(product_name, callback_data=product_id)]
+                for (product_id, product_name) in tuple(products.items())]
+    keyboard.append([InlineKeyboardButton('ВАША КОРЗИНА', callback_data='goto_cart')])
+    return InlineKeyboardMarkup(keyboard).to_json()
+
+
+def card_before(products, details, cart):
+    product_id = next(iter(details))
+    name, description, price, href_img = details[product_id]
+    text = f'"{name}"\n\n{description}\n\n{price} рублей'
+    keyboard = [[InlineKeyboardButton('ЗАКАЗАТЬ', callback_data=f'{product_id}')]]
+    keyboard.append([InlineKeyboardButton('МЕНЮ', callback_data='goto_menu')])
+    keyboard.append([InlineKeyboardButton('ВАША КОРЗИНА', callback_data='goto_cart')])
+    return text, InlineKeyboardMarkup(keyboard).to_json()
+
+
+def cart_before(products, details, cart):
+    cart, lines, total = cart
+    keyboard = [[InlineKeyboardButton(f"УДАЛИТЬ {product['name']}", callback_data=product['id'])]
+                for product in cart['data']]
+    keyboard.append([InlineKeyboardButton('МЕНЮ', callback_data='goto_menu')])
+    if total > 0:
+        keyboard.append([InlineKeyboardButton('ОФОРМИТЬ ЗАКАЗ', callback_data='goto_checkout_geo')])
+    return f'ВАША КОРЗИНА:\n{lines}\nСумма:{total} руб.', InlineKeyboardMarkup(keyboard).to_json()
+
+
+templates = Templates(0)
+
+
+def menu_after(products, details, cart):
+    return templates.get_menu_markup(products)
+
+
+def card_after(products, details, cart):
+    product_id = next(iter(details))
+    return templates.get_card(product_id, details[product_id])
+
+
+def cart_after(products, details, cart):
+    cart, lines, total = cart
+    return get_cart_text(lines, total), get_cart_markup(cart, total)
+
+
+def measure(render, count, *args):
+    render(*args)
+    start = time.perf_counter()
+    for _ in range(count):
+        render(*args)
+    per_update = (time.perf_counter() - start) / count * 1e6
+
+    tracemalloc.start()
+    peaks = 0
+    for _ in range(min(count, 1000)):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        render(*args)
+        peaks += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return per_update, peaks / min(count, 1000)
+
+
+def main():
+    product_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    products, details = make_catalog(product_count)
+    cart = make_cart(products, 3)
+    print(f'{product_count} products, cart of 3 items, {count} updates')
+    for name, before, after in (('menu', menu_before, menu_after),
+                                ('card', card_before, card_after),
+                                ('cart', cart_before, cart_after)):
+        for stage, render in (('before', before), ('after', after)):
+            per_update, allocated = measure(render, count, products, details, cart)
+            print(f'{name:>4} {stage:>6}: {per_update:8.2f} us, '
+                  f'{allocated:8.0f} bytes allocated per update')
+
+
+if __name__ == '__main__':
+    main()
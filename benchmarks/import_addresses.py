@@ -0,0 +1,51 @@
+"""Imports a chain of pizzerias to the Moltin stub three times: from
+scratch, again without changes and after 1% of them have moved.
+
+Redis from REDIS_HOST/REDIS_PORT keeps the shops cache, so point them to
+a disposable local server.
+
+Usage: python -m benchmarks.import_addresses [branches] [latency_ms] [requests_per_second]
+"""
+import os
+import sys
+import time
+
+from benchmarks.stubs import moltin_stub
+
+
+def make_addresses(count):
+    return [{'id': number, 'alias': f'Пиццерия {number}',
+             'address': {'full': f'Москва, улица {number}'},
+             'coordinates': {'lat': 55.5 + number % 100 * 0.005,
+                             'lon': 37.3 + number // 100 * 0.01}}
+            for number in range(count)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+    rate = sys.argv[3] if len(sys.argv) > 3 else '1000'
+    stub = moltin_stub(latency)
+    os.environ.update({
+        'MOLTIN_API_URL': f'{stub.url}/v2',
+        'MOLTIN_API_OAUTH_URL': f'{stub.url}/oauth/access_token',
+        'MOLTIN_REQUESTS_PER_SECOND': rate,
+    })
+    from import_addresses import sync_addresses
+
+    addresses = make_addresses(count)
+    moved = addresses[::100]
+    for address in moved:
+        address['coordinates']['lat'] += 0.001
+    runs = (('first import', make_addresses(count)), ('re-import', make_addresses(count)),
+            (f'{len(moved)} moved', addresses))
+    for name, source in runs:
+        stub.calls.clear()
+        start = time.perf_counter()
+        sync_addresses(source)
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {elapsed:.2f} s, {len(stub.calls)} Moltin requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""Replays recorded customer updates against the threaded Flask stack
+and the asyncio stack, both talking to local Moltin and Telegram stubs.
+
+Redis from REDIS_HOST/REDIS_PORT is used for the states, so point them to
+a disposable local server.
+
+Usage: python -m benchmarks.load_test [threaded|async] [chats] [latency_ms]
+"""
+import os
+import sys
+import time
+import json
+import asyncio
+
+from benchmarks.stubs import moltin_stub, telegram_stub, PRODUCTS
+
+
+TG_TOKEN = '123456:stub-token'
+
+
+def make_user(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': 'Stub'}
+
+
+def make_message(chat_id, message_id, text):
+    message = {'message_id': message_id, 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': make_user(chat_id), 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text)}]
+    return message
+
+
+def make_callback(chat_id, message_id, data):
+    return {'id': f'{chat_id}-{message_id}', 'from': make_user(chat_id),
+            'chat_instance': str(chat_id), 'data': data,
+            'message': make_message(chat_id, message_id, 'stub')}
+
+
+def make_journey(chat_id):
+    # Start, open a pizza, order it, back to menu, order another one, cart.
+    first_product, second_product = PRODUCTS[0]['id'], PRODUCTS[1]['id']
+    steps = [('message', '/start'),
+             ('callback_query', first_product),
+             ('callback_query', first_product),
+             ('callback_query', 'goto_menu'),
+             ('callback_query', second_product),
+             ('callback_query', second_product),
+             ('callback_query', 'goto_menu'),
+             ('callback_query', 'goto_cart')]
+    updates = []
+    for number, (kind, data) in enumerate(steps, start=1):
+        update_id = chat_id * 100 + number
+        if kind == 'message':
+            update = {'update_id': update_id, 'message': make_message(chat_id, number, data)}
+        else:
+            update = {'update_id': update_id, 'callback_query': make_callback(chat_id, number, data)}
+        updates.append(update)
+    return updates
+
+
+def wait_for_calls(stub, expected, timeout=300):
+    deadline = time.time() + timeout
+    while len(stub.calls) < expected and time.time() < deadline:
+        time.sleep(0.01)
+    return len(stub.calls)
+
+
+def run_threaded(chats):
+    import application
+    client = application.app.test_client()
+    journeys = [make_journey(chat_id) for chat_id in chats]
+    for updates in zip(*journeys):
+        for update in updates:
+            client.post(f'/{TG_TOKEN}', data=json.dumps(update),
+                        content_type='application/json')
+
+
+def run_async(chats):
+    import asgi
+
+    async def post(update):
+        body = json.dumps(update).encode('utf-8')
+        scope = {'type': 'http', 'path': f'/{TG_TOKEN}', 'method': 'POST'}
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            pass
+
+        await asgi.app(scope, receive, send)
+
+    async def main():
+        await asgi.startup()
+        journeys = [make_journey(chat_id) for chat_id in chats]
+        for updates in zip(*journeys):
+            for update in updates:
+                await post(update)
+        await asgi.shutdown()
+
+    asyncio.run(main())
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'async'
+    chat_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.05
+    moltin = moltin_stub(latency)
+    telegram = telegram_stub(latency)
+    os.environ.update({
+        'MOLTIN_API_URL': f'{moltin.url}/v2',
+        'MOLTIN_API_OAUTH_URL': f'{moltin.url}/oauth/access_token',
+        'TELEGRAM_API_URL': f'{telegram.url}/bot',
+        'TG_TOKEN': TG_TOKEN,
+    })
+    run = run_threaded if mode == 'threaded' else run_async
+
+    # Warm up caches and count Telegram calls of one journey.
+    run([1])
+    calls_per_journey = wait_for_calls(telegram, 1, timeout=60)
+    time.sleep(1)
+    calls_per_journey = len(telegram.calls)
+    telegram.calls.clear()
+
+    chats = range(1000, 1000 + chat_count)
+    start = time.perf_counter()
+    run(chats)
+    done = wait_for_calls(telegram, calls_per_journey * chat_count)
+    elapsed = time.perf_counter() - start
+    updates = len(make_journey(1)) * chat_count
+    print(f'{mode}: {chat_count} chats, {updates} updates in {elapsed:.2f} s, '
+          f'{updates / elapsed:.1f} updates/s, '
+          f'{done} of {calls_per_journey * chat_count} Telegram calls')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Replays full customer journeys, from /start to the payment, through
+application.respond against local Moltin, Telegram and geocoder stubs.
+Every virtual customer sends the next update only after the previous one
+is handled, customers run concurrently.
+
+Redis from REDIS_HOST/REDIS_PORT is used, so point them to a disposable
+local server.
+
+Usage: python -m benchmarks.replay [--journeys 200] [--concurrency 20]
+           [--latency 50] [--output results.json] [--compare old.json]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.load_test import TG_TOKEN, make_message, make_callback
+from benchmarks.stubs import moltin_stub, telegram_stub, geocoder_stub, PRODUCTS
+
+
+STEP_TIMEOUT = 30
+ADDRESSES = 50
+
+
+def make_journey(chat_id):
+    # (state which handles the update, update kind, data)
+    product_id = PRODUCTS[chat_id % len(PRODUCTS)]['id']
+    return [('HANDLE_START', 'message', '/start'),
+            ('HANDLE_MENU', 'callback_query', product_id),
+            ('HANDLE_DESCRIPTION', 'callback_query', product_id),
+            ('HANDLE_CART', 'callback_query', 'goto_checkout_geo'),
+            ('HANDLE_CHECKOUT_GEO', 'message', f'Москва, улица {chat_id % ADDRESSES}'),
+            ('HANDLE_CHECKOUT_RECEIPT', 'callback_query', 'goto_checkout_delivery'),
+            ('HANDLE_CHECKOUT_PAYMENT', 'callback_query', 'goto_payment_cash')]
+
+
+def make_update(chat_id, number, kind, data):
+    update_id = chat_id * 100 + number
+    if kind == 'message':
+        return {'update_id': update_id, 'message': make_message(chat_id, number, data)}
+    return {'update_id': update_id, 'callback_query': make_callback(chat_id, number, data)}
+
+
+class Replay:
+    # Marks updates handled by the consumer, so customers know when to go on.
+    def __init__(self, application):
+        self.application = application
+        self.client = application.app.test_client()
+        self.handled = {}
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.timeouts = 0
+        process_update = application.consumer.process_update
+
+        def process_and_mark(update):
+            try:
+                process_update(update)
+            finally:
+                with self.lock:
+                    event = self.handled.get(update.update_id)
+                if event is not None:
+                    event.set()
+        application.consumer.process_update = process_and_mark
+
+    def send(self, state, update):
+        event = threading.Event()
+        with self.lock:
+            self.handled[update['update_id']] = event
+        started_at = time.perf_counter()
+        resp = self.client.post(f'/{TG_TOKEN}', data=json.dumps(update),
+                                content_type='application/json')
+        handled = resp.status_code == 200 and event.wait(STEP_TIMEOUT)
+        latency = time.perf_counter() - started_at
+        with self.lock:
+            del self.handled[update['update_id']]
+            if handled:
+                self.latencies.setdefault(state, []).append(latency)
+            else:
+                self.timeouts += 1
+
+    def run_journey(self, chat_id):
+        for number, (state, kind, data) in enumerate(make_journey(chat_id), start=1):
+            self.send(state, make_update(chat_id, number, kind, data))
+
+
+def get_percentiles(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(share):
+        return round(latencies[int(share * (len(latencies) - 1))] * 1000, 2)
+    return {'count': len(latencies), 'p50_ms': percentile(0.5), 'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99), 'max_ms': round(latencies[-1] * 1000, 2)}
+
+
+def count_redis_commands():
+    # Only commands of the handlers, the consumer and the jobs poll Redis
+    # all the time without a state.
+    import metrics
+    with metrics.metrics_lock:
+        return sum(histogram[2] for (name, labels), histogram in metrics.histograms.items()
+                   if name == 'redis_command_seconds'
+                   and dict(labels).get('state') != metrics.NO_STATE)
+
+
+def run(journeys, concurrency, latency):
+    moltin = moltin_stub(latency)
+    telegram = telegram_stub(latency)
+    geocoder = geocoder_stub(latency)
+    os.environ.update({
+        'MOLTIN_API_URL': f'{moltin.url}/v2',
+        'MOLTIN_API_OAUTH_URL': f'{moltin.url}/oauth/access_token',
+        'TELEGRAM_API_URL': f'{telegram.url}/bot',
+        'GEOCODER_URL': f'{geocoder.url}/1.x/',
+        'TG_TOKEN': TG_TOKEN,
+    })
+    import application
+    from outbox import outbox
+    replay = Replay(application)
+
+    # Warm up the catalog and shops, then count calls of the measured run.
+    replay.run_journey(1)
+    outbox.join(STEP_TIMEOUT)
+    replay.latencies.clear()
+    for stub in (moltin, telegram, geocoder):
+        stub.calls.clear()
+    redis_commands = count_redis_commands()
+
+    chat_ids = range(10000, 10000 + journeys)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(replay.run_journey, chat_ids))
+    elapsed = time.perf_counter() - started_at
+    outbox.join(STEP_TIMEOUT)
+
+    updates = sum(len(latencies) for latencies in replay.latencies.values())
+    return {
+        'config': {'journeys': journeys, 'concurrency': concurrency,
+                   'latency_ms': latency * 1000, 'started_at': time.time()},
+        'elapsed_s': round(elapsed, 3),
+        'journeys_per_s': round(journeys / elapsed, 2),
+        'updates_per_s': round(updates / elapsed, 2),
+        'timeouts': replay.timeouts,
+        'states': {state: get_percentiles(latencies)
+                   for state, latencies in replay.latencies.items()},
+        'calls_per_journey': {
+            'moltin': round(len(moltin.calls) / journeys, 2),
+            'telegram': round(len(telegram.calls) / journeys, 2),
+            'geocoder': round(len(geocoder.calls) / journeys, 2),
+            'redis': round((count_redis_commands() - redis_commands) / journeys, 2),
+        },
+    }
+
+
+def print_results(results, previous=None):
+    def compare(value, old_value):
+        if old_value is None:
+            return f'{value}'
+        return f'{value} (was {old_value})'
+
+    previous = previous or {}
+    print(f"{results['config']['journeys']} journeys, concurrency "
+          f"{results['config']['concurrency']}, {results['elapsed_s']} s, "
+          f"{compare(results['journeys_per_s'], previous.get('journeys_per_s'))} journeys/s, "
+          f"{compare(results['updates_per_s'], previous.get('updates_per_s'))} updates/s, "
+          f"{results['timeouts']} timeouts")
+    for state, percentiles in results['states'].items():
+        old_percentiles = previous.get('states', {}).get(state, {})
+        print(f'{state:>24}: ' + ', '.join(
+            f'{name} {compare(value, old_percentiles.get(name))}'
+            for name, value in percentiles.items()))
+    old_calls = previous.get('calls_per_journey', {})
+    print('calls per journey: ' + ', '.join(
+        f'{service} {compare(calls, old_calls.get(service))}'
+        for service, calls in results['calls_per_journey'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays customer journeys against stubs.')
+    parser.add_argument('--journeys', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=50, help='stub latency, ms')
+    parser.add_argument('--output', help='save results to the JSON file')
+    parser.add_argument('--compare', help='JSON file of the previous run')
+    args = parser.parse_args()
+
+    results = run(args.journeys, args.concurrency, args.latency / 1000)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if results['timeouts'] else 0)
+
+
+if __name__ == '__main__':
+    main()
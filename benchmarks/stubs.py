@@ -0,0 +1,306 @@
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs
+
+
+PRODUCTS = [
+    {'id': f'product-{number}', 'name': f'Пицца {number}',
+     'description': 'Тесто, сыр, томаты', 'price': [{'amount': 399 + number}],
+     'relationships': {'main_image': {'data': {'id': f'file-{number}'}}},
+     'meta': {'timestamps': {'created_at': f'2020-01-0{number + 1}T00:00:00',
+                             'updated_at': f'2020-01-0{number + 1}T00:00:00'}}}
+    for number in range(8)
+]
+SHOPS = [
+    {'id': f'shop-{number}', 'address': f'Москва, улица {number}',
+     'alias': f'Пиццерия {number}', 'latitude': 55.70 + number * 0.01,
+     'longitude': 37.60 + number * 0.01, 'courier_telegram_id': '1'}
+    for number in range(5)
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive HTTP/1.1 handler, routes are regexps of the server.
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        path, _, query = self.path.partition('?')
+        # Query of GET requests is given to views as the body.
+        body = body or query.encode()
+        time.sleep(self.server.latency)
+        self.server.calls.append((method, self.path))
+        for route_method, pattern, view in self.server.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                status, payload = view(self.server, body, *match.groups())
+                break
+        else:
+            status, payload = 404, {'errors': [{'title': 'Not found'}]}
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, routes, latency=0):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.routes = routes
+        self.latency = latency
+        self.calls = []
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def oauth_view(server, body):
+    return 200, {'access_token': 'stub-token', 'token_type': 'Bearer',
+                 'expires': int(time.time()) + 3600, 'expires_in': 3600}
+
+
+def get_page(entries, body):
+    # Moltin paging and sorting by timestamps, e.g. sort=-updated_at.
+    params = parse_params(body)
+    limit = int(params.get('page[limit]', 100))
+    offset = int(params.get('page[offset]', 0))
+    sort = params.get('sort')
+    if sort:
+        entries = sorted(entries, key=lambda entry: entry['meta']['timestamps'][sort.lstrip('-')],
+                         reverse=sort.startswith('-'))
+    return {'data': entries[offset:offset + limit],
+            'meta': {'page': {'total': -(-len(entries) // limit)},
+                     'results': {'total': len(entries)}}}
+
+
+def set_timestamps(entry):
+    now = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())
+    timestamps = entry.setdefault('meta', {}).setdefault('timestamps', {})
+    timestamps.setdefault('created_at', now)
+    timestamps['updated_at'] = now
+
+
+def products_view(server, body):
+    return 200, get_page(PRODUCTS, body)
+
+
+def product_view(server, body, product_id):
+    for product in PRODUCTS:
+        if product['id'] == product_id:
+            return 200, {'data': product}
+    return 404, {'errors': [{'title': 'Product not found'}]}
+
+
+def file_view(server, body, file_id):
+    return 200, {'data': {'id': file_id,
+                          'link': {'href': f'https://example.com/{file_id}.jpg'}}}
+
+
+def make_cart(items):
+    total = sum(item['quantity'] * item['unit_price']['amount'] for item in items)
+    return {'data': items,
+            'meta': {'display_price': {'with_tax': {'formatted': str(total)}}}}
+
+
+def cart_items_view(server, body, cart_id):
+    return 200, make_cart(server.carts.get(cart_id, []))
+
+
+def add_to_cart_view(server, body, cart_id):
+    product_id = json.loads(body)['data']['id']
+    product = next(product for product in PRODUCTS if product['id'] == product_id)
+    items = server.carts.setdefault(cart_id, [])
+    for item in items:
+        if item['product_id'] == product_id:
+            item['quantity'] += 1
+            break
+    else:
+        items.append({'id': f'item-{product_id}', 'product_id': product_id,
+                      'name': product['name'], 'quantity': 1,
+                      'unit_price': {'amount': product['price'][0]['amount']}})
+    return 201, make_cart(items)
+
+
+def delete_from_cart_view(server, body, cart_id, item_id):
+    items = [item for item in server.carts.get(cart_id, []) if item['id'] != item_id]
+    server.carts[cart_id] = items
+    return 200, make_cart(items)
+
+
+def flow_entries_view(server, body, flow):
+    return 200, get_page(list(server.flows.setdefault(flow, {}).values()), body)
+
+
+def flow_entry_view(server, body, flow, entry_id):
+    entry = server.flows.setdefault(flow, {}).get(entry_id)
+    if entry is None:
+        return 404, {'errors': [{'title': 'Entry not found'}]}
+    return 200, {'data': entry}
+
+
+def create_flow_entry_view(server, body, flow):
+    entry = json.loads(body)['data']
+    set_timestamps(entry)
+    with server.lock:
+        server.entry_id += 1
+        entry['id'] = f'{flow}-{server.entry_id}'
+        server.flows.setdefault(flow, {})[entry['id']] = entry
+    return 201, {'data': entry}
+
+
+def update_flow_entry_view(server, body, flow, entry_id):
+    entry = server.flows.setdefault(flow, {}).get(entry_id)
+    if entry is None:
+        return 404, {'errors': [{'title': 'Entry not found'}]}
+    entry.update(json.loads(body)['data'])
+    set_timestamps(entry)
+    return 200, {'data': entry}
+
+
+def delete_flow_entry_view(server, body, flow, entry_id):
+    if server.flows.setdefault(flow, {}).pop(entry_id, None) is None:
+        return 404, {'errors': [{'title': 'Entry not found'}]}
+    return 200, {}
+
+
+def flows_view(server, body):
+    return 200, {'data': [{'id': f'flow-{slug}', 'slug': slug, 'name': slug}
+                          for slug in server.flows]}
+
+
+def create_flow_view(server, body):
+    slug = json.loads(body)['data']['slug']
+    server.flows.setdefault(slug, {})
+    return 201, {'data': {'id': f'flow-{slug}', 'slug': slug, 'name': slug}}
+
+
+def flow_fields_view(server, body, flow):
+    return 200, {'data': [{'slug': field, 'name': field}
+                          for field in server.fields.get(f'flow-{flow}', [])]}
+
+
+def create_field_view(server, body):
+    field = json.loads(body)['data']
+    flow_id = field['relationships']['flow']['data']['id']
+    server.fields.setdefault(flow_id, []).append(field['slug'])
+    return 201, {'data': {'slug': field['slug'], 'name': field['name']}}
+
+
+def moltin_stub(latency=0):
+    # Emulates Moltin endpoints used by moltin.py, MOLTIN_API_URL and
+    # MOLTIN_API_OAUTH_URL should point to the stub before importing it.
+    routes = [
+        ('POST', r'/oauth/access_token', oauth_view),
+        ('GET', r'/v2/products', products_view),
+        ('GET', r'/v2/products/([^/]+)', product_view),
+        ('GET', r'/v2/files/([^/]+)', file_view),
+        ('GET', r'/v2/carts/([^/]+)/items', cart_items_view),
+        ('POST', r'/v2/carts/([^/]+)/items', add_to_cart_view),
+        ('DELETE', r'/v2/carts/([^/]+)/items/([^/]+)', delete_from_cart_view),
+        ('GET', r'/v2/flows/([^/]+)/entries', flow_entries_view),
+        ('GET', r'/v2/flows/([^/]+)/entries/([^/]+)', flow_entry_view),
+        ('POST', r'/v2/flows/([^/]+)/entries', create_flow_entry_view),
+        ('PUT', r'/v2/flows/([^/]+)/entries/([^/]+)', update_flow_entry_view),
+        ('DELETE', r'/v2/flows/([^/]+)/entries/([^/]+)', delete_flow_entry_view),
+        ('GET', r'/v2/flows', flows_view),
+        ('POST', r'/v2/flows', create_flow_view),
+        ('GET', r'/v2/flows/([^/]+)/fields', flow_fields_view),
+        ('POST', r'/v2/fields', create_field_view),
+    ]
+    server = StubServer(routes, latency)
+    server.carts = {}
+    server.fields = {}
+    server.entry_id = 0
+    server.lock = Lock()
+    server.flows = {'addresses2': {shop['id']: dict(shop) for shop in SHOPS}}
+    for entry in server.flows['addresses2'].values():
+        set_timestamps(entry)
+    return server.start()
+
+
+def parse_params(body):
+    if not body:
+        return {}
+    try:
+        return json.loads(body)
+    except ValueError:
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+
+def telegram_view(server, body, token, method):
+    params = parse_params(body)
+    if method in ('deleteMessage', 'answerPreCheckoutQuery', 'setWebhook'):
+        return 200, {'ok': True, 'result': True}
+    if method == 'getMe':
+        return 200, {'ok': True, 'result': {'id': int(token.split(':')[0]), 'is_bot': True,
+                                            'first_name': 'Stub', 'username': 'stub_bot'}}
+    with server.lock:
+        server.message_id += 1
+        message_id = server.message_id
+    message = {'message_id': message_id, 'date': int(time.time()),
+               'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}
+    if method == 'sendPhoto':
+        message['photo'] = [{'file_id': f'photo-{message_id}', 'width': 400,
+                             'height': 400, 'file_unique_id': str(message_id)}]
+    else:
+        message['text'] = params.get('text', '')
+    return 200, {'ok': True, 'result': message}
+
+
+def telegram_stub(latency=0):
+    # Emulates Bot API, bot base url should be f'{stub.url}/bot'.
+    routes = [
+        ('POST', r'/bot([^/]+)/(\w+)', telegram_view),
+        ('GET', r'/bot([^/]+)/(\w+)', telegram_view),
+    ]
+    server = StubServer(routes, latency)
+    server.message_id = 0
+    server.lock = Lock()
+    return server.start()
+
+
+def geocoder_view(server, body):
+    # Every address is found next to the first shop.
+    shop = SHOPS[0]
+    geo_object = {
+        'Point': {'pos': f"{shop['longitude'] + 0.001} {shop['latitude'] + 0.001}"},
+        'metaDataProperty': {'GeocoderMetaData': {'text': shop['address']}},
+    }
+    return 200, {'response': {'GeoObjectCollection': {
+        'featureMember': [{'GeoObject': geo_object}]}}}
+
+
+def geocoder_stub(latency=0):
+    # Emulates Yandex geocoder, GEOCODER_URL should be f'{stub.url}/1.x/'.
+    routes = [('GET', r'/1\.x/', geocoder_view)]
+    return StubServer(routes, latency).start()
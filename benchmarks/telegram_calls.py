@@ -0,0 +1,71 @@
+"""Counts Telegram API calls per click of menu navigation. Before edit in
+place every click was one send and one delete. Needs local disposable
+Redis from REDIS_HOST/REDIS_PORT.
+
+Usage: python -m benchmarks.telegram_calls
+"""
+import os
+from types import SimpleNamespace
+
+from benchmarks.stubs import moltin_stub, PRODUCTS
+
+
+CHAT_ID = 'telegram-calls'
+
+
+class FakeBot:
+    # Records methods, returns message as Telegram does.
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            photo = [SimpleNamespace(file_id='file')] if 'photo' in name or 'media' in name else []
+            return SimpleNamespace(message_id=len(self.calls), photo=photo)
+        return call
+
+
+def make_click(data, is_photo):
+    message = SimpleNamespace(message_id=1, chat_id=CHAT_ID,
+                              photo=[object()] if is_photo else [])
+    query = SimpleNamespace(data=data, message=message)
+    return SimpleNamespace(message=None, callback_query=query)
+
+
+def main():
+    stub = moltin_stub()
+    os.environ['MOLTIN_API_URL'] = f'{stub.url}/v2'
+    os.environ['MOLTIN_API_OAUTH_URL'] = f'{stub.url}/oauth/access_token'
+    import main as handlers
+    from chat_sessions import ChatSession
+    from outbox import outbox
+    from telegram_displays import CountingBot, get_telegram_calls_stats
+
+    # Text to photo screens still need send and delete, text screens are edited.
+    clicks = [
+        (handlers.handle_menu, PRODUCTS[0]['id'], False),
+        (handlers.handle_description, 'goto_menu', True),
+        (handlers.handle_menu, PRODUCTS[1]['id'], False),
+        (handlers.handle_description, PRODUCTS[1]['id'], True),
+        (handlers.handle_cart, 'goto_menu', False),
+        (handlers.handle_menu, 'goto_cart', False),
+        (handlers.handle_cart, 'goto_menu', False),
+        (handlers.handle_menu, 'goto_cart', False),
+    ]
+    outbox.start()
+    bot = FakeBot()
+    session = ChatSession(CHAT_ID, {})
+    for handler, data, is_photo in clicks:
+        counting_bot = CountingBot(bot)
+        handler(counting_bot, make_click(data, is_photo), None, session)
+        counting_bot.finish()
+        outbox.join()
+    print(f' clicks: {len(clicks)}')
+    print(f'  calls: {len(bot.calls)} {bot.calls}')
+    print(f'  stats: {get_telegram_calls_stats()}')
+    print(f' before: {2 * len(clicks)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import json
+import time
+import logging
+from collections import OrderedDict
+from threading import Lock, Thread
+
+import redis
+
+from db import get_database_connection
+
+
+VERSION_CHECK_INTERVAL = 5
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class TieredCache:
+    # Per-process LRU in front of Redis. Values older than fresh_time are
+    # returned as is and refreshed by background thread, values older than
+    # ttl are loaded again. Redis keys contain namespace version, so
+    # invalidate() drops cache of all processes with single INCR.
+    def __init__(self, namespace, ttl, fresh_time=None, maxsize=1024, empty_ttl=None):
+        # None values are kept for empty_ttl if it's set.
+        self.namespace = namespace
+        self.ttl = ttl
+        self.empty_ttl = empty_ttl
+        self.fresh_time = fresh_time if fresh_time is not None else ttl
+        self.lru = LRUCache(maxsize)
+        self.version = None
+        self.version_checked_at = 0
+        self.refreshing = set()
+        self.lock = Lock()
+
+    def get_version(self):
+        now = time.time()
+        if now - self.version_checked_at < VERSION_CHECK_INTERVAL:
+            return self.version
+        try:
+            database = get_database_connection()
+            version = int(database.get(f'{self.namespace}:version') or 0)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Cache "{self.namespace}" version is unavailable: {e}')
+            version = self.version
+        if version != self.version:
+            self.lru.clear()
+            self.version = version
+        self.version_checked_at = now
+        return version
+
+    def make_key(self, key):
+        return f'{self.namespace}:{self.get_version()}:{key}'
+
+    def load_shared(self, key):
+        try:
+            entry = get_database_connection().get(self.make_key(key))
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Cache "{self.namespace}" is unavailable: {e}')
+            return
+        if entry is None:
+            return
+        entry = json.loads(entry)
+        self.lru.set(key, entry)
+        return entry
+
+    def get_ttl(self, value):
+        if value is None and self.empty_ttl is not None:
+            return self.empty_ttl
+        return self.ttl
+
+    def set(self, key, value):
+        entry = {'value': value, 'fetched_at': time.time()}
+        self.lru.set(key, entry)
+        try:
+            get_database_connection().set(self.make_key(key), json.dumps(entry),
+                                          ex=self.get_ttl(value))
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Cache "{self.namespace}" is unavailable: {e}')
+        return value
+
+    def refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            logging.error(f'Cache "{self.namespace}" refresh of {key} failed: {e}')
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def refresh_in_background(self, key, loader):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        Thread(target=self.refresh, args=(key, loader), daemon=True).start()
+
+    def get(self, key, loader):
+        self.get_version()
+        entry = self.lru.get(key) or self.load_shared(key)
+        if entry is None:
+            return self.set(key, loader())
+        age = time.time() - entry['fetched_at']
+        if age > self.get_ttl(entry['value']):
+            return self.set(key, loader())
+        if age > self.fresh_time:
+            self.refresh_in_background(key, loader)
+        return entry['value']
+
+    def delete(self, key):
+        self.lru.delete(key)
+        try:
+            get_database_connection().delete(self.make_key(key))
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Cache "{self.namespace}" is unavailable: {e}')
+
+    def invalidate(self):
+        self.lru.clear()
+        try:
+            self.version = get_database_connection().incr(f'{self.namespace}:version')
+            self.version_checked_at = time.time()
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Cache "{self.namespace}" is unavailable: {e}')
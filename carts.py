@@ -0,0 +1,123 @@
+import json
+import logging
+
+import redis
+
+import moltin
+from db import get_database_connection
+
+
+CART_TTL = 60 * 60
+
+
+def get_cart_key(chat_id):
+    return f'cart:{chat_id}'
+
+
+def format_version(version):
+    # Session gives the version back as a string after it's saved to Redis.
+    return None if version is None else str(version)
+
+
+def encode_cart(cart, products, total, version):
+    return json.dumps({'cart': cart, 'products': products, 'total': total,
+                       'version': format_version(version)})
+
+
+def decode_cart(cached_cart, version):
+    # Returns cached cart, products text and total, None if the cart of this
+    # version isn't cached.
+    if cached_cart is None:
+        return
+    cached_cart = json.loads(cached_cart)
+    if version is None or cached_cart['version'] == format_version(version):
+        return cached_cart['cart'], cached_cart['products'], cached_cart['total']
+
+
+def is_cart_left(cart):
+    return 'data' in cart and 'meta' in cart
+
+
+def save_cart(chat_id, cart, products, total, version=None):
+    try:
+        get_database_connection().set(
+            get_cart_key(chat_id),
+            encode_cart(cart, products, total, version),
+            ex=CART_TTL,
+        )
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Cart cache is unavailable: {e}')
+    return cart, products, total
+
+
+def invalidate_cart(chat_id):
+    try:
+        get_database_connection().delete(get_cart_key(chat_id))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Cart cache is unavailable: {e}')
+
+
+def get_cart(chat_id, version=None):
+    # Returns the same cart, products text and total as moltin.get_cart,
+    # Moltin is asked only if the cart of this version isn't cached yet.
+    try:
+        cached_cart = get_database_connection().get(get_cart_key(chat_id))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Cart cache is unavailable: {e}')
+        cached_cart = None
+    return (decode_cart(cached_cart, version)
+            or save_cart(chat_id, *moltin.get_cart(chat_id), version))
+
+
+def add_to_cart(chat_id, product_id, version=None):
+    return save_cart(chat_id, *moltin.add_to_cart(chat_id, product_id), version)
+
+
+def delete_from_cart(chat_id, item_id, version=None):
+    # Moltin answers with the cart items left, so the cart isn't asked again.
+    cart = moltin.delete_from_cart(chat_id, item_id)
+    if not is_cart_left(cart):
+        invalidate_cart(chat_id)
+        return get_cart(chat_id, version)
+    return save_cart(chat_id, *moltin.parse_cart(cart), version)
+
+
+async def save_cart_async(database, chat_id, cart, products, total, version=None):
+    try:
+        await database.set(get_cart_key(chat_id), encode_cart(cart, products, total, version),
+                           ex=CART_TTL)
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Cart cache is unavailable: {e}')
+    return cart, products, total
+
+
+async def invalidate_cart_async(database, chat_id):
+    try:
+        await database.delete(get_cart_key(chat_id))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Cart cache is unavailable: {e}')
+
+
+async def get_cart_async(database, moltin_client, chat_id, version=None):
+    # The same cache for the async stack, Moltin is asked by its client.
+    try:
+        cached_cart = await database.get(get_cart_key(chat_id))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Cart cache is unavailable: {e}')
+        cached_cart = None
+    return (decode_cart(cached_cart, version)
+            or await save_cart_async(database, chat_id, *await moltin_client.get_cart(chat_id),
+                                     version))
+
+
+async def add_to_cart_async(database, moltin_client, chat_id, product_id, version=None):
+    return await save_cart_async(database, chat_id,
+                                 *await moltin_client.add_to_cart(chat_id, product_id), version)
+
+
+async def delete_from_cart_async(database, moltin_client, chat_id, item_id, version=None):
+    cart = await moltin_client.delete_from_cart(chat_id, item_id)
+    if not is_cart_left(cart):
+        await invalidate_cart_async(database, chat_id)
+        return await get_cart_async(database, moltin_client, chat_id, version)
+    return await save_cart_async(database, chat_id, *moltin.parse_cart(cart), version)
@@ -0,0 +1,70 @@
+import logging
+from threading import Thread
+
+import moltin
+from cache import TieredCache
+from replica import Replica
+
+
+CATALOG_TTL = 24 * 60 * 60
+CATALOG_FRESH_TIME = 10 * 60
+
+catalog_cache = TieredCache('catalog', ttl=CATALOG_TTL,
+                            fresh_time=CATALOG_FRESH_TIME)
+products_replica = Replica('products', moltin.get_products_page,
+                           on_change=lambda entries: invalidate_catalog())
+
+
+def get_created_at(product):
+    return product.get('meta', {}).get('timestamps', {}).get('created_at') or ''
+
+
+def load_products():
+    # Replica keeps the menu through Moltin outages.
+    products = products_replica.get_entries()
+    if products is None:
+        return moltin.get_products()
+    return {product['id']: product['name']
+            for product in sorted(products.values(), key=get_created_at)}
+
+
+def load_product_details(product_id):
+    product = products_replica.get(product_id)
+    if product is None:
+        return moltin.get_product_details(product_id)
+    return moltin.parse_product(product)
+
+
+def get_products():
+    return catalog_cache.get('products', load_products)
+
+
+def get_product(product_id):
+    name, description, price, id_img = catalog_cache.get(
+        f'product:{product_id}',
+        lambda: load_product_details(product_id)
+    )
+    href_img = catalog_cache.get(f'file:{id_img}',
+                                 lambda: moltin.get_file_href(id_img))
+    return name, description, price, href_img
+
+
+def get_catalog_version():
+    return catalog_cache.get_version()
+
+
+def invalidate_catalog():
+    catalog_cache.invalidate()
+
+
+def warm_catalog():
+    # Loads menu and all products, so the first customers don't wait for Moltin.
+    try:
+        for product_id in get_products():
+            get_product(product_id)
+    except moltin.MoltinError as e:
+        logging.error(f'Catalog warm up failed: {e}')
+
+
+def warm_catalog_in_background():
+    Thread(target=warm_catalog, name='catalog_warm_up', daemon=True).start()
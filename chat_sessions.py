@@ -0,0 +1,120 @@
+from db import get_database_connection
+
+
+SESSION_TTL = 7 * 24 * 60 * 60
+SESSION_FIELDS = ('state', 'customer_id', 'nearest_shop_id', 'latitude',
+                  'longitude', 'cart_version', 'order_id')
+ORDERS_COUNTER_KEY = 'orders:counter'
+
+
+class ChatSession(dict):
+    # Fields of the chat session hash, values are strings as in Redis.
+    # Only changed fields are written back.
+    def __init__(self, chat_id, fields, legacy=False):
+        super().__init__(fields)
+        self.chat_id = chat_id
+        # Legacy session isn't in the hash yet, so all its fields are new.
+        self.loaded = {} if legacy else dict(fields)
+        self.legacy = legacy
+
+    def get_changes(self):
+        updated = {field: str(value) for field, value in self.items()
+                   if value is not None and self.loaded.get(field) != str(value)}
+        removed = [field for field in self.loaded if self.get(field) is None]
+        return updated, removed
+
+    def mark_saved(self):
+        self.loaded = {field: str(value) for field, value in self.items()
+                       if value is not None}
+        self.legacy = False
+
+
+def next_cart_version(session):
+    # Cart cache entries of other versions are ignored.
+    session['cart_version'] = int(session.get('cart_version') or 0) + 1
+    return session['cart_version']
+
+
+def start_order(session):
+    # Every checkout gets its own order id, so jobs and dispatch of a repeated
+    # order of the same cart aren't taken for the done ones.
+    session['order_id'] = get_database_connection().incr(ORDERS_COUNTER_KEY)
+    return session['order_id']
+
+
+async def start_order_async(database, session):
+    session['order_id'] = await database.incr(ORDERS_COUNTER_KEY)
+    return session['order_id']
+
+
+def finish_order(session):
+    # Paid cart gets a new version, the next checkout a new order id.
+    session['order_id'] = None
+    return next_cart_version(session)
+
+
+def get_session_key(chat_id):
+    return f'session:{chat_id}'
+
+
+def get_legacy_keys(chat_id):
+    # Before the session hash state and customer were separate keys.
+    return chat_id, f'{chat_id}_id_customer'
+
+
+def decode_session(chat_id, results):
+    fields, state, customer_id = results
+    fields = {field.decode('utf-8'): value.decode('utf-8')
+              for field, value in fields.items()}
+    if fields or state is None:
+        return ChatSession(chat_id, fields)
+    fields = {'state': state.decode('utf-8')}
+    if customer_id is not None:
+        fields['customer_id'] = customer_id.decode('utf-8')
+    return ChatSession(chat_id, fields, legacy=True)
+
+
+def queue_load(pipe, chat_id):
+    pipe.hgetall(get_session_key(chat_id))
+    for key in get_legacy_keys(chat_id):
+        pipe.get(key)
+
+
+def queue_save(pipe, session):
+    key = get_session_key(session.chat_id)
+    updated, removed = session.get_changes()
+    if updated:
+        pipe.hset(key, mapping=updated)
+    if removed:
+        pipe.hdel(key, *removed)
+    pipe.expire(key, SESSION_TTL)
+    if session.legacy:
+        pipe.delete(*get_legacy_keys(session.chat_id))
+
+
+def load_session(chat_id):
+    # Session is read with one round trip at the start of every update.
+    pipe = get_database_connection().pipeline(transaction=False)
+    queue_load(pipe, chat_id)
+    return decode_session(chat_id, pipe.execute())
+
+
+def save_session(session):
+    # And written with one round trip at the end, TTL drops abandoned chats.
+    pipe = get_database_connection().pipeline()
+    queue_save(pipe, session)
+    pipe.execute()
+    session.mark_saved()
+
+
+async def load_session_async(database, chat_id):
+    async with database.pipeline(transaction=False) as pipe:
+        queue_load(pipe, chat_id)
+        return decode_session(chat_id, await pipe.execute())
+
+
+async def save_session_async(database, session):
+    async with database.pipeline() as pipe:
+        queue_save(pipe, session)
+        await pipe.execute()
+    session.mark_saved()
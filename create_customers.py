@@ -1,14 +1,9 @@
-import os
-import re
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from requests.exceptions import HTTPError, ConnectionError
 from dotenv import load_dotenv
 
-from moltin import (check_resp_json, get_headers, MoltinError, MOLTIN_API_URL,
-                    MOLTIN_API_OAUTH_URL, MOLTIN_ERR_MSG, MOLTIN_FLOW_ADDRESSES,
-                    create_flow, create_fields)
+from flows import ensure_flow, ensure_fields, SYNC_THREADS
+from moltin import MOLTIN_FLOW_CUSTOMERS
 
 
 FLOW_CUSTOMERS_FIELDS = {
@@ -22,17 +17,10 @@ FLOW_CUSTOMERS_FIELDS = {
 
 if __name__ == '__main__':
     load_dotenv()
-    moltin_client_id = os.environ.get('MOLTIN_CLIENT_ID')
-    moltin_client_secret = os.environ.get('MOLTIN_CLIENT_SECRET')
-    headers = get_headers(moltin_client_id, moltin_client_secret)
 
-    # Create flow
-    moltin_flow_create = create_flow(MOLTIN_FLOW_CUSTOMERS)
-    print('Flow "{}" created'.format(moltin_flow_create['data']['name']))
-
-    # Create fields
-    moltin_create_fields = create_fields(
-                                os.environ.get('MOLTIN_FLOW_CUSTOMERS_ID'),
-                                FLOW_CUSTOMERS_FIELDS
-                            )
-    print(moltin_create_fields)
+    # Flow and fields are created only if they don't exist yet
+    flow = ensure_flow(MOLTIN_FLOW_CUSTOMERS)
+    print('Flow "{}" is ready'.format(flow['name']))
+    with ThreadPoolExecutor(SYNC_THREADS) as pool:
+        created_fields = ensure_fields(pool, flow, FLOW_CUSTOMERS_FIELDS)
+    print(f"Fields created: {', '.join(created_fields) or 'none'}")
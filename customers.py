@@ -0,0 +1,157 @@
+import json
+import time
+import logging
+import functools
+from threading import Thread
+
+import redis
+
+import moltin
+from cache import LRUCache
+from db import get_database_connection
+from replica import Replica
+
+
+PROFILE_TTL = 90 * 24 * 60 * 60
+PROFILES_CACHE_SIZE = 4096
+PENDING_WRITES_KEY = 'customers:pending'
+WRITER_LOCK_KEY = 'customers:writer_lock'
+WRITER_CURSOR_KEY = 'customers:writer_cursor'
+WRITER_INTERVAL = 2
+WRITER_BATCH_SIZE = 50
+WRITER_MAX_ATTEMPTS = 5
+WRITER_RETRY_BACKOFF = 5
+
+profiles = LRUCache(PROFILES_CACHE_SIZE)
+customers_replica = Replica(
+    moltin.MOLTIN_FLOW_CUSTOMERS,
+    functools.partial(moltin.get_flow_entries, moltin.MOLTIN_FLOW_CUSTOMERS))
+
+# Deletes pending write only if nobody has changed it while it was written.
+DELETE_IF_EQUAL_SCRIPT = '''
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+'''
+
+# Puts failed write back for retry, unless a newer one was queued meanwhile.
+REPLACE_IF_EQUAL_SCRIPT = '''
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+end
+return 0
+'''
+
+
+def get_profile_key(chat_id):
+    return f'customer:{chat_id}'
+
+
+def get_profile(chat_id):
+    # Returns last coordinates, address and nearest shop of the customer.
+    profile = profiles.get(str(chat_id))
+    if profile is not None:
+        return profile
+    try:
+        profile = get_database_connection().get(get_profile_key(chat_id))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Customer profiles are unavailable: {e}')
+        return
+    if profile is None:
+        return
+    profile = json.loads(profile)
+    profiles.set(str(chat_id), profile)
+    return profile
+
+
+def save_profile(chat_id, profile):
+    profiles.set(str(chat_id), profile)
+    try:
+        get_database_connection().set(get_profile_key(chat_id), json.dumps(profile),
+                                      ex=PROFILE_TTL)
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Customer profiles are unavailable: {e}')
+
+
+def get_customer(customer_id):
+    # Returns coordinates and nearest shop of the Moltin customer entry.
+    customer = customers_replica.get(customer_id)
+    if customer is None:
+        return moltin.get_customer(customer_id)
+    return customer['latitude'], customer['longitude'], customer['nearest_shop_id']
+
+
+def save_customer(chat_id, latitude, longitude, address, nearest_shop_id):
+    # Profile is saved locally at once, Moltin customers flow is written
+    # later by the background writer.
+    profile = {'latitude': latitude, 'longitude': longitude,
+               'address': address, 'nearest_shop_id': nearest_shop_id}
+    save_profile(chat_id, profile)
+    try:
+        get_database_connection().hset(PENDING_WRITES_KEY, chat_id,
+                                       json.dumps({'profile': profile, 'attempts': 0}))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Customer write is not queued: {e}')
+    return profile
+
+
+def write_customer(database, chat_id, pending_write):
+    # Returns False if failed write isn't due to retry yet.
+    pending = json.loads(pending_write)
+    if pending.get('retry_at', 0) > time.time():
+        return False
+    profile = pending['profile']
+    try:
+        customer_id = moltin.add_customer(chat_id, profile['latitude'], profile['longitude'],
+                                          profile['address'], profile['nearest_shop_id'])
+    except moltin.MoltinError as e:
+        pending['attempts'] += 1
+        if pending['attempts'] >= WRITER_MAX_ATTEMPTS:
+            logging.critical(f'Customer {chat_id} is not written to Moltin: {e}')
+            database.eval(DELETE_IF_EQUAL_SCRIPT, 1, PENDING_WRITES_KEY, chat_id, pending_write)
+        else:
+            logging.error(f'Customer {chat_id} write failed, will retry: {e}')
+            pending['retry_at'] = time.time() + WRITER_RETRY_BACKOFF * 2 ** pending['attempts']
+            database.eval(REPLACE_IF_EQUAL_SCRIPT, 1, PENDING_WRITES_KEY, chat_id,
+                          pending_write, json.dumps(pending))
+        return True
+    database.eval(DELETE_IF_EQUAL_SCRIPT, 1, PENDING_WRITES_KEY, chat_id, pending_write)
+    stored_profile = get_profile(chat_id)
+    if stored_profile is not None:
+        save_profile(chat_id, {**stored_profile, 'customer_id': customer_id})
+    return True
+
+
+def write_pending_customers():
+    # Writes a batch of pending customers, only one worker of all processes
+    # does it at once. Repeated checkouts of a chat are written once.
+    database = get_database_connection()
+    lock = database.lock(WRITER_LOCK_KEY, timeout=WRITER_INTERVAL * 30)
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        # Scan goes on from the last batch, so writes waiting for retry don't
+        # hold the ones behind them.
+        cursor = int(database.get(WRITER_CURSOR_KEY) or 0)
+        cursor, pending_writes = database.hscan(PENDING_WRITES_KEY, cursor,
+                                                count=WRITER_BATCH_SIZE)
+        database.set(WRITER_CURSOR_KEY, cursor)
+        return sum(write_customer(database, chat_id.decode('utf-8'), pending_write)
+                   for chat_id, pending_write in pending_writes.items())
+    finally:
+        lock.release()
+
+
+def run_customer_writer():
+    while True:
+        try:
+            if not write_pending_customers():
+                time.sleep(WRITER_INTERVAL)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Customer writer: {e}')
+            time.sleep(WRITER_INTERVAL)
+
+
+def start_customer_writer():
+    Thread(target=run_customer_writer, name='customer_writer', daemon=True).start()
@@ -0,0 +1,53 @@
+import os
+from threading import Lock
+
+import redis
+from redis.client import Pipeline
+from dotenv import load_dotenv
+
+import metrics
+
+
+load_dotenv()
+
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 32))
+REDIS_POOL_TIMEOUT = 5
+
+database = None
+database_lock = Lock()
+
+
+class InstrumentedPipeline(Pipeline):
+    def execute(self, *args, **kwargs):
+        with metrics.timer('redis_command_seconds', command='PIPELINE'):
+            return super().execute(*args, **kwargs)
+
+
+class InstrumentedRedis(redis.Redis):
+    # Times every command, pipeline is timed as a whole.
+    def execute_command(self, *args, **options):
+        with metrics.timer('redis_command_seconds', command=args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
+
+
+def get_database_connection():
+    # One connection pool is shared by all threads of the process.
+    global database
+    if database is None:
+        with database_lock:
+            if database is None:
+                db_pwd = os.getenv('REDIS_PWD')
+                db_host = os.getenv('REDIS_HOST')
+                db_port = os.getenv('REDIS_PORT')
+                pool = redis.BlockingConnectionPool(
+                    host=db_host, port=db_port, password=db_pwd,
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    timeout=REDIS_POOL_TIMEOUT,
+                )
+                redis_class = InstrumentedRedis if metrics.INSTRUMENTATION_ENABLED else redis.Redis
+                database = redis_class(connection_pool=pool)
+    return database
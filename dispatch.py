@@ -0,0 +1,127 @@
+import os
+import time
+import logging
+
+import redis
+
+import metrics
+from db import get_database_connection
+from shops import get_delivery_radius, get_shop_index
+
+
+# Order goes to the shop of the least ETA: travel time plus time to deliver
+# the orders which its courier already has.
+DISPATCH_CANDIDATES = int(os.getenv('DISPATCH_CANDIDATES', 3))
+DISPATCH_MINUTES_PER_KM = float(os.getenv('DISPATCH_MINUTES_PER_KM', 3))
+DISPATCH_MINUTES_PER_ORDER = float(os.getenv('DISPATCH_MINUTES_PER_ORDER', 10))
+# Order leaves the board when it's delivered or when its time is over.
+DISPATCH_ORDER_TIME = int(os.getenv('DISPATCH_ORDER_TIME', 60 * 60))
+DISPATCH_EXPIRE_BATCH = 10
+DISPATCH_ORDERS_KEY = 'dispatch:orders'
+DISPATCH_QUEUES_KEY = 'dispatch:queues'
+DISPATCH_DEADLINES_KEY = 'dispatch:deadlines'
+
+# Removes the order from the board and its shop queue, returns the shop.
+CLOSE_FUNCTION = '''
+local function close(order_id)
+    local shop_id = redis.call('HGET', KEYS[1], order_id)
+    if shop_id and redis.call('HINCRBY', KEYS[2], shop_id, -1) <= 0 then
+        redis.call('HDEL', KEYS[2], shop_id)
+    end
+    redis.call('HDEL', KEYS[1], order_id)
+    redis.call('ZREM', KEYS[3], order_id)
+    return shop_id
+end
+'''
+
+# Expires a few overdue orders, then puts the order to the queue of the shop
+# with the least travel time plus queue length. Repeated order gets the same
+# shop. Arguments after the first four are shop id and travel time pairs.
+ASSIGN_SCRIPT = CLOSE_FUNCTION + '''
+local shop_id = redis.call('HGET', KEYS[1], ARGV[1])
+if shop_id then
+    return shop_id
+end
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[2], 'LIMIT', 0, ARGV[5])
+for _, order_id in ipairs(expired) do
+    close(order_id)
+end
+local best_score
+for index = 6, #ARGV, 2 do
+    local queue = tonumber(redis.call('HGET', KEYS[2], ARGV[index]) or 0)
+    local score = tonumber(ARGV[index + 1]) + queue * tonumber(ARGV[4])
+    if not best_score or score < best_score then
+        shop_id, best_score = ARGV[index], score
+    end
+end
+redis.call('HINCRBY', KEYS[2], shop_id, 1)
+redis.call('HSET', KEYS[1], ARGV[1], shop_id)
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[1])
+return shop_id
+'''
+
+COMPLETE_SCRIPT = CLOSE_FUNCTION + '''
+return close(ARGV[1])
+'''
+
+
+def get_candidates(shop_index, latitude, longitude):
+    # Returns (shop, travel minutes) pairs of the nearest shops which deliver
+    # to the point, the nearest one is always there.
+    nearest = shop_index.nearest(latitude, longitude, DISPATCH_CANDIDATES)
+    return [(shop, round(distance_km * DISPATCH_MINUTES_PER_KM, 2))
+            for number, (distance_km, shop) in enumerate(nearest)
+            if number == 0 or distance_km <= get_delivery_radius(shop)]
+
+
+def assign(order_id, candidates):
+    # Returns id of the shop which got the order.
+    now = time.time()
+    arguments = [order_id, now, now + DISPATCH_ORDER_TIME, DISPATCH_MINUTES_PER_ORDER,
+                 DISPATCH_EXPIRE_BATCH]
+    for shop, minutes in candidates:
+        arguments += [shop['id'], minutes]
+    with metrics.timer('dispatch_seconds'):
+        shop_id = get_database_connection().eval(
+            ASSIGN_SCRIPT, 3, DISPATCH_ORDERS_KEY, DISPATCH_QUEUES_KEY,
+            DISPATCH_DEADLINES_KEY, *arguments)
+    return shop_id.decode('utf-8')
+
+
+def dispatch_order(order_id, latitude, longitude):
+    # Returns the shop which should deliver the order, None if there are no
+    # shops or the board is unavailable, then the nearest shop delivers it.
+    shop_index = get_shop_index()
+    candidates = get_candidates(shop_index, latitude, longitude)
+    if not candidates:
+        return
+    try:
+        shop_id = assign(order_id, candidates)
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Order {order_id} is not dispatched: {e}')
+        return
+    return shop_index.get_shop(shop_id)
+
+
+def complete_order(order_id):
+    # Returns id of the shop which delivered the order, None if the order
+    # isn't on the board.
+    shop_id = get_database_connection().eval(
+        COMPLETE_SCRIPT, 3, DISPATCH_ORDERS_KEY, DISPATCH_QUEUES_KEY,
+        DISPATCH_DEADLINES_KEY, order_id)
+    return shop_id and shop_id.decode('utf-8')
+
+
+def get_queues():
+    queues = get_database_connection().hgetall(DISPATCH_QUEUES_KEY)
+    return {shop_id.decode('utf-8'): int(queue) for shop_id, queue in queues.items()}
+
+
+def get_stats():
+    queues = get_queues()
+    busiest = sorted(queues.items(), key=lambda item: item[1], reverse=True)[:10]
+    return {
+        'open_orders': sum(queues.values()),
+        'busy_shops': len(queues),
+        'busiest': [{'shop_id': shop_id, 'open_orders': queue} for shop_id, queue in busiest],
+    }
@@ -0,0 +1,121 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from moltin import (MoltinError, MOLTIN_PAGE_LIMIT, MOLTIN_POOL_SIZE, create_entry,
+                    create_field, create_flow, delete_entry, get_flow_entries,
+                    get_flow_fields, get_flows, update_entry)
+from ratelimit import rate_limited
+
+
+# Every thread has its own connection of the Moltin session.
+SYNC_THREADS = MOLTIN_POOL_SIZE
+FIELD_TYPES = {'string': str, 'float': float, 'integer': int, 'boolean': bool}
+
+
+def ensure_flow(slug):
+    # Returns the flow, it's created only if there is no flow with the slug.
+    for flow in rate_limited(get_flows):
+        if flow['slug'] == slug:
+            return flow
+    return rate_limited(create_flow, slug)['data']
+
+
+def ensure_fields(pool, flow, fields):
+    # Creates missing fields of the flow concurrently, returns their names.
+    existing = {field['slug'] for field in rate_limited(get_flow_fields, flow['slug'])['data']}
+    missing = [(field, type) for field, type in fields.items() if field not in existing]
+    futures = [pool.submit(rate_limited, create_field, flow['id'], field, type)
+               for field, type in missing]
+    return [future.result()['name'] for future in futures]
+
+
+def get_all_entries(pool, slug):
+    # The first page tells the number of entries, the rest are loaded
+    # concurrently.
+    entries, total = rate_limited(get_flow_entries, slug, 0)
+    futures = [pool.submit(rate_limited, get_flow_entries, slug, offset)
+               for offset in range(MOLTIN_PAGE_LIMIT, total, MOLTIN_PAGE_LIMIT)]
+    for future in futures:
+        entries += future.result()[0]
+    return entries
+
+
+def normalize(value, type):
+    if value is None:
+        return
+    try:
+        return FIELD_TYPES.get(type, str)(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def diff_entries(records, entries, fields, key_field='id_field'):
+    # Returns records to create, (entry id, record) pairs to update and ids of
+    # entries to delete: entries missing in records and duplicates of a key.
+    # Fields which records don't have are left as they are.
+    existing = {}
+    to_delete = []
+    for entry in entries:
+        key = normalize(entry.get(key_field), fields[key_field])
+        if key in existing:
+            to_delete.append(entry['id'])
+        else:
+            existing[key] = entry
+    to_create, to_update = [], []
+    for key, record in records.items():
+        entry = existing.pop(key, None)
+        if entry is None:
+            to_create.append(record)
+        elif any(normalize(entry.get(field), fields[field]) != normalize(value, fields[field])
+                 for field, value in record.items()):
+            to_update.append((entry['id'], record))
+    to_delete += [entry['id'] for entry in existing.values()]
+    return to_create, to_update, to_delete
+
+
+def sync_flow(slug, fields, records, key_field='id_field', delete=True):
+    # Makes entries of the flow equal to records, only changed ones are sent
+    # to Moltin, so the repeated sync costs a few list requests. Returns the
+    # stats and entries of the flow after the sync, or None if some of
+    # requests failed.
+    started_at = time.perf_counter()
+    records = {normalize(record[key_field], fields[key_field]): record for record in records}
+    with ThreadPoolExecutor(SYNC_THREADS) as pool:
+        flow = ensure_flow(slug)
+        created_fields = ensure_fields(pool, flow, fields)
+        entries = get_all_entries(pool, slug)
+        to_create, to_update, to_delete = diff_entries(records, entries, fields, key_field)
+        if not delete:
+            to_delete = []
+        futures = {}
+        for record in to_create:
+            futures[pool.submit(rate_limited, create_entry, slug, record)] = 'created'
+        for entry_id, record in to_update:
+            futures[pool.submit(rate_limited, update_entry, slug, entry_id, record)] = 'updated'
+        for entry_id in to_delete:
+            futures[pool.submit(rate_limited, delete_entry, slug, entry_id)] = 'deleted'
+
+        stats = {'fields_created': len(created_fields), 'created': 0, 'updated': 0,
+                 'deleted': 0, 'unchanged': len(records) - len(to_create) - len(to_update),
+                 'failed': 0}
+        changed = {}
+        deleted = set()
+        for future in as_completed(futures):
+            action = futures[future]
+            try:
+                result = future.result()
+            except MoltinError as e:
+                stats['failed'] += 1
+                print(f'Flow "{slug}" sync error: {e.message}')
+                continue
+            stats[action] += 1
+            if action == 'deleted':
+                deleted.add(result)
+            else:
+                changed[result['id']] = result
+    stats['elapsed'] = round(time.perf_counter() - started_at, 2)
+    if stats['failed']:
+        return stats, None
+    entries = [changed.pop(entry['id'], entry) for entry in entries
+               if entry['id'] not in deleted]
+    return stats, entries + list(changed.values())
@@ -0,0 +1,132 @@
+import os
+import re
+import logging
+from abc import ABC, abstractmethod
+
+import requests
+from dotenv import load_dotenv
+from requests.exceptions import RequestException
+
+import metrics
+from cache import TieredCache
+
+
+load_dotenv()
+
+GEOCODER_URL = os.getenv('GEOCODER_URL', 'https://geocode-maps.yandex.ru/1.x/')
+GEOCODER_TIMEOUT = (3.05, 5)
+GEOCODING_TTL = 30 * 24 * 60 * 60
+# Not found may be a temporary miss of the geocoder, so it's asked again soon.
+GEOCODING_NOT_FOUND_TTL = 10 * 60
+GEOCODING_CACHE_SIZE = 4096
+# Coordinates are rounded to about 100 m cell for reverse geocoding cache.
+GRID_PRECISION = 3
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город', 'гор': 'город',
+    'ул': 'улица',
+    'пр': 'проспект', 'пр-т': 'проспект', 'просп': 'проспект',
+    'пер': 'переулок',
+    'б-р': 'бульвар', 'бул': 'бульвар',
+    'ш': 'шоссе',
+    'пл': 'площадь',
+    'наб': 'набережная',
+    'д': 'дом',
+    'к': 'корпус', 'корп': 'корпус',
+    'стр': 'строение',
+}
+
+geocoder = None
+geocoding_cache = TieredCache('geocoding', ttl=GEOCODING_TTL,
+                              maxsize=GEOCODING_CACHE_SIZE,
+                              empty_ttl=GEOCODING_NOT_FOUND_TTL)
+
+
+class GeocoderError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class Geocoder(ABC):
+    # Interface of geocoders, implementations return None if nothing found.
+    @abstractmethod
+    def coordinates(self, address):
+        # Returns latitude and longitude of the address.
+        pass
+
+    @abstractmethod
+    def address(self, latitude, longitude):
+        # Returns address text of the point.
+        pass
+
+
+class YandexGeocoder(Geocoder):
+    def __init__(self, url=GEOCODER_URL, apikey=None, timeout=GEOCODER_TIMEOUT):
+        self.url = url
+        self.apikey = apikey or os.getenv('YANDEX_GEOCODER_APIKEY')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, geocode):
+        params = {'format': 'json', 'geocode': geocode, 'results': 1,
+                  'lang': 'ru_RU'}
+        if self.apikey:
+            params['apikey'] = self.apikey
+        try:
+            resp = self.session.get(self.url, params=params, timeout=self.timeout)
+            resp.raise_for_status()
+            members = resp.json()['response']['GeoObjectCollection']['featureMember']
+        except (RequestException, ValueError, KeyError) as e:
+            metrics.inc('geocoder_errors_total')
+            raise GeocoderError(f'Geocoder returns error: {e}')
+        if not members:
+            return
+        return members[0]['GeoObject']
+
+    @metrics.timed('geocoder_request_seconds', function='coordinates')
+    def coordinates(self, address):
+        geo_object = self.request(address)
+        if geo_object is None:
+            return
+        longitude, latitude = geo_object['Point']['pos'].split()
+        return float(latitude), float(longitude)
+
+    @metrics.timed('geocoder_request_seconds', function='address')
+    def address(self, latitude, longitude):
+        geo_object = self.request(f'{longitude},{latitude}')
+        if geo_object is None:
+            return
+        return geo_object['metaDataProperty']['GeocoderMetaData']['text']
+
+
+def get_geocoder():
+    global geocoder
+    if geocoder is None:
+        geocoder = YandexGeocoder()
+    return geocoder
+
+
+def set_geocoder(new_geocoder):
+    global geocoder
+    geocoder = new_geocoder
+
+
+def normalize_address(address):
+    # "Москва,  ул. Тверская д.7" and "москва улица тверская дом 7" give one key.
+    words = re.findall(r'[\w-]+', address.lower().replace('ё', 'е'))
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def get_coordinates(address):
+    # Returns latitude and longitude or None if address isn't found.
+    key = f'address:{normalize_address(address)}'
+    coordinates = geocoding_cache.get(key, lambda: get_geocoder().coordinates(address))
+    if coordinates is None:
+        return
+    return tuple(coordinates)
+
+
+def get_address_by_coordinates(latitude, longitude):
+    latitude = round(latitude, GRID_PRECISION)
+    longitude = round(longitude, GRID_PRECISION)
+    key = f'point:{latitude}:{longitude}'
+    return geocoding_cache.get(key, lambda: get_geocoder().address(latitude, longitude))
@@ -0,0 +1,83 @@
+import os
+import hashlib
+
+import requests
+from PIL import Image
+
+
+IMAGES_DIR = 'images'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = (3.05, 30)
+# Widths of Telegram thumbnail and full product card, height keeps aspect.
+IMAGE_WIDTHS = {'thumb': 320, 'card': 800}
+IMAGE_FORMATS = {
+    'jpg': ('JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+DONE_MARKER = 'done'
+
+
+def get_url_hash(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+
+
+def get_image_dir(url):
+    return os.path.join(IMAGES_DIR, get_url_hash(url))
+
+
+def get_variant_path(image_dir, size, extension):
+    return os.path.join(image_dir, f'{size}.{extension}')
+
+
+def download_image(url, path):
+    # Image is streamed to disk by chunks, not kept in memory.
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as resp:
+        resp.raise_for_status()
+        with open(f'{path}.tmp', 'wb') as file:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                file.write(chunk)
+    os.replace(f'{path}.tmp', path)
+    return path
+
+
+def get_size(width, height, new_width):
+    new_width = min(new_width, width)
+    return new_width, max(1, round(height * new_width / width))
+
+
+def process_image(source_path, image_dir, widths=IMAGE_WIDTHS, formats=IMAGE_FORMATS):
+    # Decodes the source once and writes every size in every format.
+    # For JPEG draft() lets the decoder downscale by 1/2, 1/4 or 1/8 at once,
+    # so large photos are never decoded in full resolution.
+    paths = {}
+    with Image.open(source_path) as img:
+        largest_size = get_size(*img.size, max(widths.values()))
+        img.draft('RGB', largest_size)
+        img = img.convert('RGB')
+        for size, width in sorted(widths.items(), key=lambda item: -item[1]):
+            resized = img.resize(get_size(*img.size, width), Image.LANCZOS)
+            for extension, (image_format, options) in formats.items():
+                path = get_variant_path(image_dir, size, extension)
+                resized.save(path, image_format, **options)
+                paths[f'{size}.{extension}'] = path
+    with open(os.path.join(image_dir, DONE_MARKER), 'w') as file:
+        file.write(source_path)
+    return paths
+
+
+def is_processed(url):
+    return os.path.exists(os.path.join(get_image_dir(url), DONE_MARKER))
+
+
+def get_image_paths(url):
+    image_dir = get_image_dir(url)
+    return {f'{size}.{extension}': get_variant_path(image_dir, size, extension)
+            for size in IMAGE_WIDTHS for extension in IMAGE_FORMATS}
+
+
+def fetch_image(url):
+    # Downloads the source of not processed image, returns its path.
+    image_dir = get_image_dir(url)
+    os.makedirs(image_dir, exist_ok=True)
+    return download_image(url, os.path.join(image_dir, 'source'))
+
@@ -1,14 +1,12 @@
 import os
-import re
-from collections import OrderedDict
 
 import requests
 from requests.exceptions import HTTPError, ConnectionError
 from dotenv import load_dotenv
 
-from moltin import (check_resp_json, get_headers, MoltinError, MOLTIN_API_URL,
-                    MOLTIN_API_OAUTH_URL, MOLTIN_ERR_MSG, MOLTIN_FLOW_ADDRESSES,
-                    create_flow, create_fields)
+from flows import sync_flow
+from moltin import MoltinError, MOLTIN_FLOW_ADDRESSES
+from shops import addresses_replica, get_shop_index
 
 
 FLOW_ADDRESSES_FIELDS = {
@@ -17,55 +15,59 @@ FLOW_ADDRESSES_FIELDS = {
     'alias': 'string',
     'latitude': 'float',
     'longitude': 'float',
-    'courier_telegram_id': 'string'
+    'courier_telegram_id': 'string',
+    'delivery_radius': 'float'
 }
 
 
-@get_headers
-def import_addresses(headers, url):
+def get_address_record(address):
+    # Courier isn't in the source, it's set in Moltin and kept by the import.
+    # So is delivery radius if the source doesn't have it.
+    record = {
+        'id_field': str(address['id']),
+        'address': address['address']['full'],
+        'alias': address['alias'],
+        'latitude': float(address['coordinates']['lat']),
+        'longitude': float(address['coordinates']['lon']),
+    }
+    if address.get('delivery_radius') is not None:
+        record['delivery_radius'] = float(address['delivery_radius'])
+    return record
+
+
+def sync_addresses(addresses, delete=True):
+    # Creates, updates and deletes only changed pizzerias, then replaces the
+    # replica and rebuilds the nearest shop index of all processes. Replica is
+    # reloaded from Moltin if some of requests failed.
+    stats, entries = sync_flow(MOLTIN_FLOW_ADDRESSES, FLOW_ADDRESSES_FIELDS,
+                               [get_address_record(address) for address in addresses],
+                               delete=delete)
+    if stats['created'] or stats['updated'] or stats['deleted'] or entries is None:
+        addresses_replica.replace(entries)
+    shop_index = get_shop_index()
+    print(f"Addresses: {stats['created']} created, {stats['updated']} updated, "
+          f"{stats['deleted']} deleted, {stats['unchanged']} unchanged, "
+          f"{stats['failed']} failed in {stats['elapsed']} s. "
+          f"Shop index has {len(shop_index.shops)} shops.")
+    if stats['failed']:
+        print('Run the import again to retry failed addresses.')
+    return stats
+
+
+def import_addresses(url):
     try:
         response = requests.get(url)
+        response.raise_for_status()
         addresses = response.json()
     except (HTTPError, ConnectionError) as e:
-        raise DvmnError(f'{DVMN_ERR_MSG} {e}')
+        print(f'Import addresses error: {e}')
+        return
     try:
-        for address in addresses:
-            data = {
-                'data': {
-                    'type': 'entry',
-                    'id_field': address['id'],
-                    'address': address['address']['full'],
-                    'alias': address['alias'],
-                    'latitude': address['coordinates']['lat'],
-                    'longitude': address['coordinates']['lon'],
-                }
-            }
-            resp = requests.post(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_ADDRESSES}/entries', headers=headers, json=data)
-            resp.raise_for_status()
-            check_resp_json(resp)
-            moltin_enrty = resp.json()['data']
-            print('Address "{}" exported successfully.'.format(moltin_enrty['alias']))
-    except HTTPError as e:
-        raise MoltinError(f'{MOLTIN_ERR_MSG} {e}')
+        return sync_addresses(addresses)
+    except MoltinError as e:
+        print(f'Import addresses error: {e.message}')
 
 
 if __name__ == '__main__':
     load_dotenv()
-    moltin_client_id = os.environ.get('MOLTIN_CLIENT_ID')
-    moltin_client_secret = os.environ.get('MOLTIN_CLIENT_SECRET')
-    headers = get_headers(moltin_client_id, moltin_client_secret)
-
-    # Create flow
-    moltin_flow_create = create_flow(MOLTIN_FLOW_ADDRESSES)
-    print('Flow "{}" created'.format(moltin_flow_create['data']['name']))
-
-    # Create fields
-    moltin_create_fields = create_fields(
-                                os.environ.get('MOLTIN_FLOW_ADDRESSES_ID'),
-                                FLOW_ADDRESSES_FIELDS
-                            )
-    print(moltin_create_fields)
-
-    # Export addresses
-    moltin_addresses = import_addresses(os.environ.get('URL_ADDRESSES'))
-    print(moltin_addresses)
+    import_addresses(os.environ.get('URL_ADDRESSES'))
@@ -1,14 +1,22 @@
 import os
 import re
-from collections import OrderedDict
+import json
+import time
+import hashlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threading import Lock
 
 import requests
 from requests.exceptions import HTTPError, ConnectionError
 from dotenv import load_dotenv
-from PIL import Image
 
+from catalog import invalidate_catalog
+from images import fetch_image, get_image_dir, get_image_paths, is_processed, process_image
 from moltin import (check_resp_json, get_headers, MoltinError, MOLTIN_API_URL,
-                    MOLTIN_API_OAUTH_URL, MOLTIN_ERR_MSG, MOLTIN_API_FLOW_SLUG)
+                    MOLTIN_API_OAUTH_URL, MOLTIN_ERR_MSG, session)
+from photos import invalidate_file_id
+from ratelimit import rate_limited
 
 
 SLUG_TRANS_MAP = {
@@ -23,8 +31,9 @@ FOOD_VALUE_MAP = {
     'carbohydrates': 'углеводы',
     'kiloCalories': 'калорийность',
     'weight': 'вес'}
-IMAGES_DIR = 'images'
-WIDTH_SMALL = 400
+MANIFEST_FILE = 'menu_manifest.json'
+IMPORT_THREADS = 8
+RESIZE_PROCESSES = os.cpu_count()
 
 
 def get_slug(name):
@@ -38,17 +47,18 @@ def get_slug(name):
 
 @get_headers
 def create_file(headers, file):
-    files = {
-        'file': open(file, 'rb'),
-        'public': True
-    }
-    try:
-        resp = requests.post(f'{MOLTIN_API_URL}/files', headers=headers, files=files)
-        resp.raise_for_status()
-        check_resp_json(resp)
-        return resp.json()
-    except HTTPError as e:
-        raise MoltinError(f'{MOLTIN_ERR_MSG} {e}')
+    with open(file, 'rb') as upload:
+        files = {
+            'file': upload,
+            'public': True
+        }
+        try:
+            resp = session.post(f'{MOLTIN_API_URL}/files', headers=headers, files=files)
+            resp.raise_for_status()
+            check_resp_json(resp)
+            return resp.json()
+        except HTTPError as e:
+            raise MoltinError(f'{MOLTIN_ERR_MSG} {e}')
 
 
 @get_headers
@@ -59,7 +69,7 @@ def create_relationship(headers, product_id, img_id):
             'id': img_id
         }
     }
-    resp = requests.post(f'{MOLTIN_API_URL}/products/{product_id}/relationships/main-image', headers=headers, json=data)
+    resp = session.post(f'{MOLTIN_API_URL}/products/{product_id}/relationships/main-image', headers=headers, json=data)
     resp.raise_for_status()
     check_resp_json(resp)
     return resp.json()
@@ -80,47 +90,162 @@ def create_product(headers, name, slug, sku, description, price):
             'commodity_type': 'physical'
         }
     }
-    resp = requests.post(f'{MOLTIN_API_URL}/products', headers=headers, json=data)
+    resp = session.post(f'{MOLTIN_API_URL}/products', headers=headers, json=data)
     resp.raise_for_status()
     check_resp_json(resp)
     return resp.json()
 
 
-def resize_image(slug):
-    img = Image.open(f'{IMAGES_DIR}/{slug}.jpg')
-    width, height = img.size
-    img_res = img.resize((WIDTH_SMALL, WIDTH_SMALL* round(height / width)))
-    filename_new = f'{slug}_small.jpg'
-    img_res.save(f'{IMAGES_DIR}/{filename_new}', 'JPEG')
-    return filename_new
+@get_headers
+def update_product(headers, product_id, name, slug, sku, description, price):
+    data = {
+        'data': {
+            'id': product_id,
+            'type': 'product',
+            'name': name,
+            'slug': slug,
+            'sku': sku,
+            'description': description,
+            'price': [{'amount': price, 'currency': 'RUB', 'includes_tax': True}],
+        }
+    }
+    resp = session.put(f'{MOLTIN_API_URL}/products/{product_id}', headers=headers, json=data)
+    resp.raise_for_status()
+    check_resp_json(resp)
+    return resp.json()
 
 
-def import_menu(url):
+class Manifest:
+    # Import checkpoint: content hashes and Moltin ids of every pizza,
+    # saved after each stage, so the next run skips unchanged pizzas and
+    # resumes interrupted ones instead of creating duplicates.
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.lock = Lock()
+        try:
+            with open(path) as file:
+                self.pizzas = json.load(file)
+        except FileNotFoundError:
+            self.pizzas = {}
+
+    def get(self, pizza_id):
+        with self.lock:
+            return dict(self.pizzas.get(pizza_id, {}))
+
+    def update(self, pizza_id, **fields):
+        with self.lock:
+            self.pizzas.setdefault(pizza_id, {}).update(fields)
+            with open(f'{self.path}.tmp', 'w') as file:
+                json.dump(self.pizzas, file, ensure_ascii=False, indent=2)
+            os.replace(f'{self.path}.tmp', self.path)
+
+
+class StageTimer:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.lock = Lock()
+
+    def measure(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        with self.lock:
+            self.timings[stage].append(time.perf_counter() - start)
+        return result
+
+    def report(self, imported, elapsed):
+        for stage, timings in self.timings.items():
+            print(f'{stage:>14}: {len(timings)} done, {sum(timings):.2f} s total, '
+                  f'{sum(timings) / len(timings):.3f} s avg')
+        print(f'Imported {imported} pizzas in {elapsed:.2f} s, '
+              f'{imported / elapsed if elapsed else 0:.2f} pizzas/s')
+
+
+def get_hash(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def prepare_image(url, timer, resize_pool):
+    # Image of the same URL is downloaded and processed only once.
+    if is_processed(url):
+        return get_image_paths(url)
+    source_path = timer.measure('download', fetch_image, url)
+    return timer.measure('resize', lambda: resize_pool.submit(
+        process_image, source_path, get_image_dir(url)).result())
+
+
+def import_pizza(pizza, manifest, timer, resize_pool):
+    id = str(pizza['id'])
+    slug = get_slug(pizza['name'])
+    sku = f'{slug}{id}'
+    food_value = OrderedDict(pizza['food_value']).items()
+    food_value = ', '.join(f'{FOOD_VALUE_MAP[key]}: {amount}' for key, amount in food_value)
+    description = '{}\n\n{}'.format(pizza['description'], food_value)
+    product_hash = get_hash([pizza['name'], description, pizza['price']])
+    image_url = pizza['product_image']['url']
+    state = manifest.get(id)
+    if state.get('done') and state.get('product_hash') == product_hash \
+            and state.get('image_url') == image_url:
+        return False
+
+    product_args = (pizza['name'], slug, sku, description, pizza['price'])
+    if 'product_id' not in state:
+        moltin_product = timer.measure('product', rate_limited, create_product, *product_args)
+        manifest.update(id, product_id=moltin_product['data']['id'], product_hash=product_hash)
+    elif state.get('product_hash') != product_hash:
+        timer.measure('product', rate_limited, update_product, state['product_id'], *product_args)
+        manifest.update(id, product_hash=product_hash)
+    state = manifest.get(id)
+
+    if state.get('image_url') != image_url or 'file_id' not in state:
+        image_paths = prepare_image(image_url, timer, resize_pool)
+        moltin_file = timer.measure('upload', rate_limited, create_file, image_paths['card.jpg'])
+        manifest.update(id, file_id=moltin_file['data']['id'], image_url=image_url,
+                        relationship_file_id=None)
+        state = manifest.get(id)
+
+    if state.get('relationship_file_id') != state['file_id']:
+        timer.measure('relationship', rate_limited, create_relationship,
+                      state['product_id'], state['file_id'])
+        manifest.update(id, relationship_file_id=state['file_id'])
+        invalidate_file_id(state['product_id'])
+    manifest.update(id, done=True)
+    print('"{}" pizza exported successfully.'.format(pizza['name']))
+    return True
+
+
+def import_menu(url, manifest_path=MANIFEST_FILE):
+    # Pizzas are imported concurrently: network stages run in a thread pool
+    # limited by Moltin rate, images are resized in a process pool.
     try:
         response = requests.get(url)
         menu = response.json()
     except (HTTPError, ConnectionError) as e:
         print(f'Import menu error: {e}')
-    for pizza in menu[1:]:
-        id = pizza['id']
-        slug = get_slug(pizza['name'])
-        sku = f'{slug}{id}'
-        food_value = OrderedDict(pizza['food_value']).items()
-        food_value = ', '.join(f'{FOOD_VALUE_MAP[key]}: {amount}' for key, amount in food_value)
-        description = '{}\n\n{}'.format(pizza['description'], food_value)
-        moltin_product = create_product(pizza['name'], slug, sku, description, pizza['price'])
-        resp = requests.get(pizza['product_image']['url'])
-        with open(f'{IMAGES_DIR}/{slug}.jpg', 'wb') as file:
-            file.write(resp.content)
-        filename_new = resize_image(slug)
-        moltin_file = create_file(f'{IMAGES_DIR}/{filename_new}')
-        moltin_relationship = create_relationship(moltin_product['data']['id'], moltin_file['data']['id'])
-        print('"{}" pizza exported successfully.'.format(pizza['name']))
+        return
+    manifest = Manifest(manifest_path)
+    timer = StageTimer()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(RESIZE_PROCESSES) as resize_pool, \
+            ThreadPoolExecutor(IMPORT_THREADS) as import_pool:
+        futures = [import_pool.submit(import_pizza, pizza, manifest, timer, resize_pool)
+                   for pizza in menu[1:]]
+        imported, failed = 0, 0
+        for future in futures:
+            # Timeouts and broken images fail only their pizza, Pillow
+            # raises OSError if the image can't be read.
+            try:
+                imported += future.result()
+            except (requests.RequestException, OSError, MoltinError) as e:
+                failed += 1
+                print(f'Import menu error: {e}')
+    timer.report(imported, time.perf_counter() - start)
+    print(f'{len(futures) - imported - failed} unchanged, {failed} failed.')
+    if failed:
+        print('Run the import again to resume failed pizzas.')
+    if imported:
+        invalidate_catalog()
 
 
 if __name__ == '__main__':
     load_dotenv()
-    moltin_client_id = os.environ.get('MOLTIN_CLIENT_ID')
-    moltin_client_secret = os.environ.get('MOLTIN_CLIENT_SECRET')
-    headers = get_headers(moltin_client_id, moltin_client_secret)
     import_menu(os.environ.get('URL_MENU'))
@@ -0,0 +1,241 @@
+import os
+import json
+import math
+import time
+import zlib
+import socket
+import logging
+from threading import Lock, Thread
+
+import redis
+from telegram import Update
+
+import tracing
+from db import get_database_connection
+from scheduler import UpdateScheduler, get_update_chat_id, get_update_key
+
+
+STREAM_PARTITIONS = int(os.getenv('STREAM_PARTITIONS', 16))
+STREAM_KEY = 'updates:{}'
+STREAM_GROUP = 'bot'
+STREAM_MAX_BACKLOG = 1000
+SEEN_KEY = 'updates:seen:{}'
+SEEN_TTL = 24 * 60 * 60
+LEASE_KEY = 'updates:lease:{}'
+LEASE_TIME = 30
+CONSUMERS_KEY = 'updates:consumers'
+READ_COUNT = 50
+READ_BLOCK = 1000
+SCHEDULER_MAX_BACKLOG = 500
+
+# Adds update to the stream of its chat once per update_id, refuses it if
+# consumers are behind.
+INGEST_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+if redis.call('XLEN', KEYS[2]) >= tonumber(ARGV[2]) then
+    return -1
+end
+redis.call('SET', KEYS[1], 1, 'EX', ARGV[1])
+redis.call('XADD', KEYS[2], '*', 'update', ARGV[3], 'trace_id', ARGV[4],
+           'received_at', ARGV[5])
+return 1
+'''
+
+RENEW_LEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+RELEASE_LEASE_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+
+def get_partition(chat_id, partitions=STREAM_PARTITIONS):
+    return zlib.crc32(str(chat_id).encode('utf-8')) % partitions
+
+
+def ingest_update(update_json, chat_id, trace_id='', received_at=None):
+    # Returns 'queued', 'duplicate' or 'overloaded', Redis errors are raised.
+    result = get_database_connection().eval(
+        INGEST_SCRIPT, 2, SEEN_KEY.format(update_json['update_id']),
+        STREAM_KEY.format(get_partition(chat_id)), SEEN_TTL, STREAM_MAX_BACKLOG,
+        json.dumps(update_json), trace_id, repr(received_at or time.time()))
+    return {1: 'queued', 0: 'duplicate', -1: 'overloaded'}[result]
+
+
+class StreamConsumer:
+    # Every partition of the updates is read by one process at a time, the
+    # process which holds its lease, so all updates of a chat are handled in
+    # one place and in order. Partitions are shared equally between alive
+    # consumers, partition of a died one is taken over when its lease ends.
+    def __init__(self, process_update, bot, partitions=STREAM_PARTITIONS, name=None):
+        self.process_update = process_update
+        self.bot = bot
+        self.partitions = partitions
+        self.name = name or f'{socket.gethostname()}:{os.getpid()}'
+        self.owned = set()
+        self.releasing = set()
+        self.in_flight = {}
+        self.lock = Lock()
+        self.scheduler = UpdateScheduler(self.process)
+        self.stats = {'read': 0, 'recovered': 0, 'acked': 0}
+
+    def start(self):
+        self.scheduler.start()
+        Thread(target=self.run, name='stream_consumer', daemon=True).start()
+        return self
+
+    def create_groups(self, database):
+        for partition in range(self.partitions):
+            try:
+                database.xgroup_create(STREAM_KEY.format(partition), STREAM_GROUP,
+                                       id='0', mkstream=True)
+            except redis.exceptions.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+
+    def balance(self, database):
+        now = time.time()
+        database.zadd(CONSUMERS_KEY, {self.name: now})
+        database.zremrangebyscore(CONSUMERS_KEY, '-inf', now - LEASE_TIME)
+        target = math.ceil(self.partitions / max(database.zcard(CONSUMERS_KEY), 1))
+        for partition in self.owned | self.releasing:
+            if not database.eval(RENEW_LEASE_SCRIPT, 1, LEASE_KEY.format(partition),
+                                 self.name, LEASE_TIME):
+                logging.warning(f'Lease of updates partition {partition} is lost')
+                self.owned.discard(partition)
+                self.releasing.discard(partition)
+        # Extra partition isn't read anymore, but its lease is kept until
+        # updates already read from it are handled.
+        while len(self.owned) > target:
+            self.releasing.add(self.owned.pop())
+        for partition in list(self.releasing):
+            with self.lock:
+                in_flight = self.in_flight.get(STREAM_KEY.format(partition), 0)
+            if not in_flight:
+                database.eval(RELEASE_LEASE_SCRIPT, 1, LEASE_KEY.format(partition), self.name)
+                self.releasing.discard(partition)
+        for partition in range(self.partitions):
+            if len(self.owned) >= target:
+                break
+            if partition in self.owned or partition in self.releasing:
+                continue
+            if database.set(LEASE_KEY.format(partition), self.name, nx=True, ex=LEASE_TIME):
+                self.owned.add(partition)
+        for partition in self.owned:
+            self.recover(database, partition)
+
+    def recover(self, database, partition):
+        # Updates read by other consumers long ago were lost with them.
+        stream = STREAM_KEY.format(partition)
+        pending = database.xpending_range(stream, STREAM_GROUP, '-', '+', READ_COUNT)
+        entry_ids = [entry['message_id'] for entry in pending
+                     if entry['consumer'].decode('utf-8') != self.name
+                     and entry['time_since_delivered'] >= LEASE_TIME * 1000]
+        if not entry_ids:
+            return
+        entries = database.xclaim(stream, STREAM_GROUP, self.name,
+                                  LEASE_TIME * 1000, entry_ids)
+        with self.lock:
+            self.stats['recovered'] += len(entries)
+        for entry_id, fields in entries:
+            self.submit(stream, entry_id, fields)
+
+    def read(self, database):
+        backlog = self.scheduler.get_stats()['queue_depth']
+        if not self.owned or backlog >= SCHEDULER_MAX_BACKLOG:
+            time.sleep(READ_BLOCK / 1000)
+            return
+        streams = {STREAM_KEY.format(partition): '>' for partition in self.owned}
+        count = min(READ_COUNT, SCHEDULER_MAX_BACKLOG - backlog)
+        for stream, entries in database.xreadgroup(STREAM_GROUP, self.name, streams,
+                                                   count=count, block=READ_BLOCK):
+            stream = stream.decode('utf-8')
+            with self.lock:
+                self.stats['read'] += len(entries)
+            for entry_id, fields in entries:
+                self.submit(stream, entry_id, fields)
+
+    def submit(self, stream, entry_id, fields):
+        # Duplicate clicks and updates over the chat queue limit aren't handled.
+        with self.lock:
+            self.in_flight[stream] = self.in_flight.get(stream, 0) + 1
+        try:
+            update = Update.de_json(json.loads(fields[b'update']), self.bot)
+        except (KeyError, ValueError) as e:
+            logging.error(f'Bad update {entry_id} in {stream}: {e}')
+            self.ack(stream, entry_id)
+            return
+        trace = None
+        if fields.get(b'trace_id'):
+            trace = tracing.start_trace(fields[b'trace_id'].decode('utf-8'),
+                                        float(fields[b'received_at']))
+            trace.attributes['update_id'] = update.update_id
+        if not self.scheduler.submit(get_update_chat_id(update),
+                                     (stream, entry_id, update, trace), get_update_key(update)):
+            self.ack(stream, entry_id)
+
+    def process(self, item):
+        stream, entry_id, update, trace = item
+        if trace is None:
+            try:
+                self.process_update(update)
+            finally:
+                self.ack(stream, entry_id)
+            return
+        # Queue wait is the time from the webhook to this worker.
+        with tracing.attach(trace):
+            tracing.add_span('queue wait', trace.started_at, time.time() - trace.started_at)
+            try:
+                with tracing.span('process_update'):
+                    self.process_update(update)
+            finally:
+                self.ack(stream, entry_id)
+        trace.release()
+
+    def ack(self, stream, entry_id):
+        # Not acked update is handled again by the next owner of the stream.
+        with self.lock:
+            self.in_flight[stream] -= 1
+        try:
+            with get_database_connection().pipeline() as pipe:
+                pipe.xack(stream, STREAM_GROUP, entry_id)
+                pipe.xdel(stream, entry_id)
+                pipe.execute()
+            with self.lock:
+                self.stats['acked'] += 1
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Update {entry_id} is not acked: {e}')
+
+    def run(self):
+        database = get_database_connection()
+        groups_created = False
+        balanced_at = 0
+        while True:
+            try:
+                if not groups_created:
+                    self.create_groups(database)
+                    groups_created = True
+                if time.monotonic() - balanced_at > LEASE_TIME / 3:
+                    self.balance(database)
+                    balanced_at = time.monotonic()
+                self.read(database)
+            except redis.exceptions.RedisError as e:
+                logging.error(f'Stream consumer: {e}')
+                time.sleep(READ_BLOCK / 1000)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['in_flight'] = sum(self.in_flight.values())
+        stats.update({'name': self.name, 'partitions': sorted(self.owned),
+                      'releasing': sorted(self.releasing)})
+        return stats
@@ -0,0 +1,188 @@
+import json
+import time
+import uuid
+import logging
+from threading import Thread
+
+import redis
+
+from db import get_database_connection
+
+
+JOBS_DUE_KEY = 'jobs:due'
+JOBS_DATA_KEY = 'jobs:data'
+JOBS_DEAD_KEY = 'jobs:dead'
+JOB_DONE_KEY = 'jobs:done:{}'
+JOB_DONE_TTL = 24 * 60 * 60
+JOB_STEPS_KEY = 'jobs:steps:{}'
+# Handlers wait for the outbox up to a minute per message, the lease is
+# longer and starts when the job starts.
+JOB_LEASE_TIME = 5 * 60
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF = 10
+JOBS_POLL_INTERVAL = 1
+JOBS_BATCH_SIZE = 20
+
+# Adds the job unless it's already scheduled or done, so the same
+# idempotency key fires once.
+SCHEDULE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+if redis.call('ZADD', KEYS[1], 'NX', ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[3])
+return 1
+'''
+
+# Takes due jobs and moves them to the end of the lease, so other workers
+# don't see them. Job of a died worker is due again when its lease ends.
+CLAIM_SCRIPT = '''
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, job_id in ipairs(job_ids) do
+    redis.call('ZADD', KEYS[1], ARGV[2], job_id)
+end
+return job_ids
+'''
+
+# Leases the job again when it starts, so jobs waiting for their turn in the
+# batch don't run out of time. Job taken by another worker isn't started.
+RENEW_SCRIPT = '''
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+'''
+
+# Finishes the job only if the lease is still ours.
+ACK_SCRIPT = '''
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[3], 1, 'EX', ARGV[3])
+return 1
+'''
+
+# Moves the job to a later time if the lease is still ours.
+RETRY_SCRIPT = '''
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[4])
+return 1
+'''
+
+
+def format_score(timestamp):
+    # Scores are integer milliseconds, so Lua compares them as equal strings.
+    return str(round(timestamp * 1000))
+
+
+class JobScheduler:
+    # Delayed jobs in Redis sorted set of due times. Jobs are delivered at
+    # least once: a job is removed only after its handler has finished, so
+    # handlers get job_id and should be idempotent.
+    def __init__(self, clock=time.time, lease_time=JOB_LEASE_TIME):
+        self.clock = clock
+        self.lease_time = lease_time
+        self.handlers = {}
+
+    def handler(self, name):
+        def register(function):
+            self.handlers[name] = function
+            return function
+        return register
+
+    def schedule(self, job_name, delay=0, job_id=None, **kwargs):
+        # Returns False if the job with this idempotency key already exists.
+        job_id = job_id or f'{job_name}:{uuid.uuid4().hex}'
+        job = json.dumps({'name': job_name, 'kwargs': kwargs, 'attempts': 0})
+        return bool(get_database_connection().eval(
+            SCHEDULE_SCRIPT, 3, JOBS_DUE_KEY, JOBS_DATA_KEY, JOB_DONE_KEY.format(job_id),
+            format_score(self.clock() + delay), job_id, job))
+
+    def is_step_done(self, job_id, step):
+        # Steps of a job with several sends, retry goes on from the failed one.
+        return bool(get_database_connection().sismember(JOB_STEPS_KEY.format(job_id), step))
+
+    def mark_step_done(self, job_id, step):
+        with get_database_connection().pipeline() as pipe:
+            pipe.sadd(JOB_STEPS_KEY.format(job_id), step)
+            pipe.expire(JOB_STEPS_KEY.format(job_id), JOB_DONE_TTL)
+            pipe.execute()
+
+    def claim(self, database, batch_size):
+        lease_until = format_score(self.clock() + self.lease_time)
+        job_ids = database.eval(CLAIM_SCRIPT, 1, JOBS_DUE_KEY, format_score(self.clock()),
+                                lease_until, batch_size)
+        return [job_id.decode('utf-8') for job_id in job_ids], lease_until
+
+    def run_job(self, database, bot, job_id, claimed_until):
+        lease_until = format_score(self.clock() + self.lease_time)
+        if not database.eval(RENEW_SCRIPT, 1, JOBS_DUE_KEY, job_id, claimed_until, lease_until):
+            logging.warning(f'Lease of job {job_id} ended before it was started')
+            return
+        job = database.hget(JOBS_DATA_KEY, job_id)
+        if job is None:
+            database.zrem(JOBS_DUE_KEY, job_id)
+            return
+        job = json.loads(job)
+        try:
+            self.handlers[job['name']](bot, job_id, **job['kwargs'])
+        except Exception as e:
+            job['attempts'] += 1
+            if job['attempts'] >= JOB_MAX_ATTEMPTS:
+                logging.critical(f'Job {job_id} failed {job["attempts"]} times: {e}')
+                database.hset(JOBS_DEAD_KEY, job_id, json.dumps(job))
+                database.eval(ACK_SCRIPT, 3, JOBS_DUE_KEY, JOBS_DATA_KEY,
+                              JOB_DONE_KEY.format(job_id), job_id, lease_until, JOB_DONE_TTL)
+                return
+            logging.error(f'Job {job_id} failed, will retry: {e}')
+            retry_at = self.clock() + JOB_RETRY_BACKOFF * 2 ** job['attempts']
+            database.eval(RETRY_SCRIPT, 2, JOBS_DUE_KEY, JOBS_DATA_KEY, job_id,
+                          lease_until, format_score(retry_at), json.dumps(job))
+            return
+        if not database.eval(ACK_SCRIPT, 3, JOBS_DUE_KEY, JOBS_DATA_KEY,
+                             JOB_DONE_KEY.format(job_id), job_id, lease_until, JOB_DONE_TTL):
+            logging.warning(f'Lease of job {job_id} ended before it was done')
+
+    def run_due(self, bot, batch_size=JOBS_BATCH_SIZE):
+        # Runs a batch of due jobs, returns how many of them were taken.
+        database = get_database_connection()
+        job_ids, lease_until = self.claim(database, batch_size)
+        for job_id in job_ids:
+            self.run_job(database, bot, job_id, lease_until)
+        return len(job_ids)
+
+    def run(self, bot):
+        while True:
+            try:
+                if not self.run_due(bot):
+                    time.sleep(JOBS_POLL_INTERVAL)
+            except redis.exceptions.RedisError as e:
+                logging.error(f'Job scheduler: {e}')
+                time.sleep(JOBS_POLL_INTERVAL)
+
+    def start(self, bot):
+        Thread(target=self.run, args=(bot,), name='job_scheduler', daemon=True).start()
+        return self
+
+    def get_stats(self):
+        database = get_database_connection()
+        now = self.clock()
+        with database.pipeline() as pipe:
+            pipe.zcard(JOBS_DUE_KEY)
+            pipe.zcount(JOBS_DUE_KEY, '-inf', format_score(now))
+            pipe.hlen(JOBS_DEAD_KEY)
+            pipe.zrange(JOBS_DUE_KEY, 0, 0, withscores=True)
+            scheduled, due, dead, first = pipe.execute()
+        return {'scheduled': scheduled, 'due': due, 'dead': dead,
+                'overdue': max(now - first[0][1] / 1000, 0) if first else 0}
+
+
+jobs = JobScheduler()
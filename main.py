@@ -7,10 +7,23 @@ from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import (Updater, Filters, Dispatcher,
                         CommandHandler, MessageHandler, CallbackQueryHandler,
                         PreCheckoutQueryHandler, ShippingQueryHandler)
-import yandex_geocoder
 
-from moltin import get_cart, get_customer, get_addresses, get_address, add_to_cart, delete_from_cart
-from telegram_displays import display_menu, display_description, display_cart, display_address
+from chat_sessions import (load_session, save_session, next_cart_version, start_order,
+                           finish_order)
+from geocoding import GeocoderError, get_coordinates, get_address_by_coordinates
+from carts import get_cart, add_to_cart, delete_from_cart, invalidate_cart
+from customers import get_profile, get_customer
+from dispatch import dispatch_order, complete_order
+import metrics
+import tracing
+from jobs import jobs
+from moltin import MoltinError, get_address
+from shops import get_shop
+from telegram_displays import (CountingBot, display_menu, display_description,
+                               display_cart, display_address, render,
+                               notify_courier, notify_courier_location,
+                               notify_courier_order, send_invoice, send_text)
+from templates import PAYMENT_MARKUP
 
 load_dotenv()
 
@@ -22,8 +35,6 @@ TELEGRAM_ERR_MSG = 'Telegram API returns error:'
 REMINDER_TIME = 60 * 60
 PAYMENT_PAYLOAD = os.getenv('PAYMENT_PAYLOAD')
 
-database = None
-
 
 def error_callback(bot, update, error):
     try:
@@ -32,16 +43,6 @@ def error_callback(bot, update, error):
         logging.critical(f'{TELEGRAM_ERR_MSG} {e}')
 
 
-def get_database_connection():
-    global database
-    if database is None:
-        db_pwd = os.getenv('REDIS_PWD')
-        db_host = os.getenv('REDIS_HOST')
-        db_port = os.getenv('REDIS_PORT')
-        database = redis.Redis(host=db_host, port=db_port, password=db_pwd)
-    return database
-
-
 def get_query_data(update):
     if update.message:
         query = update.message
@@ -54,118 +55,171 @@ def get_query_data(update):
         return
 
 
-def add_reminder(bot, job):
-    bot.send_message(text=f'*текст напоминания через {REMINDER_TIME} секунд*',
-                    chat_id=job.context)
+def is_photo_message(update):
+    # Photo messages can't be edited into text ones.
+    return bool(update.callback_query and update.callback_query.message.photo)
+
+
+def get_customer_location(chat_id, session):
+    # Location is saved by display_address, Moltin is asked only for
+    # sessions created before the customer profiles. Returns None if the
+    # customer is unknown, e.g. the session has expired.
+    profile = session if session.get('nearest_shop_id') else get_profile(chat_id)
+    if profile:
+        return (float(profile['latitude']), float(profile['longitude']),
+                profile['nearest_shop_id'])
+    if session.get('customer_id'):
+        return get_customer(session['customer_id'])
+
 
+def ask_location(bot, chat_id, message_id):
+    render(bot, chat_id, message_id, 'ОФОРМЛЕНИЕ ЗАКАЗА:\nДля доставки вашей пиццы'
+                                     ' отправьте нам геолокацию или адрес текстом.')
 
-def handle_start(bot, update, job_queue):
+
+@jobs.handler('courier_order')
+def run_courier_order(bot, job_id, courier_telegram_id, latitude, longitude, text):
+    # Retry of the job doesn't send the location again.
+    if not jobs.is_step_done(job_id, 'location'):
+        notify_courier_location(bot, courier_telegram_id, latitude, longitude, wait=True)
+        jobs.mark_step_done(job_id, 'location')
+    notify_courier_order(bot, courier_telegram_id, text, wait=True)
+
+
+@jobs.handler('delivery_reminder')
+def add_reminder(bot, job_id, chat_id, order_id=None):
+    # The order should be delivered by now, so its courier is free of it.
+    if order_id is not None:
+        complete_order(order_id)
+    send_text(bot, chat_id, f'*текст напоминания через {REMINDER_TIME} секунд*', wait=True)
+
+
+def schedule_delivery(bot, chat_id, order_id, courier_telegram_id, latitude, longitude, text):
+    # Jobs survive restarts and fire once per order, repeated clicks of the
+    # same checkout give the same order_id.
+    try:
+        jobs.schedule('courier_order', job_id=f'courier_order:{order_id}',
+                      courier_telegram_id=courier_telegram_id,
+                      latitude=latitude, longitude=longitude, text=text)
+        jobs.schedule('delivery_reminder', REMINDER_TIME, job_id=f'delivery_reminder:{order_id}',
+                      chat_id=chat_id, order_id=order_id)
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Delivery jobs are not scheduled: {e}')
+        notify_courier(bot, courier_telegram_id, latitude, longitude, text)
+
+
+def handle_start(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
-    display_menu(bot, chat_id)
-    if query_data != '/start':
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+    if query_data == '/start':
+        display_menu(bot, chat_id)
+    else:
+        display_menu(bot, chat_id, message_id, is_photo_message(update))
     return 'HANDLE_MENU'
 
 
-def handle_menu(bot, update, job_queue):
+def handle_menu(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
     if query_data == 'goto_cart':
-        cart, products, total = get_cart(chat_id)
-        display_cart(bot, cart, products, total, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        cart, products, total = get_cart(chat_id, session.get('cart_version'))
+        display_cart(bot, cart, products, total, chat_id, message_id, is_photo_message(update))
         return 'HANDLE_CART'
-    display_description(bot, query_data, chat_id)
-    bot.delete_message(chat_id=chat_id, message_id=message_id)
+    display_description(bot, query_data, chat_id, message_id, is_photo_message(update))
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(bot, update, job_queue):
+def handle_description(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
     if query_data == 'goto_menu':
-        display_menu(bot, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        display_menu(bot, chat_id, message_id, is_photo_message(update))
         return 'HANDLE_MENU'
     elif query_data == 'goto_cart':
-        cart, products, total = get_cart(chat_id)
-        display_cart(bot, cart, products, total, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        cart, products, total = get_cart(chat_id, session.get('cart_version'))
+        display_cart(bot, cart, products, total, chat_id, message_id, is_photo_message(update))
         return 'HANDLE_CART'
     else:
         product_id = query_data
-        cart, products, total = add_to_cart(chat_id, product_id)
-        display_cart(bot, cart, products, total, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        cart, products, total = add_to_cart(chat_id, product_id, next_cart_version(session))
+        display_cart(bot, cart, products, total, chat_id, message_id, is_photo_message(update))
         return 'HANDLE_CART'
 
 
-def handle_cart(bot, update, job_queue):
+def handle_cart(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
     if query_data == 'goto_menu':
-        display_menu(bot, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        display_menu(bot, chat_id, message_id)
         return 'HANDLE_MENU'
     elif query_data == 'goto_checkout_geo':
-        bot.send_message(text=f'ОФОРМЛЕНИЕ ЗАКАЗА:\nДля доставки вашей пиццы'
-                                ' отправьте нам геолокацию или адрес текстом.',
-                        chat_id=chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        start_order(session)
+        ask_location(bot, chat_id, message_id)
         return 'HANDLE_CHECKOUT_GEO'
     else:
-        delete_from_cart(chat_id, query_data)
-        cart, products, total = get_cart(chat_id)
-        display_cart(bot, cart, products, total, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        cart, products, total = delete_from_cart(chat_id, query_data, next_cart_version(session))
+        display_cart(bot, cart, products, total, chat_id, message_id)
         return 'HANDLE_CART'
 
 
-def handle_checkout_geo(bot, update, job_queue):
-    global database
+def handle_checkout_geo(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
+    latitude, longitude, address_customer = None, None, None
     try:
         if isinstance(query_data, str):
-            longitude, latitude = yandex_geocoder.Client.coordinates(query_data)
-            address_customer = query_data
+            coordinates = get_coordinates(query_data)
+            if coordinates:
+                latitude, longitude = coordinates
+                address_customer = query_data
         else:
             latitude, longitude = query_data.latitude, query_data.longitude
-            # TODO: add getting address by coordinates
+            address_customer = get_address_by_coordinates(latitude, longitude) or ''
+    except GeocoderError as e:
+        logging.error(e)
+        if not isinstance(query_data, str):
             address_customer = ''
-    except Exception as e:
-        latitude, longitude, address_customer = None, None, None
-    bot.delete_message(chat_id=chat_id, message_id=message_id - 1)
-    addresses = get_addresses()
-    if display_address(bot, chat_id, latitude, longitude, address_customer, addresses, database):
+    # The previous message is the bot's request of the address.
+    if display_address(bot, chat_id, latitude, longitude, address_customer, session,
+                       message_id - 1):
         return 'HANDLE_CHECKOUT_RECEIPT'
     else:
         return 'HANDLE_CHECKOUT_GEO'
 
 
-def handle_checkout_receipt(bot, update, job_queue):
-    global database
+def handle_checkout_receipt(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
-    cart, products, total = get_cart(chat_id)
-    customer_id = database.get(f'{chat_id}_id_customer').decode('utf-8')
-    latitude, longitude, nearest_shop_id = get_customer(customer_id)
-    address, courier_telegram_id = get_address(nearest_shop_id)
-    keyboard = [[InlineKeyboardButton('ПО КАРТЕ', callback_data='goto_payment_card')],
-                [InlineKeyboardButton('НАЛИЧНЫМИ', callback_data='goto_payment_cash')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    location = get_customer_location(chat_id, session)
+    if location is None:
+        ask_location(bot, chat_id, message_id)
+        return 'HANDLE_CHECKOUT_GEO'
+    latitude, longitude, nearest_shop_id = location
+    cart, products, total = get_cart(chat_id, session.get('cart_version'))
+    shop = get_shop(nearest_shop_id)
+    if shop:
+        address, courier_telegram_id = shop['address'], shop['courier_telegram_id']
+    else:
+        address, courier_telegram_id = get_address(nearest_shop_id)
     if query_data == 'goto_checkout_delivery':
-        bot.send_location(latitude=latitude, longitude=longitude, chat_id=courier_telegram_id)
-        bot.send_message(text=f'Заказ:\n{products}\nСумма:{total} руб.',
-                        chat_id=courier_telegram_id)
-        #job_queue.run_once(add_reminder, REMINDER_TIME, context=chat_id)
-        bot.send_message(text=f'Заказ принят и скоро будет доставлен! Как будете оплачивать?', chat_id=chat_id, reply_markup=reply_markup)
+        # The nearest shop may be too busy, the order goes to the one which
+        # delivers sooner.
+        order_id = session.get('order_id') or start_order(session)
+        dispatched_shop = dispatch_order(order_id, latitude, longitude)
+        if dispatched_shop:
+            courier_telegram_id = dispatched_shop['courier_telegram_id']
+        schedule_delivery(bot, chat_id, order_id,
+                          courier_telegram_id, latitude, longitude,
+                          f'Заказ:\n{products}\nСумма:{total} руб.')
+        render(bot, chat_id, message_id, 'Заказ принят и скоро будет доставлен! Как будете оплачивать?',
+               reply_markup=PAYMENT_MARKUP)
     elif query_data == 'goto_checkout_pickup':
-        bot.send_message(text=f'Отлично! Ждем вас по адресу: {address}. Как будете оплачивать?', chat_id=chat_id, reply_markup=reply_markup)
-    bot.delete_message(chat_id=chat_id, message_id=message_id)
+        render(bot, chat_id, message_id, f'Отлично! Ждем вас по адресу: {address}. Как будете оплачивать?',
+               reply_markup=PAYMENT_MARKUP)
     return 'HANDLE_CHECKOUT_PAYMENT'
 
 
-def handle_checkout_payment(bot, update, job_queue):
+def handle_checkout_payment(bot, update, job_queue, session):
     message_id, chat_id, query_data = get_query_data(update)
-    cart, products, total = get_cart(chat_id)
+    cart, products, total = get_cart(chat_id, session.get('cart_version'))
     if query_data == 'goto_payment_cash':
-        bot.send_message(text=f'Договорились! Напоминаем, что вы заказали:\n{products}\nСумма:{total} руб.', chat_id=chat_id)
+        render(bot, chat_id, message_id, f'Договорились! Напоминаем, что вы заказали:\n{products}\nСумма:{total} руб.')
+        finish_order(session)
+        invalidate_cart(chat_id)
     elif query_data == 'goto_payment_card':
         title = 'Оплата заказа'
         description = f'{products}\nСумма:{total} руб.'
@@ -175,9 +229,8 @@ def handle_checkout_payment(bot, update, job_queue):
         currency = 'RUB'
         price = total
         prices = [LabeledPrice('Test', price * 100)]
-        bot.sendInvoice(chat_id, title, description, payload, provider_token,
-                        start_parameter, currency, prices)
-    bot.delete_message(chat_id=chat_id, message_id=message_id)
+        send_invoice(bot, chat_id, message_id, title, description, payload,
+                     provider_token, start_parameter, currency, prices)
 
 
 def handle_answer_payment(bot, update):
@@ -190,22 +243,25 @@ def handle_answer_payment(bot, update):
 
 
 def handle_successful_payment(bot, update):
-    update.message.reply_text('Спасибо за заказ!')
+    session = load_session(update.message.chat_id)
+    finish_order(session)
+    save_session(session)
+    invalidate_cart(update.message.chat_id)
+    send_text(bot, update.message.chat_id, 'Спасибо за заказ!')
 
-import logging as l
-l.basicConfig(level=l.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s', datefmt='%m-%d %H:%M', filename='log.log', filemode='a+')
 
+@tracing.traced('handle_users_reply')
 def handle_users_reply(bot, update, job_queue):
 
     # Handles all user's actions. Gets current statement,
     # runs relevant function and set new statement.
-    global database
-    database = get_database_connection()
     message_id, chat_id, query_data = get_query_data(update)
-    if query_data == '/start':
+    session = load_session(chat_id)
+    bot = CountingBot(bot)
+    if query_data == '/start' or 'state' not in session:
         user_state = 'HANDLE_START'
     else:
-        user_state = database.get(chat_id).decode('utf-8')
+        user_state = session['state']
     states_functions = {
             'HANDLE_START': handle_start,
             'HANDLE_MENU': handle_menu,
@@ -216,9 +272,18 @@ def handle_users_reply(bot, update, job_queue):
             'HANDLE_CHECKOUT_PAYMENT': handle_checkout_payment,
         }
     state_handler = states_functions[user_state]
-    l.info(f'job_queue: {job_queue}, state_handler: {state_handler}')
+    metrics.set_state(user_state)
+    tracing.set_attribute('state', user_state)
+    tracing.set_chat(chat_id)
     try:
-        next_state = state_handler(bot, update, job_queue)
-        database.set(chat_id, next_state)
+        with metrics.timer('handler_seconds'):
+            next_state = state_handler(bot, update, job_queue, session)
+            if next_state:
+                session['state'] = next_state
+            save_session(session)
     except MoltinError as e:
+        metrics.inc('handler_errors_total', state=user_state)
         logging.critical(e)
+    finally:
+        bot.finish()
+        metrics.set_state(None)
@@ -0,0 +1,176 @@
+import os
+import time
+import bisect
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+import tracing
+
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1') == '1'
+# Timers also give spans to the traces. With metrics switched off only calls
+# of sampled updates are timed.
+INSTRUMENTATION_ENABLED = METRICS_ENABLED or tracing.TRACING_ENABLED
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+NO_STATE = 'none'
+
+histograms = {}
+counters = {}
+gauges = {}
+descriptions = {}
+metrics_lock = threading.Lock()
+context = threading.local()
+
+
+def get_state():
+    # State of the chat whose update is handled by the current thread.
+    return getattr(context, 'state', NO_STATE)
+
+
+def set_state(state):
+    context.state = state or NO_STATE
+
+
+def describe(name, description):
+    descriptions[name] = description
+
+
+def get_labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, value, **labels):
+    key = (name, get_labels_key(labels))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * len(LATENCY_BUCKETS), 0, 0]
+        position = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if position < len(LATENCY_BUCKETS):
+            histogram[0][position] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def inc(name, value=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, get_labels_key(labels))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def register_gauge(name, function):
+    # Function returns the current value, it's called on every scrape.
+    gauges[name] = function
+
+
+def is_timed():
+    return METRICS_ENABLED or tracing.get_trace() is not None
+
+
+def record(name, start, duration, labels):
+    # "moltin_request_seconds" with function="get_cart" is span "moltin get_cart".
+    if METRICS_ENABLED:
+        observe(name, duration, state=get_state(), **labels)
+    if tracing.get_trace() is not None:
+        span_name = name.split('_')[0]
+        if labels:
+            span_name = f'{span_name} {next(iter(labels.values()))}'
+        else:
+            span_name = f'{span_name} {get_state()}'
+        tracing.add_span(span_name, start, duration)
+
+
+@contextmanager
+def timer(name, **labels):
+    if not is_timed():
+        yield
+        return
+    start = time.time()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, start, time.perf_counter() - started_at, labels)
+
+
+def timed(name, **labels):
+    # Decorator, the function is returned as is if metrics and tracing are
+    # disabled.
+    def decorator(function):
+        if not INSTRUMENTATION_ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not is_timed():
+                return function(*args, **kwargs)
+            start = time.time()
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, start, time.perf_counter() - started_at, labels)
+        return wrapper
+    return decorator
+
+
+def format_labels(labels, **extra_labels):
+    labels = list(labels) + list(extra_labels.items())
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(labels, escaped)) + '}'
+
+
+def format_header(lines, name, kind):
+    if name in descriptions:
+        lines.append(f'# HELP {name} {descriptions[name]}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def render():
+    # Prometheus text format.
+    with metrics_lock:
+        histogram_items = sorted((key, ([*buckets], total, number))
+                                 for key, (buckets, total, number) in histograms.items())
+        counter_items = sorted(counters.items())
+    lines = []
+    last_name = None
+    for (name, labels), (buckets, total, number) in histogram_items:
+        if name != last_name:
+            format_header(lines, name, 'histogram')
+            last_name = name
+        cumulative = 0
+        for bucket, bucket_count in zip(LATENCY_BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{format_labels(labels, le=bucket)} {cumulative}')
+        lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {number}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{name}_count{format_labels(labels)} {number}')
+    for (name, labels), value in counter_items:
+        if name != last_name:
+            format_header(lines, name, 'counter')
+            last_name = name
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    for name, function in sorted(gauges.items()):
+        try:
+            value = function()
+        except Exception as e:
+            logging.error(f'Gauge {name} failed: {e}')
+            continue
+        format_header(lines, name, 'gauge')
+        lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+describe('handler_seconds', 'Time of handling one update by the state handler.')
+describe('handler_errors_total', 'Updates failed in the state handler.')
+describe('moltin_request_seconds', 'Moltin API calls by function.')
+describe('moltin_errors_total', 'MoltinError by endpoint function.')
+describe('redis_command_seconds', 'Redis commands and pipelines.')
+describe('geocoder_request_seconds', 'Geocoder API requests.')
+describe('telegram_request_seconds', 'Telegram Bot API calls by method.')
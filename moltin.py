@@ -1,17 +1,43 @@
 import os
+import json
+import time
+import functools
+import logging
+from threading import Lock
 from dotenv import load_dotenv
 
+import redis
 import requests
-from requests.exceptions import HTTPError, ConnectionError
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, ConnectionError, Timeout
+from urllib3.util.retry import Retry
 
+import metrics
+from db import get_database_connection
 
-MOLTIN_API_URL = 'https://api.moltin.com/v2'
-MOLTIN_API_OAUTH_URL = 'https://api.moltin.com/oauth/access_token'
+
+load_dotenv()
+
+MOLTIN_API_URL = os.getenv('MOLTIN_API_URL', 'https://api.moltin.com/v2')
+MOLTIN_API_OAUTH_URL = os.getenv('MOLTIN_API_OAUTH_URL',
+                                 'https://api.moltin.com/oauth/access_token')
 MOLTIN_ERR_MSG = 'Moltin API returns error:'
 MOLTIN_FLOW_ADDRESSES = 'addresses2'
 MOLTIN_FLOW_CUSTOMERS = 'customers2'
-
-load_dotenv()
+MOLTIN_TOKEN_KEY = 'moltin_token'
+MOLTIN_TOKEN_LOCK_KEY = 'moltin_token_lock'
+MOLTIN_TOKEN_REFRESH_MARGIN = 60
+MOLTIN_TOKEN_LOCK_TIMEOUT = 10
+MOLTIN_TIMEOUT = (3.05, 10)  # connect and read timeouts, seconds
+MOLTIN_POOL_SIZE = int(os.getenv('MOLTIN_POOL_SIZE', 16))
+MOLTIN_RETRIES = 3
+MOLTIN_RETRY_BACKOFF = 0.3
+MOLTIN_RETRY_STATUSES = (429, 500, 502, 503, 504)
+MOLTIN_PAGE_LIMIT = 100
+
+token = {'access_token': None, 'expires': 0}
+token_lock = Lock()
+token_stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
 
 
 class MoltinError(Exception):
@@ -19,78 +45,234 @@ class MoltinError(Exception):
         self.message = message
 
 
+class MoltinRetry(Retry):
+    # Moltin rejects throttled requests before processing them,
+    # so any method, even POST, can be retried on 429.
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class MoltinSession(requests.Session):
+    # Keep-alive session with connection pool shared by all dispatcher
+    # threads. Every request gets default timeout, so a stalled Moltin
+    # call can't freeze the thread forever.
+    def __init__(self, timeout=MOLTIN_TIMEOUT, pool_size=MOLTIN_POOL_SIZE,
+                 retries=MOLTIN_RETRIES):
+        super().__init__()
+        self.timeout = timeout
+        retry = MoltinRetry(total=retries, backoff_factor=MOLTIN_RETRY_BACKOFF,
+                            status_forcelist=MOLTIN_RETRY_STATUSES,
+                            raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+session = MoltinSession()
+
+
 def check_resp_json(resp):
     if 'errors' in resp.json():
         raise MoltinError(f'{MOLTIN_ERR_MSG} {resp.json()}')
 
 
+def parse_cart(cart):
+    products = '\n'.join((f"{product['name']}: {product['quantity']} шт. по {product['unit_price']['amount']} руб." for product in cart['data']))
+    total = int(cart['meta']['display_price']['with_tax']['formatted'])
+    return cart, products, total
+
+
+def is_token_fresh(candidate, rejected_token=None):
+    # Token is refreshed proactively, some time before Moltin expires it.
+    if not candidate or candidate['access_token'] is None:
+        return False
+    if candidate['access_token'] == rejected_token:
+        return False
+    return candidate['expires'] - time.time() > MOLTIN_TOKEN_REFRESH_MARGIN
+
+
+@metrics.timed('moltin_request_seconds', function='fetch_token')
+def fetch_token():
+    moltin_client_id = os.getenv('MOLTIN_CLIENT_ID')
+    moltin_client_secret = os.getenv('MOLTIN_CLIENT_SECRET')
+    data = {'client_id': str(moltin_client_id),
+            'client_secret': str(moltin_client_secret),
+            'grant_type': 'client_credentials'}
+    resp = session.post(MOLTIN_API_OAUTH_URL, data=data)
+    resp.raise_for_status()
+    check_resp_json(resp)
+    resp_json = resp.json()
+    expires = resp_json.get('expires') or time.time() + resp_json['expires_in']
+    return {'access_token': resp_json['access_token'], 'expires': expires}
+
+
+def load_shared_token(database):
+    shared_token = database.get(MOLTIN_TOKEN_KEY)
+    if shared_token is None:
+        return
+    return json.loads(shared_token)
+
+
+def save_shared_token(database, new_token):
+    ttl = max(int(new_token['expires'] - time.time()), 1)
+    database.set(MOLTIN_TOKEN_KEY, json.dumps(new_token), ex=ttl)
+
+
+def refresh_token(rejected_token=None):
+    # Tokens are shared by all gunicorn workers through Redis, and the
+    # Redis lock lets only one worker go to Moltin for a new one.
+    database = get_database_connection()
+    try:
+        shared_token = load_shared_token(database)
+        if is_token_fresh(shared_token, rejected_token):
+            return shared_token
+        with database.lock(MOLTIN_TOKEN_LOCK_KEY,
+                           timeout=MOLTIN_TOKEN_LOCK_TIMEOUT,
+                           blocking_timeout=MOLTIN_TOKEN_LOCK_TIMEOUT):
+            shared_token = load_shared_token(database)
+            if is_token_fresh(shared_token, rejected_token):
+                return shared_token
+            new_token = fetch_token()
+            token_stats['refreshes'] += 1
+            save_shared_token(database, new_token)
+            return new_token
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Shared Moltin token is unavailable: {e}')
+        token_stats['refreshes'] += 1
+        return fetch_token()
+
+
+def get_token(rejected_token=None):
+    # Returns cached access token. Only one thread of the process refreshes
+    # expired token, the others wait for it and take the new one.
+    global token
+    if is_token_fresh(token, rejected_token):
+        token_stats['hits'] += 1
+        return token['access_token']
+    with token_lock:
+        if is_token_fresh(token, rejected_token):
+            token_stats['hits'] += 1
+            return token['access_token']
+        token_stats['misses'] += 1
+        token = refresh_token(rejected_token)
+        return token['access_token']
+
+
+def get_token_stats():
+    return dict(token_stats)
+
+
+def make_headers(moltin_token):
+    return {
+        'Authorization': 'Bearer {}'.format(moltin_token),
+        'Content-Type': 'application/json'
+    }
+
+
 def get_headers(func):
+    @functools.wraps(func)
+    @metrics.timed('moltin_request_seconds', function=func.__name__)
     def wrapper(*args):
-        moltin_client_id = os.getenv('MOLTIN_CLIENT_ID')
-        moltin_client_secret = os.getenv('MOLTIN_CLIENT_SECRET')
-        data = {'client_id': str(moltin_client_id),
-                'client_secret': str(moltin_client_secret),
-                'grant_type': 'client_credentials'}
         try:
-            resp = requests.post(MOLTIN_API_OAUTH_URL, data=data)
-            resp.raise_for_status()
-            check_resp_json(resp)
-            moltin_token = resp.json()['access_token']
-            headers = {
-                'Authorization': 'Bearer {}'.format(moltin_token),
-                'Content-Type': 'application/json'
-            }
-            return func(headers, *args)
+            moltin_token = get_token()
+            try:
+                return func(make_headers(moltin_token), *args)
+            except HTTPError as e:
+                # Token could be revoked before its expiration time,
+                # so get the new one and try again once.
+                if e.response is None or e.response.status_code != 401:
+                    raise
+                moltin_token = get_token(rejected_token=moltin_token)
+                return func(make_headers(moltin_token), *args)
         except HTTPError as e:
+            metrics.inc('moltin_errors_total', endpoint=func.__name__)
             raise MoltinError(f'{MOLTIN_ERR_MSG} {e}')
-        except ConnectionError as e:
+        except (ConnectionError, Timeout) as e:
+            metrics.inc('moltin_errors_total', endpoint=func.__name__)
             raise MoltinError(f'{MOLTIN_ERR_MSG} {e}')
     return wrapper
 
 
+def get_page_params(offset, sort, limit):
+    params = {'page[limit]': limit, 'page[offset]': offset}
+    if sort:
+        params['sort'] = sort
+    return params
+
+
+def get_all_pages(load_page):
+    # load_page(offset) returns entries of the page and total number of them.
+    entries, total = load_page(0)
+    for offset in range(MOLTIN_PAGE_LIMIT, total, MOLTIN_PAGE_LIMIT):
+        entries += load_page(offset)[0]
+    return list({entry['id']: entry for entry in entries}.values())
+
+
 @get_headers
-def get_products(headers):
-    resp = requests.get(f'{MOLTIN_API_URL}/products', headers=headers)
+def get_products_page(headers, offset=0, sort=None, limit=MOLTIN_PAGE_LIMIT):
+    resp = session.get(f'{MOLTIN_API_URL}/products', headers=headers,
+                        params=get_page_params(offset, sort, limit))
     resp.raise_for_status()
     check_resp_json(resp)
-    products = resp.json()['data']
+    resp_json = resp.json()
+    return resp_json['data'], resp_json['meta']['results']['total']
+
+
+def get_products():
+    products = get_all_pages(get_products_page)
     return {product['id']: product['name'] for product in products}
 
 
-@get_headers
-def get_product(headers, product_id):
-    resp = requests.get(f'{MOLTIN_API_URL}/products/{product_id}',
-                        headers=headers)
-    resp.raise_for_status()
-    check_resp_json(resp)
-    product = resp.json()['data']
+def parse_product(product):
     name = product['name']
     description = product['description']
     price = product['price'][0]['amount']
     id_img = product['relationships']['main_image']['data']['id']
-    resp_img = requests.get(f'{MOLTIN_API_URL}/files/{id_img}',
+    return name, description, price, id_img
+
+
+@get_headers
+def get_product_details(headers, product_id):
+    resp = session.get(f'{MOLTIN_API_URL}/products/{product_id}',
+                        headers=headers)
+    resp.raise_for_status()
+    check_resp_json(resp)
+    return parse_product(resp.json()['data'])
+
+
+@get_headers
+def get_file_href(headers, id_img):
+    resp_img = session.get(f'{MOLTIN_API_URL}/files/{id_img}',
                             headers=headers)
     resp_img.raise_for_status()
     check_resp_json(resp_img)
-    href_img = resp_img.json()['data']['link']['href']
-    return name, description, price, href_img
+    return resp_img.json()['data']['link']['href']
+
+
+def get_product(product_id):
+    name, description, price, id_img = get_product_details(product_id)
+    return name, description, price, get_file_href(id_img)
 
 
 @get_headers
 def get_cart(headers, cart_id):
-    resp = requests.get(f'{MOLTIN_API_URL}/carts/{cart_id}/items',
+    resp = session.get(f'{MOLTIN_API_URL}/carts/{cart_id}/items',
                         headers=headers)
     resp.raise_for_status()
     check_resp_json(resp)
-    cart = resp.json()
-    products = '\n'.join((f"{product['name']}: {product['quantity']} шт. по {product['unit_price']['amount']} руб." for product in cart['data']))
-    total = int(cart['meta']['display_price']['with_tax']['formatted'])
-    return cart, products, total
+    return parse_cart(resp.json())
 
 
 @get_headers
 def get_customer(headers, id):
-    resp = requests.get(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_CUSTOMERS}/entries/{id}',
+    resp = session.get(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_CUSTOMERS}/entries/{id}',
                         headers=headers)
     resp.raise_for_status()
     check_resp_json(resp)
@@ -98,18 +280,52 @@ def get_customer(headers, id):
     return data['latitude'], data['longitude'], data['nearest_shop_id']
 
 
+def get_addresses():
+    return get_all_pages(functools.partial(get_flow_entries, MOLTIN_FLOW_ADDRESSES))
+
+
 @get_headers
-def get_addresses(headers):
-    resp = requests.get(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_ADDRESSES}/entries',
-                        headers=headers)
+def get_flow_entries(headers, flow_slug, offset=0, sort=None, limit=MOLTIN_PAGE_LIMIT):
+    # Returns one page of entries and total number of entries in the flow.
+    resp = session.get(f'{MOLTIN_API_URL}/flows/{flow_slug}/entries',
+                        headers=headers, params=get_page_params(offset, sort, limit))
+    resp.raise_for_status()
+    check_resp_json(resp)
+    resp_json = resp.json()
+    return resp_json['data'], resp_json['meta']['results']['total']
+
+
+@get_headers
+def create_entry(headers, flow_slug, fields):
+    data = {'data': {'type': 'entry', **fields}}
+    resp = session.post(f'{MOLTIN_API_URL}/flows/{flow_slug}/entries',
+                        headers=headers, json=data)
     resp.raise_for_status()
     check_resp_json(resp)
     return resp.json()['data']
 
 
+@get_headers
+def update_entry(headers, flow_slug, entry_id, fields):
+    data = {'data': {'type': 'entry', 'id': entry_id, **fields}}
+    resp = session.put(f'{MOLTIN_API_URL}/flows/{flow_slug}/entries/{entry_id}',
+                        headers=headers, json=data)
+    resp.raise_for_status()
+    check_resp_json(resp)
+    return resp.json()['data']
+
+
+@get_headers
+def delete_entry(headers, flow_slug, entry_id):
+    resp = session.delete(f'{MOLTIN_API_URL}/flows/{flow_slug}/entries/{entry_id}',
+                            headers=headers)
+    resp.raise_for_status()
+    return entry_id
+
+
 @get_headers
 def get_address(headers, id):
-    resp = requests.get(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_ADDRESSES}/entries/{id}',
+    resp = session.get(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_ADDRESSES}/entries/{id}',
                         headers=headers)
     resp.raise_for_status()
     check_resp_json(resp)
@@ -129,7 +345,7 @@ def add_customer(headers, chat_id, latitude, longitude, address, nearest_shop_id
             'nearest_shop_id': nearest_shop_id,
         }
     }
-    resp = requests.post(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_CUSTOMERS}/entries',
+    resp = session.post(f'{MOLTIN_API_URL}/flows/{MOLTIN_FLOW_CUSTOMERS}/entries',
                         headers=headers, json=data)
     resp.raise_for_status()
     check_resp_json(resp)
@@ -146,19 +362,16 @@ def add_to_cart(headers, cart_id, product_id):
         }
     }
     headers['X-MOLTIN-CURRENCY'] = 'RUB'
-    resp = requests.post(f'{MOLTIN_API_URL}/carts/{cart_id}/items',
+    resp = session.post(f'{MOLTIN_API_URL}/carts/{cart_id}/items',
                         headers=headers, json=data)
     resp.raise_for_status()
     check_resp_json(resp)
-    cart = resp.json()
-    products = '\n'.join((f"{product['name']}: {product['quantity']} шт. по {product['unit_price']['amount']} руб." for product in cart['data']))
-    total = int(cart['meta']['display_price']['with_tax']['formatted'])
-    return cart, products, total
+    return parse_cart(resp.json())
 
 
 @get_headers
 def delete_from_cart(headers, cart_id, item_id):
-    resp = requests.delete(f'{MOLTIN_API_URL}/carts/{cart_id}/items/{item_id}',
+    resp = session.delete(f'{MOLTIN_API_URL}/carts/{cart_id}/items/{item_id}',
                             headers=headers)
     resp.raise_for_status()
     check_resp_json(resp)
@@ -176,54 +389,66 @@ def create_flow(headers, name):
             'enabled': True
         }
     }
-    resp = requests.post(f'{MOLTIN_API_URL}/flows', headers=headers, json=data)
+    resp = session.post(f'{MOLTIN_API_URL}/flows', headers=headers, json=data)
     resp.raise_for_status()
     check_resp_json(resp)
     return resp.json()
 
 
 @get_headers
-def create_fields(headers, flow_id, fields):
-    result = ''
-    for field, type in fields.items():
-        data = {
-            'data': {
-                'type': 'field',
-                'name': field,
-                'slug': field,
-                'field_type': type,
-                'description': '',
-                'required': False,
-                'unique': False,
-                'default': 0,
-                'enabled': True,
-                'order': 1,
-                'relationships': {
-                    'flow': {
-                        'data': {
-                            'type': 'flow',
-                            'id': flow_id
-                        }
+def get_flows(headers):
+    resp = session.get(f'{MOLTIN_API_URL}/flows', headers=headers)
+    resp.raise_for_status()
+    check_resp_json(resp)
+    return resp.json()['data']
+
+
+@get_headers
+def create_field(headers, flow_id, field, type):
+    data = {
+        'data': {
+            'type': 'field',
+            'name': field,
+            'slug': field,
+            'field_type': type,
+            'description': '',
+            'required': False,
+            'unique': False,
+            'default': 0,
+            'enabled': True,
+            'order': 1,
+            'relationships': {
+                'flow': {
+                    'data': {
+                        'type': 'flow',
+                        'id': flow_id
                     }
                 }
             }
         }
-        resp = requests.post(f'{MOLTIN_API_URL}/fields', headers=headers, json=data)
-        resp.raise_for_status()
-        check_resp_json(resp)
-        result +=  ', ' + str(resp.json()['data']['name'])
+    }
+    resp = session.post(f'{MOLTIN_API_URL}/fields', headers=headers, json=data)
+    resp.raise_for_status()
+    check_resp_json(resp)
+    return resp.json()['data']
+
+
+def create_fields(flow_id, fields):
+    result = ''
+    for field, type in fields.items():
+        result += ', ' + str(create_field(flow_id, field, type)['name'])
     return f'Fields: {result} was created'
 
 
 @get_headers
 def delete_flow(headers, id):
-    resp = requests.delete(f'{MOLTIN_API_URL}/flows/{id}', headers=headers)
+    resp = session.delete(f'{MOLTIN_API_URL}/flows/{id}', headers=headers)
     resp.raise_for_status()
     return resp
 
 
 @get_headers
 def get_flow_fields(headers, name):
-    resp = requests.get(f'{MOLTIN_API_URL}/flows/{name}/fields', headers=headers)
+    resp = session.get(f'{MOLTIN_API_URL}/flows/{name}/fields', headers=headers)
     resp.raise_for_status()
     return resp.json()
@@ -0,0 +1,276 @@
+import os
+import time
+import heapq
+import logging
+from collections import deque
+from itertools import count
+from threading import Condition, Event, Thread
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+import metrics
+import tracing
+from ratelimit import TokenBucket
+
+
+CUSTOMER_PRIORITY = 0
+COURIER_PRIORITY = 1
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+TELEGRAM_MESSAGES_PER_SECOND = int(os.getenv('TELEGRAM_MESSAGES_PER_SECOND', 30))
+CHAT_MESSAGES_PER_SECOND = 1
+CHAT_BURST = 3
+CHAT_QUEUE_SIZE = 50
+SEND_MAX_ATTEMPTS = 5
+SEND_RETRY_BACKOFF = 1
+SEND_WAIT_TIMEOUT = 60
+IDLE_CHAT_TTL = 60
+
+
+class ThrottledBot:
+    # Proxy of the bot, every Telegram API call takes token of the bucket.
+    def __init__(self, bot, bucket):
+        self.bot = bot
+        self.bucket = bucket
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            self.bucket.acquire()
+            return attribute(*args, **kwargs)
+        return call
+
+
+class Job:
+    def __init__(self, function, bot, args, kwargs, priority, key):
+        self.function = function
+        self.bot = bot
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.key = key
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        self.done = Event()
+        self.error = None
+        self.state = metrics.get_state()
+        self.trace = tracing.get_trace()
+        if self.trace is not None:
+            self.trace.hold()
+
+    def release(self):
+        if self.trace is not None:
+            self.trace.release()
+
+
+class Outbox:
+    # Sends of one chat run in order, one at a time, within the per-chat
+    # limit. Ready chats are served by priority of their first job, so
+    # customer replies pass ahead of courier notifications.
+    def __init__(self, workers=SEND_WORKERS, rate=TELEGRAM_MESSAGES_PER_SECOND,
+                 chat_rate=CHAT_MESSAGES_PER_SECOND, chat_burst=CHAT_BURST,
+                 chat_queue_size=CHAT_QUEUE_SIZE, clock=time.monotonic):
+        self.workers = workers
+        self.bucket = TokenBucket(rate, clock=clock)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_queue_size = chat_queue_size
+        self.clock = clock
+        self.chats = {}
+        self.chat_buckets = {}
+        self.busy = set()
+        self.ready = []
+        self.delayed = []
+        self.sequence = count()
+        self.condition = Condition()
+        self.stats = {'submitted': 0, 'sent': 0, 'retried': 0, 'failed': 0,
+                      'dropped': 0, 'coalesced': 0}
+
+    def start(self):
+        for number in range(self.workers):
+            Thread(target=self.work, name=f'outbox_{number}', daemon=True).start()
+        return self
+
+    def submit(self, chat_id, function, bot, *args, priority=CUSTOMER_PRIORITY,
+               key=None, **kwargs):
+        # Queues function(bot, *args, **kwargs) and returns at once. Pending
+        # job of the chat with the same key is replaced by the new one.
+        return self.put(chat_id, Job(function, bot, args, kwargs, priority, key))
+
+    def call(self, chat_id, function, bot, *args, priority=CUSTOMER_PRIORITY,
+             timeout=SEND_WAIT_TIMEOUT, **kwargs):
+        # The same as submit, but waits until it's sent and raises its error.
+        job = Job(function, bot, args, kwargs, priority, None)
+        if not self.put(chat_id, job):
+            raise TelegramError(f'Send queue of chat {chat_id} is full')
+        if not job.done.wait(timeout):
+            raise TelegramError(f'Send to chat {chat_id} is not done in {timeout} s')
+        if job.error is not None:
+            raise job.error
+
+    def put(self, chat_id, job):
+        key = job.key
+        with self.condition:
+            self.stats['submitted'] += 1
+            chat_queue = self.chats.get(chat_id)
+            if chat_queue is None:
+                chat_queue = self.chats[chat_id] = deque()
+            if key is not None:
+                for number, pending_job in enumerate(chat_queue):
+                    if pending_job.key == key:
+                        job.enqueued_at = pending_job.enqueued_at
+                        chat_queue[number] = job
+                        self.stats['coalesced'] += 1
+                        pending_job.release()
+                        return True
+            if len(chat_queue) >= self.chat_queue_size:
+                self.stats['dropped'] += 1
+                logging.warning(f'Send to chat {chat_id} dropped, queue is full')
+                job.release()
+                return False
+            chat_queue.append(job)
+            if len(chat_queue) == 1 and chat_id not in self.busy:
+                self.push_ready(chat_id)
+            return True
+
+    def push_ready(self, chat_id):
+        priority = self.chats[chat_id][0].priority
+        heapq.heappush(self.ready, (priority, next(self.sequence), chat_id))
+        self.condition.notify()
+
+    def push_delayed(self, chat_id, delay):
+        heapq.heappush(self.delayed, (self.clock() + delay, next(self.sequence), chat_id))
+        self.condition.notify()
+
+    def get_chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, self.chat_burst, clock=self.clock)
+        return bucket
+
+    def take(self):
+        # Waits for a chat which may be sent to now and returns its first job.
+        with self.condition:
+            while True:
+                now = self.clock()
+                while self.delayed and self.delayed[0][0] <= now:
+                    chat_id = heapq.heappop(self.delayed)[2]
+                    self.push_ready(chat_id)
+                if self.ready:
+                    chat_id = heapq.heappop(self.ready)[2]
+                    wait_time = self.get_chat_bucket(chat_id).try_acquire()
+                    if wait_time:
+                        self.push_delayed(chat_id, wait_time)
+                        continue
+                    self.busy.add(chat_id)
+                    return chat_id, self.chats[chat_id].popleft()
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.condition.wait(timeout)
+
+    def finish(self, chat_id, job=None, delay=0):
+        # Returns the job to the head of the chat queue if it's retried.
+        with self.condition:
+            self.busy.discard(chat_id)
+            chat_queue = self.chats[chat_id]
+            if job is not None:
+                chat_queue.appendleft(job)
+            if not chat_queue:
+                del self.chats[chat_id]
+                self.condition.notify_all()
+            elif delay:
+                self.push_delayed(chat_id, delay)
+            else:
+                self.push_ready(chat_id)
+
+    def send(self, chat_id, job):
+        # Returns seconds to wait before retry, None if the job is done.
+        job.attempts += 1
+        metrics.set_state(job.state)
+        try:
+            with tracing.attach(job.trace):
+                wait_time = time.monotonic() - job.enqueued_at
+                tracing.add_span('outbox wait', time.time() - wait_time, wait_time)
+                job.function(ThrottledBot(job.bot, self.bucket), *job.args, **job.kwargs)
+            job.error = None
+            return
+        except RetryAfter as e:
+            logging.warning(f'Telegram asks to retry send to chat {chat_id} after {e.retry_after} s')
+            job.error = e
+            delay = e.retry_after
+        except BadRequest as e:
+            logging.error(f'Send to chat {chat_id} failed: {e}')
+            job.error = e
+            return
+        except NetworkError as e:
+            logging.error(f'Send to chat {chat_id} failed, attempt {job.attempts}: {e}')
+            job.error = e
+            delay = SEND_RETRY_BACKOFF * job.attempts
+        except TelegramError as e:
+            logging.error(f'Send to chat {chat_id} failed: {e}')
+            job.error = e
+            return
+        if job.attempts >= SEND_MAX_ATTEMPTS:
+            logging.error(f'Send to chat {chat_id} dropped after {job.attempts} attempts')
+            return
+        return delay
+
+    def work(self):
+        while True:
+            chat_id, job = self.take()
+            try:
+                delay = self.send(chat_id, job)
+            except Exception as e:
+                logging.critical(e)
+                job.error = e
+                delay = None
+                result = 'failed'
+            else:
+                result = 'sent' if delay is None else 'retried'
+            with self.condition:
+                self.stats[result] += 1
+            if delay is None:
+                self.finish(chat_id)
+                job.done.set()
+                job.release()
+            else:
+                self.finish(chat_id, job, delay)
+            self.forget_idle_chats()
+
+    def forget_idle_chats(self):
+        # Full bucket of the idle chat is the same as a new one.
+        with self.condition:
+            if len(self.chat_buckets) <= len(self.chats) * 2 + 1000:
+                return
+            for chat_id, bucket in list(self.chat_buckets.items()):
+                idle = self.clock() - bucket.updated_at > IDLE_CHAT_TTL
+                if chat_id not in self.chats and idle:
+                    del self.chat_buckets[chat_id]
+
+    def join(self, timeout=None):
+        # Waits until all queued sends are done, for scripts and benchmarks.
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.chats, timeout)
+
+    def get_stats(self):
+        now = time.monotonic()
+        with self.condition:
+            jobs = [job for chat_queue in self.chats.values() for job in chat_queue]
+            stats = dict(self.stats)
+            stats.update({
+                'workers': self.workers,
+                'chats': len(self.chats),
+                'delayed_chats': len(self.delayed),
+            })
+        stats['backlog'] = len(jobs)
+        stats['backlog_by_priority'] = {
+            'customer': sum(job.priority == CUSTOMER_PRIORITY for job in jobs),
+            'courier': sum(job.priority == COURIER_PRIORITY for job in jobs),
+        }
+        stats['oldest_wait'] = max((now - job.enqueued_at for job in jobs), default=0)
+        return stats
+
+
+outbox = Outbox()
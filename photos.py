@@ -0,0 +1,75 @@
+import json
+import logging
+
+import redis
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+from cache import LRUCache
+from db import get_database_connection
+
+
+FILE_IDS_KEY = 'telegram:file_ids'
+
+file_ids = LRUCache(1024)
+
+
+def get_file_id(product_id, href_img):
+    # Returns Telegram file_id of the product photo, if this image version
+    # was already sent. Otherwise Telegram has to download it from href_img.
+    photo = file_ids.get(product_id)
+    if photo is None:
+        try:
+            photo = get_database_connection().hget(FILE_IDS_KEY, product_id)
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Telegram file ids are unavailable: {e}')
+            return
+        if photo is None:
+            return
+        photo = json.loads(photo)
+        file_ids.set(product_id, photo)
+    if photo['href'] == href_img:
+        return photo['file_id']
+
+
+def save_file_id(product_id, href_img, file_id):
+    photo = {'href': href_img, 'file_id': file_id}
+    file_ids.set(product_id, photo)
+    try:
+        get_database_connection().hset(FILE_IDS_KEY, product_id, json.dumps(photo))
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Telegram file ids are unavailable: {e}')
+
+
+def invalidate_file_id(product_id):
+    file_ids.delete(product_id)
+    try:
+        get_database_connection().hdel(FILE_IDS_KEY, product_id)
+    except redis.exceptions.RedisError as e:
+        logging.error(f'Telegram file ids are unavailable: {e}')
+
+
+def send_product_photo(bot, chat_id, product_id, href_img, **kwargs):
+    # Sends cached file_id, or the URL once and remembers its file_id.
+    file_id = get_file_id(product_id, href_img)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            logging.error(f'Telegram file id of {product_id} is rejected: {e}')
+            invalidate_file_id(product_id)
+    message = bot.send_photo(chat_id=chat_id, photo=href_img, **kwargs)
+    save_file_id(product_id, href_img, message.photo[-1].file_id)
+    return message
+
+
+def edit_product_photo(bot, chat_id, message_id, product_id, href_img,
+                       caption=None, reply_markup=None):
+    # Replaces photo of the message, Telegram errors are left to the caller.
+    file_id = get_file_id(product_id, href_img)
+    media = InputMediaPhoto(file_id or href_img, caption=caption)
+    message = bot.edit_message_media(chat_id=chat_id, message_id=message_id,
+                                     media=media, reply_markup=reply_markup)
+    if not file_id and getattr(message, 'photo', None):
+        save_file_id(product_id, href_img, message.photo[-1].file_id)
+    return message
@@ -0,0 +1,47 @@
+import os
+import time
+from threading import Lock
+
+
+MOLTIN_REQUESTS_PER_SECOND = float(os.getenv('MOLTIN_REQUESTS_PER_SECOND', 10))
+
+
+class TokenBucket:
+    # Allows `rate` events per second on average and bursts of `capacity`.
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.clock = clock
+        self.updated_at = clock()
+        self.lock = Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens=1):
+        # Returns 0 if tokens are taken, otherwise seconds to wait for them.
+        with self.lock:
+            self.refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+
+# One limit for Moltin requests of the menu and the flows imports.
+moltin_bucket = TokenBucket(MOLTIN_REQUESTS_PER_SECOND)
+
+
+def rate_limited(func, *args):
+    moltin_bucket.acquire()
+    return func(*args)
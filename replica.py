@@ -0,0 +1,216 @@
+import json
+import time
+import logging
+from threading import Lock, Thread
+
+import redis
+
+from db import get_database_connection
+from moltin import MoltinError, MOLTIN_PAGE_LIMIT, get_all_pages
+
+
+REPLICA_INTERVAL = 30
+REPLICA_FULL_RELOAD_INTERVAL = 60 * 60
+REPLICA_CHECK_INTERVAL = 5
+REPLICA_KEY = 'replica:{}'
+REPLICA_ENTRIES_KEY = 'replica:{}:{}'
+REPLICA_LOCK_KEY = 'replica:lock'
+REPLICA_WRITE_BATCH = 500
+
+# Returns version of the replica and its entries if the version isn't the
+# known one. Both are read at once, so the full reload can't be seen half done.
+LOAD_SCRIPT = '''
+local state = redis.call('HMGET', KEYS[1], 'generation', 'version')
+if not state[1] then
+    return nil
+end
+if state[2] == ARGV[1] then
+    return {state[2]}
+end
+return {state[2], redis.call('HGETALL', KEYS[2] .. state[1])}
+'''
+
+replicas = []
+
+
+def get_updated_at(entry):
+    return entry.get('meta', {}).get('timestamps', {}).get('updated_at') or ''
+
+
+class Replica:
+    # Copy of Moltin entries in Redis hash and in memory of every process, so
+    # handlers read them without Moltin. One process at a time polls Moltin:
+    # changed entries come first when sorted by updated_at, so only they are
+    # read. Deleted entries are dropped by the full reload, which writes new
+    # hash and switches the replica to it in one transaction.
+    def __init__(self, name, load_page, on_change=None):
+        # load_page(offset, sort) returns entries of the page and their total,
+        # on_change(entries) is called by the process which found changes.
+        self.name = name
+        self.load_page = load_page
+        self.on_change = on_change
+        self.entries = None
+        self.version = None
+        self.checked_at = 0
+        self.lock = Lock()
+        replicas.append(self)
+
+    def get_entries(self):
+        # Returns dict of entries by id, None if the replica isn't loaded yet.
+        if self.entries is None and time.time() - self.checked_at > REPLICA_CHECK_INTERVAL:
+            self.follow()
+        return self.entries
+
+    def get(self, entry_id):
+        entries = self.get_entries()
+        if entries is not None:
+            return entries.get(entry_id)
+
+    def follow(self):
+        # Takes new version of the replica from Redis, the whole dict is
+        # replaced, so readers never see it half updated.
+        with self.lock:
+            self.checked_at = time.time()
+            try:
+                result = get_database_connection().eval(
+                    LOAD_SCRIPT, 2, REPLICA_KEY.format(self.name),
+                    REPLICA_ENTRIES_KEY.format(self.name, ''), self.version or '')
+            except redis.exceptions.RedisError as e:
+                logging.error(f'Replica "{self.name}" is unavailable: {e}')
+                return
+            if result is None or len(result) == 1:
+                return
+            version, items = result
+            self.entries = {items[index].decode('utf-8'): json.loads(items[index + 1])
+                            for index in range(0, len(items), 2)}
+            self.version = version.decode('utf-8')
+
+    def fetch_changed(self, cursor):
+        # Entries updated at the cursor time are read again, they could be
+        # changed after the last poll within the same second.
+        changed = {}
+        offset = 0
+        while True:
+            entries, total = self.load_page(offset, '-updated_at')
+            for entry in entries:
+                if get_updated_at(entry) < cursor:
+                    return changed
+                changed[entry['id']] = entry
+            offset += MOLTIN_PAGE_LIMIT
+            if not entries or offset >= total:
+                return changed
+
+    def write(self, pipe, key, entries):
+        items = [(entry_id, json.dumps(entry)) for entry_id, entry in entries.items()]
+        for start in range(0, len(items), REPLICA_WRITE_BATCH):
+            pipe.hset(key, mapping=dict(items[start:start + REPLICA_WRITE_BATCH]))
+
+    def reload(self, database, state, entries=None):
+        # Entries are loaded from Moltin unless they are known.
+        if entries is None:
+            entries = get_all_pages(lambda offset: self.load_page(offset, None))
+        entries = {entry['id']: entry for entry in entries}
+        generation = int(state.get(b'generation', 0)) + 1
+        cursor = max(map(get_updated_at, entries.values()), default='')
+        with database.pipeline() as pipe:
+            pipe.delete(REPLICA_ENTRIES_KEY.format(self.name, generation))
+            self.write(pipe, REPLICA_ENTRIES_KEY.format(self.name, generation), entries)
+            pipe.hset(REPLICA_KEY.format(self.name),
+                      mapping={'generation': generation, 'cursor': cursor,
+                               'synced_at': time.time(), 'reloaded_at': time.time()})
+            pipe.hincrby(REPLICA_KEY.format(self.name), 'version', 1)
+            if b'generation' in state:
+                pipe.delete(REPLICA_ENTRIES_KEY.format(self.name, int(state[b'generation'])))
+            pipe.execute()
+        logging.info(f'Replica "{self.name}" is reloaded with {len(entries)} entries')
+        return entries
+
+    def refresh(self, database, state):
+        # Returns changed entries, the replica in memory should be followed.
+        changed = self.fetch_changed(state.get(b'cursor', b'').decode('utf-8'))
+        self.follow()
+        entries = self.entries or {}
+        changed = {entry_id: entry for entry_id, entry in changed.items()
+                   if entries.get(entry_id) != entry}
+        with database.pipeline() as pipe:
+            if changed:
+                self.write(pipe, REPLICA_ENTRIES_KEY.format(self.name,
+                                                            int(state[b'generation'])), changed)
+                pipe.hset(REPLICA_KEY.format(self.name), 'cursor',
+                          max(map(get_updated_at, changed.values())))
+                pipe.hincrby(REPLICA_KEY.format(self.name), 'version', 1)
+            pipe.hset(REPLICA_KEY.format(self.name), 'synced_at', time.time())
+            pipe.execute()
+        return changed
+
+    def sync(self, database, force=False):
+        # Returns True if entries have changed.
+        state = database.hgetall(REPLICA_KEY.format(self.name))
+        now = time.time()
+        if not force and now - float(state.get(b'synced_at', 0)) < REPLICA_INTERVAL:
+            return False
+        if not state or now - float(state[b'reloaded_at']) > REPLICA_FULL_RELOAD_INTERVAL:
+            changed = self.reload(database, state)
+        else:
+            changed = self.refresh(database, state)
+        self.follow()
+        if changed and self.on_change is not None:
+            self.on_change(self.entries)
+        return bool(changed)
+
+    def replace(self, entries=None):
+        # Writes all entries at once after they are changed by import, so
+        # deleted ones don't wait for the full reload.
+        database = get_database_connection()
+        with database.lock(REPLICA_LOCK_KEY, timeout=REPLICA_INTERVAL * 10,
+                           blocking_timeout=REPLICA_INTERVAL):
+            self.reload(database, database.hgetall(REPLICA_KEY.format(self.name)), entries)
+        self.follow()
+        if self.on_change is not None:
+            self.on_change(self.entries)
+
+    def get_stats(self):
+        try:
+            state = get_database_connection().hgetall(REPLICA_KEY.format(self.name))
+        except redis.exceptions.RedisError:
+            state = {}
+        synced_at = float(state.get(b'synced_at', 0))
+        return {'entries': len(self.entries or {}), 'version': self.version,
+                'synced_ago': round(time.time() - synced_at, 1) if synced_at else None}
+
+
+def sync_replicas(force=False):
+    # Only one process of all polls Moltin at once, returns False if it's
+    # another one.
+    database = get_database_connection()
+    lock = database.lock(REPLICA_LOCK_KEY, timeout=REPLICA_INTERVAL * 10)
+    if not lock.acquire(blocking=False):
+        return False
+    try:
+        for replica in replicas:
+            try:
+                replica.sync(database, force)
+            except MoltinError as e:
+                logging.error(f'Replica "{replica.name}" sync failed: {e.message}')
+    finally:
+        lock.release()
+    return True
+
+
+def run_replicas():
+    while True:
+        try:
+            sync_replicas()
+        except redis.exceptions.RedisError as e:
+            logging.error(f'Replicas sync: {e}')
+        for replica in replicas:
+            replica.follow()
+        time.sleep(REPLICA_CHECK_INTERVAL)
+
+
+def start_replicas():
+    Thread(target=run_replicas, name='replicas', daemon=True).start()
+
+
+def get_replicas_stats():
+    return {replica.name: replica.get_stats() for replica in replicas}
@@ -0,0 +1,114 @@
+import os
+import time
+import logging
+from collections import deque
+from queue import Queue
+from threading import Lock, Thread
+
+
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 8))
+CHAT_QUEUE_SIZE = 20
+WAIT_TIMES_SIZE = 1000
+
+
+def get_update_chat_id(update):
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        return update.effective_user.id
+
+
+def get_update_key(update):
+    # Repeated clicks on the same button of the same message give one key.
+    query = update.callback_query
+    if query and query.message:
+        return f'{query.message.message_id}:{query.data}'
+
+
+class UpdateScheduler:
+    # Chat with pending updates is given to one worker at a time, and the
+    # worker processes its updates in order, so Redis state transitions of
+    # the chat can't interleave. Different chats run on different workers.
+    def __init__(self, process, workers=SCHEDULER_WORKERS,
+                 chat_queue_size=CHAT_QUEUE_SIZE):
+        self.process = process
+        self.workers = workers
+        self.chat_queue_size = chat_queue_size
+        self.chats = {}
+        self.current_keys = {}
+        self.ready = Queue()
+        self.lock = Lock()
+        self.wait_times = deque(maxlen=WAIT_TIMES_SIZE)
+        self.stats = {'submitted': 0, 'processed': 0, 'failed': 0,
+                      'dropped': 0, 'coalesced': 0}
+
+    def start(self):
+        for number in range(self.workers):
+            Thread(target=self.work, name=f'scheduler_{number}', daemon=True).start()
+        return self
+
+    def submit(self, chat_id, update, key=None):
+        # Returns False if update is dropped as duplicate or by full queue.
+        with self.lock:
+            self.stats['submitted'] += 1
+            chat_queue = self.chats.get(chat_id)
+            if chat_queue is None:
+                chat_queue = self.chats[chat_id] = deque()
+                self.ready.put(chat_id)
+            if key is not None and (self.current_keys.get(chat_id) == key
+                                    or any(item[1] == key for item in chat_queue)):
+                self.stats['coalesced'] += 1
+                return False
+            if len(chat_queue) >= self.chat_queue_size:
+                self.stats['dropped'] += 1
+                logging.warning(f'Update of chat {chat_id} dropped, queue is full')
+                return False
+            chat_queue.append((update, key, time.monotonic()))
+            return True
+
+    def take(self, chat_id):
+        with self.lock:
+            chat_queue = self.chats[chat_id]
+            if not chat_queue:
+                del self.chats[chat_id]
+                self.current_keys.pop(chat_id, None)
+                return
+            update, key, enqueued_at = chat_queue.popleft()
+            self.current_keys[chat_id] = key
+            self.wait_times.append(time.monotonic() - enqueued_at)
+            return update
+
+    def work(self):
+        while True:
+            chat_id = self.ready.get()
+            while True:
+                update = self.take(chat_id)
+                if update is None:
+                    break
+                try:
+                    self.process(update)
+                    result = 'processed'
+                except Exception as e:
+                    result = 'failed'
+                    logging.critical(e)
+                with self.lock:
+                    self.stats[result] += 1
+
+    def get_stats(self):
+        with self.lock:
+            depths = [len(chat_queue) for chat_queue in self.chats.values()]
+            wait_times = sorted(self.wait_times)
+            stats = dict(self.stats)
+        stats.update({
+            'workers': self.workers,
+            'chats': len(depths),
+            'queue_depth': sum(depths),
+            'max_chat_queue_depth': max(depths, default=0),
+        })
+        if wait_times:
+            stats.update({
+                'wait_time_avg': sum(wait_times) / len(wait_times),
+                'wait_time_p95': wait_times[int(0.95 * (len(wait_times) - 1))],
+                'wait_time_max': wait_times[-1],
+            })
+        return stats
@@ -0,0 +1,193 @@
+import os
+import heapq
+import math
+import logging
+import functools
+from threading import Lock
+
+from geopy import distance
+
+from cache import TieredCache
+from moltin import MOLTIN_FLOW_ADDRESSES, get_addresses, get_flow_entries
+from replica import Replica
+
+
+EARTH_RADIUS = 6371.0088
+# Haversine differs from geodesic distance less than 0.5%, so only shops
+# which are so close to the nearest one need exact computation.
+HAVERSINE_ERROR = 0.005
+NEAREST_CANDIDATES = 8
+SHOPS_TTL = 24 * 60 * 60
+SHOP_FIELDS = ('id', 'address', 'alias', 'latitude', 'longitude',
+               'courier_telegram_id', 'delivery_radius')
+
+
+def parse_tiers(tiers):
+    # "0.5:0,5:100" is free delivery up to 0.5 km and for 100 up to 5 km.
+    return tuple(sorted(tuple(float(value) for value in tier.split(':'))
+                        for tier in tiers.split(',')))
+
+
+# Max distance in km and delivery price, farther shops don't deliver.
+DELIVERY_TIERS = parse_tiers(os.getenv('DELIVERY_TIERS', '0.5:0,5:100,20:300'))
+
+shops_cache = TieredCache('shops', ttl=SHOPS_TTL)
+shop_index = None
+shop_index_lock = Lock()
+addresses_replica = Replica(
+    MOLTIN_FLOW_ADDRESSES, functools.partial(get_flow_entries, MOLTIN_FLOW_ADDRESSES),
+    on_change=lambda entries: invalidate_shops(list(entries.values())))
+
+
+def to_unit_vector(latitude, longitude):
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (math.cos(latitude) * math.cos(longitude),
+            math.cos(latitude) * math.sin(longitude),
+            math.sin(latitude))
+
+
+def get_haversine_distance(point, other_point):
+    latitude, longitude = map(math.radians, point)
+    other_latitude, other_longitude = map(math.radians, other_point)
+    a = (math.sin((other_latitude - latitude) / 2) ** 2
+         + math.cos(latitude) * math.cos(other_latitude)
+         * math.sin((other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def get_delivery_radius(shop):
+    # Shop can deliver not so far as the last tier, delivery_radius is the
+    # optional field of the addresses flow, 0 is the default of Moltin fields.
+    radius = shop.get('delivery_radius')
+    if not radius:
+        return DELIVERY_TIERS[-1][0]
+    return min(float(radius), DELIVERY_TIERS[-1][0])
+
+
+def get_delivery_price(distance_km, radius=None):
+    # Returns None if shop is too far for delivery.
+    if radius is not None and distance_km > radius:
+        return
+    for max_distance, price in DELIVERY_TIERS:
+        if distance_km <= max_distance:
+            return int(price)
+
+
+class KDTree:
+    # KD-tree over points on the unit sphere. Chord length between points
+    # grows with great-circle distance, so nearest by chord are nearest
+    # on the Earth surface too.
+    def __init__(self, points):
+        self.points = points
+        self.root = self.build(list(range(len(points))), 0)
+
+    def build(self, indexes, depth):
+        if not indexes:
+            return
+        axis = depth % 3
+        indexes.sort(key=lambda index: self.points[index][axis])
+        middle = len(indexes) // 2
+        return (indexes[middle], axis,
+                self.build(indexes[:middle], depth + 1),
+                self.build(indexes[middle + 1:], depth + 1))
+
+    def query(self, point, k):
+        # Returns up to k (squared chord, index) pairs, nearest first.
+        heap = []
+
+        def search(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            node_point = self.points[index]
+            squared = sum((a - b) ** 2 for a, b in zip(point, node_point))
+            if len(heap) < k:
+                heapq.heappush(heap, (-squared, index))
+            elif squared < -heap[0][0]:
+                heapq.heapreplace(heap, (-squared, index))
+            delta = point[axis] - node_point[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            search(near)
+            if len(heap) < k or delta ** 2 < -heap[0][0]:
+                search(far)
+
+        search(self.root)
+        return sorted((-squared, index) for squared, index in heap)
+
+
+class ShopIndex:
+    def __init__(self, addresses, version=None):
+        self.version = version
+        self.shops = [{field: address.get(field) for field in SHOP_FIELDS}
+                      for address in addresses]
+        self.shops_by_id = {shop['id']: shop for shop in self.shops}
+        self.coordinates = [(float(shop['latitude']), float(shop['longitude']))
+                            for shop in self.shops]
+        self.tree = KDTree([to_unit_vector(*point) for point in self.coordinates])
+
+    def nearest(self, latitude, longitude, k=1):
+        # Returns k nearest (distance in km, shop) pairs. Candidates are found
+        # by KD-tree and sorted by haversine, only the ones which still could
+        # be the nearest get exact geodesic distance.
+        if not self.shops:
+            return []
+        point = (latitude, longitude)
+        candidates = self.tree.query(to_unit_vector(latitude, longitude),
+                                     max(k, NEAREST_CANDIDATES))
+        candidates = sorted(
+            (get_haversine_distance(point, self.coordinates[index]), index)
+            for squared, index in candidates
+        )
+        limit = candidates[min(k, len(candidates)) - 1][0] * (1 + 2 * HAVERSINE_ERROR)
+        exact = sorted(
+            (distance.distance(point, self.coordinates[index]).km, index)
+            for haversine, index in candidates if haversine <= limit
+        )
+        return [(distance_km, self.shops[index]) for distance_km, index in exact[:k]]
+
+    def get_shop(self, shop_id):
+        return self.shops_by_id.get(shop_id)
+
+
+def load_addresses():
+    # Replica keeps the shops through Moltin outages.
+    addresses = addresses_replica.get_entries()
+    if addresses is None:
+        return get_addresses()
+    return list(addresses.values())
+
+
+def get_shop_index():
+    # Index is built once per process and rebuilt when addresses change.
+    global shop_index
+    version = shops_cache.get_version()
+    if shop_index is not None and shop_index.version == version:
+        return shop_index
+    with shop_index_lock:
+        if shop_index is None or shop_index.version != version:
+            addresses = shops_cache.get('addresses', load_addresses)
+            shop_index = ShopIndex(addresses, version)
+            logging.info(f'Shop index is built for {len(addresses)} shops')
+    return shop_index
+
+
+def invalidate_shops(addresses=None):
+    # Known new addresses are cached at once, so processes rebuild their
+    # indexes without loading the flow from Moltin.
+    shops_cache.invalidate()
+    if addresses is not None:
+        shops_cache.set('addresses', addresses)
+
+
+def get_shop(shop_id):
+    return get_shop_index().get_shop(shop_id)
+
+
+def find_nearest_shop(latitude, longitude):
+    # Returns nearest shop, distance to it in km and delivery price.
+    nearest = get_shop_index().nearest(latitude, longitude)
+    if not nearest:
+        return None, None, None
+    distance_km, shop = nearest[0]
+    return shop, distance_km, get_delivery_price(round(distance_km, 1),
+                                                 get_delivery_radius(shop))
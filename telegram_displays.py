@@ -1,70 +1,219 @@
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from geopy import distance
+import logging
+import threading
 
-from moltin import get_products, get_product, add_customer
+from telegram.error import BadRequest, TelegramError
+from telegram.utils.request import Request
 
+import metrics
 
-def display_menu(bot, chat_id):
-    products = get_products().items()
-    keyboard = [[InlineKeyboardButton(product_name, callback_data=product_id)]
-                for (product_id, product_name) in products]
-    keyboard.append([InlineKeyboardButton('ВАША КОРЗИНА', callback_data='goto_cart')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_message(text='Приветствуем Вас в пицца-боте!\nВот наши пиццы:\n',
-                    chat_id=chat_id, reply_markup=reply_markup)
+from catalog import get_products, get_product
+from customers import save_customer
+from outbox import outbox, COURIER_PRIORITY
+from photos import send_product_photo, edit_product_photo
+from templates import (DELIVERY_MARKUP, MENU_TEXT, get_cart_markup, get_cart_text,
+                       get_templates)
+from zones import find_nearest_shop
 
 
-def display_description(bot, query_data, chat_id):
+class InstrumentedRequest(Request):
+    # Times every Telegram Bot API call by its method.
+    def post(self, url, data, timeout=None):
+        method = url.rsplit('/', 1)[-1]
+        with metrics.timer('telegram_request_seconds', method=method):
+            try:
+                return super().post(url, data, timeout=timeout)
+            except TelegramError:
+                metrics.inc('telegram_errors_total', method=method)
+                raise
+
+
+class CountingBot:
+    # Proxy of the bot which counts Telegram API calls of updates. Calls are
+    # made later by the outbox, so they are added to the totals one by one.
+    stats = {'updates': 0, 'calls': 0}
+    stats_lock = threading.Lock()
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with CountingBot.stats_lock:
+                CountingBot.stats['calls'] += 1
+            return attribute(*args, **kwargs)
+        return call
+
+    def finish(self):
+        with CountingBot.stats_lock:
+            CountingBot.stats['updates'] += 1
+
+
+def get_telegram_calls_stats():
+    with CountingBot.stats_lock:
+        stats = dict(CountingBot.stats)
+    stats['calls_per_update'] = stats['calls'] / stats['updates'] if stats['updates'] else 0
+    return stats
+
+
+def delete_message(bot, chat_id, message_id):
+    # Errors aren't raised, so the outbox won't send the new message twice.
+    try:
+        bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except TelegramError as e:
+        logging.error(f'Message {message_id} is not deleted: {e}')
+
+
+def get_screen_key(message_id):
+    # Only the last of pending screens in place of the message is shown.
+    if message_id is not None:
+        return f'screen:{message_id}'
+
+
+def render(bot, chat_id, message_id, text, reply_markup=None, parse_mode=None,
+           current_is_photo=False):
+    outbox.submit(chat_id, show_text, bot, chat_id, message_id, text,
+                  reply_markup=reply_markup, parse_mode=parse_mode,
+                  current_is_photo=current_is_photo, key=get_screen_key(message_id))
+
+
+def render_photo(bot, chat_id, message_id, product_id, href_img, caption,
+                 reply_markup=None, current_is_photo=False):
+    outbox.submit(chat_id, show_photo, bot, chat_id, message_id, product_id, href_img,
+                  caption, reply_markup=reply_markup, current_is_photo=current_is_photo,
+                  key=get_screen_key(message_id))
+
+
+def send_text(bot, chat_id, text, wait=False, **kwargs):
+    send = outbox.call if wait else outbox.submit
+    send(chat_id, send_message, bot, chat_id, text, **kwargs)
+
+
+def send_message(bot, chat_id, text, **kwargs):
+    return bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+
+def show_text(bot, chat_id, message_id, text, reply_markup=None, parse_mode=None,
+              current_is_photo=False):
+    # Shows text screen in place of the current message of the bot.
+    # Text message is edited, photo is replaced by new message.
+    if message_id is not None and not current_is_photo:
+        try:
+            return bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id,
+                                         parse_mode=parse_mode, reply_markup=reply_markup)
+        except BadRequest as e:
+            if 'not modified' in str(e):
+                return
+            logging.error(f'Message {message_id} is not edited: {e}')
+    message = bot.send_message(text=text, chat_id=chat_id, parse_mode=parse_mode,
+                               reply_markup=reply_markup)
+    if message_id is not None:
+        delete_message(bot, chat_id, message_id)
+    return message
+
+
+def show_photo(bot, chat_id, message_id, product_id, href_img, caption,
+               reply_markup=None, current_is_photo=False):
+    # The same for the product photo screen.
+    if message_id is not None and current_is_photo:
+        try:
+            return edit_product_photo(bot, chat_id, message_id, product_id, href_img,
+                                      caption=caption, reply_markup=reply_markup)
+        except BadRequest as e:
+            if 'not modified' in str(e):
+                return
+            logging.error(f'Message {message_id} is not edited: {e}')
+    message = send_product_photo(bot, chat_id, product_id, href_img, caption=caption,
+                                 reply_markup=reply_markup)
+    if message_id is not None:
+        delete_message(bot, chat_id, message_id)
+    return message
+
+
+def send_location(bot, chat_id, latitude, longitude):
+    return bot.send_location(latitude=latitude, longitude=longitude, chat_id=chat_id)
+
+
+def notify_courier_location(bot, courier_telegram_id, latitude, longitude, wait=False):
+    # Couriers wait behind the customers when Telegram limits are reached.
+    # Location and order are separate outbox items, so failed order text
+    # isn't sent with the location again.
+    send = outbox.call if wait else outbox.submit
+    send(courier_telegram_id, send_location, bot, courier_telegram_id,
+         latitude, longitude, priority=COURIER_PRIORITY)
+
+
+def notify_courier_order(bot, courier_telegram_id, text, wait=False):
+    send = outbox.call if wait else outbox.submit
+    send(courier_telegram_id, send_message, bot, courier_telegram_id, text,
+         priority=COURIER_PRIORITY)
+
+
+def notify_courier(bot, courier_telegram_id, latitude, longitude, text):
+    notify_courier_location(bot, courier_telegram_id, latitude, longitude)
+    notify_courier_order(bot, courier_telegram_id, text)
+
+
+def send_invoice(bot, chat_id, message_id, *args):
+    outbox.submit(chat_id, replace_with_invoice, bot, chat_id, message_id, *args,
+                  key=get_screen_key(message_id))
+
+
+def replace_with_invoice(bot, chat_id, message_id, *args):
+    # Invoice can't replace a text message, so it is sent as new one.
+    bot.sendInvoice(chat_id, *args)
+    delete_message(bot, chat_id, message_id)
+
+
+def display_menu(bot, chat_id, message_id=None, current_is_photo=False):
+    reply_markup = get_templates().get_menu_markup(get_products())
+    render(bot, chat_id, message_id, MENU_TEXT, reply_markup=reply_markup,
+           current_is_photo=current_is_photo)
+
+
+def display_description(bot, query_data, chat_id, message_id=None, current_is_photo=False):
     product_id = query_data
-    name, description, price, href_img = get_product(query_data)
-    text = f'"{name}"\n\n{description}\n\n{price} рублей'
-    keyboard = [[InlineKeyboardButton('ЗАКАЗАТЬ', callback_data=f'{product_id}')]]
-    keyboard.append([InlineKeyboardButton('МЕНЮ', callback_data='goto_menu')])
-    keyboard.append([InlineKeyboardButton('ВАША КОРЗИНА', callback_data='goto_cart')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_photo(chat_id=chat_id, photo=href_img, caption=text,
-                    reply_markup=reply_markup)
-
-
-def display_cart(bot, cart, products, total, chat_id):
-    keyboard = [[InlineKeyboardButton(f"УДАЛИТЬ {product['name']}", callback_data=product['id'])] for product in cart['data']]
-    keyboard.append([InlineKeyboardButton('МЕНЮ', callback_data='goto_menu')])
-    if total > 0:
-        keyboard.append([InlineKeyboardButton('ОФОРМИТЬ ЗАКАЗ', callback_data='goto_checkout_geo')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_message(text=f'ВАША КОРЗИНА:\n{products}\nСумма:{total} руб.',
-                    chat_id=chat_id, reply_markup=reply_markup)
-
-
-def display_address(bot, chat_id, latitude, longitude, address_customer, addresses, database):
+    details = get_product(product_id)
+    caption, reply_markup = get_templates().get_card(product_id, details)
+    render_photo(bot, chat_id, message_id, product_id, details[3], caption,
+                 reply_markup=reply_markup, current_is_photo=current_is_photo)
+
+
+def display_cart(bot, cart, products, total, chat_id, message_id=None, current_is_photo=False):
+    render(bot, chat_id, message_id, get_cart_text(products, total),
+           reply_markup=get_cart_markup(cart, total), current_is_photo=current_is_photo)
+
+
+def display_address(bot, chat_id, latitude, longitude, address_customer, session, message_id=None):
     if latitude is None and longitude is None:
         text = 'Не могу определить координаты. Уточните пожалуйста адрес.'
-        bot.send_message(text=text, chat_id=chat_id)
+        render(bot, chat_id, message_id, text)
+        return False
+    nearest_shop, nearest_distance, delivery_price = find_nearest_shop(latitude, longitude)
+    if nearest_shop is None:
+        text = 'Простите, сейчас нет ни одной работающей пиццерии :('
+        render(bot, chat_id, message_id, text)
         return False
-    for address in addresses:
-        address['distance'] = distance.distance(
-                                            (latitude, longitude),
-                                            (address['latitude'], address['longitude'])
-                                        ).km
-    nearest_address = min(addresses, key=lambda x: x['distance'])
-    nearest_distance = round(nearest_address['distance'], 1)
-    nearest_shop_id = nearest_address['id']
-    nearest_address = nearest_address['address']
-
-    if nearest_distance > 20:
+    nearest_distance = round(nearest_distance, 1)
+    nearest_shop_id = nearest_shop['id']
+    nearest_address = nearest_shop['address']
+
+    if delivery_price is None:
         text = f'Ближайшая пиццерия  аж в {nearest_distance} км от вас! Простите, но так далеко доставить не сможем :('
-        bot.send_message(text=text, chat_id=chat_id)
+        render(bot, chat_id, message_id, text)
         return False
-    elif nearest_distance > 5:
-        text = f'Ближайшая пиццерия в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или доставим за 300 рублей'
-    elif nearest_distance > 0.5:
+    elif delivery_price == 0:
+        text = f'Вы совсем рядом! Ближайшая пиццерия всего в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или можем доставить бесплатно.'
+    elif delivery_price == 100:
         text = f'Ближайшая пиццерия в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или привезем за самокате за 100 рублей'
     else:
-        text = f'Вы совсем рядом! Ближайшая пиццерия всего в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или можем доставить бесплатно.'
-    id_customer = add_customer(chat_id, latitude, longitude, address_customer, nearest_shop_id)
-    database.set(f'{chat_id}_id_customer', id_customer)
-    keyboard = [[InlineKeyboardButton('ДОСТАВКА', callback_data='goto_checkout_delivery')]]
-    keyboard.append([InlineKeyboardButton('САМОВЫВОЗ', callback_data='goto_checkout_pickup')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_message(text=text, parse_mode='Markdown', chat_id=chat_id, reply_markup=reply_markup)
+        text = f'Ближайшая пиццерия в {nearest_distance} км от вас по адресу {nearest_address}. Заберете сами? Или доставим за {delivery_price} рублей'
+    save_customer(chat_id, latitude, longitude, address_customer, nearest_shop_id)
+    session.update({'nearest_shop_id': nearest_shop_id,
+                    'latitude': latitude, 'longitude': longitude})
+    render(bot, chat_id, message_id, text, reply_markup=DELIVERY_MARKUP,
+           parse_mode='Markdown')
     return True
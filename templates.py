@@ -0,0 +1,89 @@
+import json
+
+from catalog import get_catalog_version
+
+
+MENU_TEXT = 'Приветствуем Вас в пицца-боте!\nВот наши пиццы:\n'
+
+templates = None
+
+
+def button(text, callback_data):
+    return {'text': text, 'callback_data': callback_data}
+
+
+def serialize(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def serialize_keyboard(*rows):
+    # Bot sends reply_markup strings as they are, so keyboards are serialized
+    # once instead of building InlineKeyboardMarkup objects on every update.
+    return serialize({'inline_keyboard': list(rows)})
+
+
+DELIVERY_MARKUP = serialize_keyboard([button('ДОСТАВКА', 'goto_checkout_delivery')],
+                                     [button('САМОВЫВОЗ', 'goto_checkout_pickup')])
+PAYMENT_MARKUP = serialize_keyboard([button('ПО КАРТЕ', 'goto_payment_card')],
+                                    [button('НАЛИЧНЫМИ', 'goto_payment_cash')])
+CART_MENU_ROWS = serialize([button('МЕНЮ', 'goto_menu')])
+CART_CHECKOUT_ROWS = CART_MENU_ROWS + ',' + serialize([button('ОФОРМИТЬ ЗАКАЗ', 'goto_checkout_geo')])
+
+
+def get_cart_markup(cart, total):
+    # Only rows of the cart items are serialized per update.
+    rows = [serialize([button(f"УДАЛИТЬ {item['name']}", item['id'])]) for item in cart['data']]
+    rows.append(CART_CHECKOUT_ROWS if total > 0 else CART_MENU_ROWS)
+    return '{"inline_keyboard":[' + ','.join(rows) + ']}'
+
+
+def get_cart_text(products, total):
+    return f'ВАША КОРЗИНА:\n{products}\nСумма:{total} руб.'
+
+
+class Templates:
+    # Screens which are the same for all customers, rendered once per
+    # catalog version. Menu and cards are rendered again only if the catalog
+    # cache has refreshed them within the version.
+    def __init__(self, version):
+        self.version = version
+        self.menu = None
+        self.cards = {}
+        self.renders = 0
+
+    def get_menu_markup(self, products):
+        menu = self.menu
+        if menu is None or (menu[0] is not products and menu[0] != products):
+            rows = [[button(product_name, product_id)]
+                    for product_id, product_name in products.items()]
+            rows.append([button('ВАША КОРЗИНА', 'goto_cart')])
+            menu = self.menu = (products, serialize_keyboard(*rows))
+            self.renders += 1
+        return menu[1]
+
+    def get_card(self, product_id, details):
+        # Returns caption and markup of the product photo screen.
+        card = self.cards.get(product_id)
+        if card is None or card[0] != details:
+            name, description, price, href_img = details
+            card = self.cards[product_id] = (
+                details,
+                f'"{name}"\n\n{description}\n\n{price} рублей',
+                serialize_keyboard([button('ЗАКАЗАТЬ', product_id)],
+                                   [button('МЕНЮ', 'goto_menu')],
+                                   [button('ВАША КОРЗИНА', 'goto_cart')]),
+            )
+            self.renders += 1
+        return card[1], card[2]
+
+    def get_stats(self):
+        return {'version': self.version, 'cards': len(self.cards), 'renders': self.renders}
+
+
+def get_templates():
+    # Templates of the old catalog version are dropped at once.
+    global templates
+    version = get_catalog_version()
+    if templates is None or templates.version != version:
+        templates = Templates(version)
+    return templates
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def database(monkeypatch):
+    # Lua scripts of the modules need fakeredis with lupa.
+    fakeredis = pytest.importorskip('fakeredis')
+    pytest.importorskip('lupa')
+    import db
+    database = fakeredis.FakeRedis()
+    monkeypatch.setattr(db, 'get_database_connection', lambda: database)
+    return database
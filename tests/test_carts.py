@@ -0,0 +1,88 @@
+import pytest
+
+from benchmarks.stubs import moltin_stub, PRODUCTS
+
+
+@pytest.fixture
+def stub(database, monkeypatch):
+    import moltin
+    import carts
+    import chat_sessions
+    server = moltin_stub()
+    monkeypatch.setattr(moltin, 'MOLTIN_API_URL', f'{server.url}/v2')
+    monkeypatch.setattr(moltin, 'MOLTIN_API_OAUTH_URL', f'{server.url}/oauth/access_token')
+    monkeypatch.setattr(moltin, 'token', None)
+    for module in (moltin, carts, chat_sessions):
+        monkeypatch.setattr(module, 'get_database_connection', lambda: database)
+    yield server
+    server.shutdown()
+
+
+def run_flow(cart_functions, chat_id, cached):
+    # The same cart calls as handlers in main.py do for one order.
+    get_cart, add_to_cart, delete_from_cart = cart_functions
+    get_cart(chat_id)  # opens the cart from menu
+    add_to_cart(chat_id, PRODUCTS[0]['id'])
+    add_to_cart(chat_id, PRODUCTS[1]['id'])
+    cart, products, total = get_cart(chat_id)  # opens the cart again
+    delete_from_cart(chat_id, cart['data'][-1]['id'])
+    if not cached:
+        get_cart(chat_id)  # handle_cart asked the cart after deleting
+    get_cart(chat_id)  # handle_checkout_receipt
+    get_cart(chat_id)  # handle_checkout_payment
+
+
+def run_session_flow(chat_id):
+    # Every step is a separate update: session is loaded and saved again.
+    from carts import get_cart, add_to_cart, delete_from_cart
+    from chat_sessions import load_session, save_session, next_cart_version
+
+    def step(action):
+        session = load_session(chat_id)
+        result = action(session)
+        save_session(session)
+        return result
+
+    step(lambda session: get_cart(chat_id, session.get('cart_version')))
+    for product in PRODUCTS[:2]:
+        step(lambda session: add_to_cart(chat_id, product['id'], next_cart_version(session)))
+    cart, products, total = step(lambda session: get_cart(chat_id, session.get('cart_version')))
+    step(lambda session: delete_from_cart(chat_id, cart['data'][-1]['id'],
+                                          next_cart_version(session)))
+    step(lambda session: get_cart(chat_id, session.get('cart_version')))
+    step(lambda session: get_cart(chat_id, session.get('cart_version')))
+    return get_cart(chat_id, load_session(chat_id).get('cart_version'))
+
+
+def count_calls(stub):
+    counts = {}
+    for method, path in stub.calls:
+        if '/carts/' in path:
+            counts[method] = counts.get(method, 0) + 1
+    return counts
+
+
+def test_order_without_cache_gets_cart_every_time(stub):
+    import moltin
+    run_flow((moltin.get_cart, moltin.add_to_cart, moltin.delete_from_cart), 'chat', False)
+    assert count_calls(stub) == {'GET': 5, 'POST': 2, 'DELETE': 1}
+
+
+def test_order_with_cache_gets_cart_once(stub):
+    import carts
+    run_flow((carts.get_cart, carts.add_to_cart, carts.delete_from_cart), 'chat', True)
+    assert count_calls(stub) == {'GET': 1, 'POST': 2, 'DELETE': 1}
+
+
+def test_cart_versions_survive_saved_sessions(stub):
+    cart, products, total = run_session_flow('chat')
+    assert count_calls(stub) == {'GET': 1, 'POST': 2, 'DELETE': 1}
+    assert [item['product_id'] for item in cart['data']] == [PRODUCTS[0]['id']]
+
+
+def test_invalidated_cart_is_asked_again(stub):
+    import carts
+    carts.get_cart('chat')
+    carts.invalidate_cart('chat')
+    carts.get_cart('chat')
+    assert count_calls(stub) == {'GET': 2}
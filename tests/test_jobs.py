@@ -0,0 +1,155 @@
+from threading import Barrier, Thread
+from collections import Counter
+
+import pytest
+
+import jobs
+from jobs import JobScheduler, JOB_RETRY_BACKOFF, JOB_MAX_ATTEMPTS
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def database(database, monkeypatch):
+    monkeypatch.setattr(jobs, 'get_database_connection', lambda: database)
+    return database
+
+
+def make_scheduler(clock, calls, failures=None):
+    scheduler = JobScheduler(clock=clock, lease_time=60)
+
+    @scheduler.handler('record')
+    def record(bot, job_id, **kwargs):
+        calls.append(job_id)
+        if failures and failures.get(job_id):
+            failures[job_id] -= 1
+            raise RuntimeError('send failed')
+    return scheduler
+
+
+def test_jobs_fire_in_order_of_due_time(database, clock):
+    calls = []
+    scheduler = make_scheduler(clock, calls)
+    scheduler.schedule('record', 20, job_id='second')
+    scheduler.schedule('record', 30, job_id='third')
+    scheduler.schedule('record', 10, job_id='first')
+
+    clock.advance(5)
+    assert scheduler.run_due(None) == 0
+    clock.advance(20)
+    scheduler.run_due(None)
+    assert calls == ['first', 'second']
+    clock.advance(10)
+    scheduler.run_due(None)
+    assert calls == ['first', 'second', 'third']
+    assert database.zcard(jobs.JOBS_DUE_KEY) == 0
+
+
+def test_job_of_died_worker_is_taken_again_after_lease(database, clock):
+    calls = []
+    died = make_scheduler(clock, calls)
+    alive = make_scheduler(clock, calls)
+    died.schedule('record', job_id='order')
+    job_ids, claimed_until = died.claim(database, 10)
+    assert job_ids == ['order']
+
+    clock.advance(59)
+    assert alive.run_due(None) == 0
+    clock.advance(2)
+    assert alive.run_due(None) == 1
+    assert calls == ['order']
+
+    # Worker which comes back with the old claim doesn't run the job again.
+    died.run_job(database, None, 'order', claimed_until)
+    assert calls == ['order']
+
+
+def test_failed_job_is_retried_with_backoff(database, clock):
+    calls = []
+    scheduler = make_scheduler(clock, calls, failures={'order': 2})
+    scheduler.schedule('record', job_id='order')
+
+    scheduler.run_due(None)
+    clock.advance(JOB_RETRY_BACKOFF * 2 - 1)
+    assert scheduler.run_due(None) == 0
+    clock.advance(1)
+    scheduler.run_due(None)
+    clock.advance(JOB_RETRY_BACKOFF * 4 - 1)
+    assert scheduler.run_due(None) == 0
+    clock.advance(1)
+    scheduler.run_due(None)
+    assert calls == ['order'] * 3
+    assert database.zcard(jobs.JOBS_DUE_KEY) == 0
+    assert database.exists(jobs.JOB_DONE_KEY.format('order'))
+
+
+def test_job_failing_every_attempt_is_dead(database, clock):
+    calls = []
+    scheduler = make_scheduler(clock, calls, failures={'order': JOB_MAX_ATTEMPTS})
+    scheduler.schedule('record', job_id='order')
+    for _ in range(JOB_MAX_ATTEMPTS):
+        scheduler.run_due(None)
+        clock.advance(JOB_RETRY_BACKOFF * 2 ** JOB_MAX_ATTEMPTS)
+    assert scheduler.run_due(None) == 0
+    assert len(calls) == JOB_MAX_ATTEMPTS
+    assert database.hexists(jobs.JOBS_DEAD_KEY, 'order')
+
+
+def test_job_with_the_same_key_fires_once(database, clock):
+    calls = []
+    scheduler = make_scheduler(clock, calls)
+    assert scheduler.schedule('record', job_id='order')
+    assert not scheduler.schedule('record', job_id='order')
+    scheduler.run_due(None)
+    assert not scheduler.schedule('record', job_id='order')
+    clock.advance(3600)
+    scheduler.run_due(None)
+    assert calls == ['order']
+
+
+def test_job_is_not_acked_with_lost_lease(database, clock):
+    calls = []
+    scheduler = make_scheduler(clock, calls)
+    scheduler.schedule('record', job_id='order')
+    job_ids, claimed_until = scheduler.claim(database, 10)
+    # Another worker took the job after the lease ended.
+    clock.advance(61)
+    scheduler.claim(database, 10)
+    assert not database.eval(jobs.ACK_SCRIPT, 3, jobs.JOBS_DUE_KEY, jobs.JOBS_DATA_KEY,
+                             jobs.JOB_DONE_KEY.format('order'), 'order', claimed_until,
+                             jobs.JOB_DONE_TTL)
+    assert database.zscore(jobs.JOBS_DUE_KEY, 'order') is not None
+
+
+def test_two_workers_never_fire_the_same_job(database, clock):
+    calls = []
+    workers = [make_scheduler(clock, calls) for _ in range(2)]
+    for number in range(100):
+        workers[0].schedule('record', job_id=f'order:{number}')
+    barrier = Barrier(len(workers))
+
+    def work(scheduler):
+        barrier.wait()
+        while scheduler.run_due(None, batch_size=7):
+            pass
+
+    threads = [Thread(target=work, args=(scheduler,)) for scheduler in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert Counter(calls) == Counter(f'order:{number}' for number in range(100))
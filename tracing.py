@@ -0,0 +1,184 @@
+import os
+import hmac
+import time
+import heapq
+import hashlib
+import random
+import threading
+import uuid
+import functools
+from contextlib import contextmanager
+from itertools import count
+
+
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.1))
+TRACING_ENABLED = TRACE_SAMPLE_RATE > 0
+SLOWEST_TRACES = 50
+TRACES_WINDOW = 15 * 60
+MAX_SPANS = 1000
+# Chats are kept in traces as keyed hashes, set the key to match them
+# between processes.
+TRACE_HASH_KEY = os.getenv('TRACE_HASH_KEY', '').encode('utf-8') or os.urandom(16)
+
+context = threading.local()
+
+
+def new_trace_id():
+    # Returns empty id if the update isn't sampled.
+    if TRACING_ENABLED and random.random() < TRACE_SAMPLE_RATE:
+        return uuid.uuid4().hex[:16]
+    return ''
+
+
+class Trace:
+    # Spans of one update. Outbox sends may finish after the handler, so the
+    # trace is stored when the last of its holders releases it.
+    def __init__(self, trace_id, started_at):
+        self.trace_id = trace_id
+        self.started_at = started_at
+        self.finished_at = started_at
+        self.spans = []
+        self.attributes = {}
+        self.holders = 1
+        self.lock = threading.Lock()
+
+    def add_span(self, name, start, duration, args):
+        with self.lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append((name, start, duration, threading.current_thread().name, args))
+            self.finished_at = max(self.finished_at, start + duration)
+
+    def hold(self):
+        with self.lock:
+            self.holders += 1
+
+    def release(self):
+        with self.lock:
+            self.holders -= 1
+            finished = not self.holders
+        if finished:
+            traces.add(self)
+
+    def get_duration(self):
+        return self.finished_at - self.started_at
+
+    def get_summary(self):
+        return {'trace_id': self.trace_id, 'started_at': self.started_at,
+                'duration': self.get_duration(), 'spans': len(self.spans),
+                **self.attributes}
+
+    def get_trace_events(self):
+        # Chrome trace-event format, open it in chrome://tracing or Perfetto.
+        with self.lock:
+            spans = list(self.spans)
+        threads = {}
+        events = []
+        for name, start, duration, thread_name, args in spans:
+            tid = threads.setdefault(thread_name, len(threads) + 1)
+            events.append({'name': name, 'cat': name.split()[0], 'ph': 'X', 'pid': 1,
+                           'tid': tid, 'ts': (start - self.started_at) * 1e6,
+                           'dur': duration * 1e6, 'args': args})
+        for thread_name, tid in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                           'args': {'name': thread_name}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': self.get_summary()}
+
+
+class SlowestTraces:
+    # Slowest traces of the current and the previous window, so old outliers
+    # are forgotten.
+    def __init__(self, size=SLOWEST_TRACES, window=TRACES_WINDOW):
+        self.size = size
+        self.window = window
+        self.current = []
+        self.previous = []
+        self.window_started_at = time.time()
+        self.sequence = count()
+        self.lock = threading.Lock()
+
+    def add(self, trace):
+        item = (trace.get_duration(), next(self.sequence), trace)
+        with self.lock:
+            if time.time() - self.window_started_at > self.window:
+                self.previous, self.current = self.current, []
+                self.window_started_at = time.time()
+            if len(self.current) < self.size:
+                heapq.heappush(self.current, item)
+            elif item[0] > self.current[0][0]:
+                heapq.heapreplace(self.current, item)
+
+    def get_traces(self):
+        with self.lock:
+            items = self.current + self.previous
+        return [trace for _, _, trace in sorted(items, key=lambda item: -item[0])][:self.size]
+
+    def get_trace(self, trace_id):
+        for trace in self.get_traces():
+            if trace.trace_id == trace_id:
+                return trace
+
+
+traces = SlowestTraces()
+
+
+def get_trace():
+    return getattr(context, 'trace', None)
+
+
+@contextmanager
+def attach(trace):
+    # Spans of the thread go to the trace until the block ends.
+    previous = get_trace()
+    context.trace = trace
+    try:
+        yield trace
+    finally:
+        context.trace = previous
+
+
+def start_trace(trace_id, started_at=None):
+    return Trace(trace_id, started_at or time.time())
+
+
+def add_span(name, start, duration, **args):
+    trace = get_trace()
+    if trace is not None:
+        trace.add_span(name, start, duration, args)
+
+
+def set_attribute(name, value):
+    trace = get_trace()
+    if trace is not None:
+        trace.attributes[name] = value
+
+
+def set_chat(chat_id):
+    trace = get_trace()
+    if trace is not None:
+        trace.attributes['chat'] = hmac.new(TRACE_HASH_KEY, str(chat_id).encode('utf-8'),
+                                            hashlib.sha256).hexdigest()[:16]
+
+
+@contextmanager
+def span(name, **args):
+    trace = get_trace()
+    if trace is None:
+        yield
+        return
+    start = time.time()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, time.perf_counter() - started_at, args)
+
+
+def traced(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,26 @@
+import os
+import logging
+
+import telegram
+from dotenv import load_dotenv
+
+from catalog import get_products, get_product
+from photos import get_file_id, send_product_photo
+
+
+def warm_up_photos(bot, chat_id):
+    # Sends every catalog photo to the service chat, so Telegram downloads
+    # it once and customers get it by file_id from the first view.
+    for product_id, product_name in get_products().items():
+        name, description, price, href_img = get_product(product_id)
+        if get_file_id(product_id, href_img):
+            continue
+        message = send_product_photo(bot, chat_id, product_id, href_img)
+        bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        print(f'Photo of "{product_name}" uploaded.')
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    bot = telegram.Bot(token=os.getenv('TG_TOKEN'))
+    warm_up_photos(bot, os.getenv('TG_SERVICE_CHAT_ID'))
@@ -0,0 +1,242 @@
+import os
+import math
+import time
+import logging
+from threading import Lock, Thread
+
+from geopy import distance
+
+from shops import (EARTH_RADIUS, HAVERSINE_ERROR, NEAREST_CANDIDATES, get_delivery_price,
+                   get_delivery_radius, get_haversine_distance, get_shop_index,
+                   to_unit_vector, find_nearest_shop as find_nearest_shop_exactly)
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Geohash cells of precision 5 are about 4.9 x 4.9 km, of precision 6 about
+# 1.2 x 0.6 km. Cells crossed by zone borders are split down to the max one.
+ZONE_MIN_PRECISION = int(os.getenv('ZONE_MIN_PRECISION', 5))
+ZONE_MAX_PRECISION = int(os.getenv('ZONE_MAX_PRECISION', 6))
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+zone_map = None
+zone_map_lock = Lock()
+
+
+def encode_geohash(latitude, longitude, precision):
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash = []
+    bits, bit_count, even = 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (longitude, longitude_range) if even else (latitude, latitude_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits, bit_count = 0, 0
+    return ''.join(geohash)
+
+
+def get_geohash_bounds(geohash):
+    # Returns south, west, north and east borders of the cell.
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for char in geohash:
+        bits = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = longitude_range if even else latitude_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even = not even
+    return latitude_range[0], longitude_range[0], latitude_range[1], longitude_range[1]
+
+
+def get_cell_size(precision):
+    # Returns height and width of cells in degrees.
+    longitude_bits = math.ceil(precision * 5 / 2)
+    latitude_bits = precision * 5 // 2
+    return 180 / 2 ** latitude_bits, 360 / 2 ** longitude_bits
+
+
+class ZoneMap:
+    # Delivery zones rasterized into geohash cells. Cell keeps index of the
+    # nearest shop and delivery price if they are the same in all its points,
+    # so lookup is a few dict gets. Other cells are split into 32 smaller
+    # ones. The smallest of them are boundary cells: they keep the shops which
+    # could be the nearest, only distances to them are computed. Points out of
+    # the service area are computed by the shop index.
+    def __init__(self, shop_index, min_precision=ZONE_MIN_PRECISION,
+                 max_precision=ZONE_MAX_PRECISION):
+        self.shop_index = shop_index
+        self.version = shop_index.version
+        self.min_precision = min_precision
+        self.max_precision = max_precision
+        self.radiuses = [get_delivery_radius(shop) for shop in shop_index.shops]
+        self.reach = max(self.radiuses, default=0)
+        self.cells = {}
+        self.boundary = {}
+        started_at = time.perf_counter()
+        for geohash in self.get_area_cells():
+            self.add_cell(geohash)
+        self.build_time = time.perf_counter() - started_at
+
+    def get_area_cells(self):
+        # Cells of min precision around all shops.
+        height, width = get_cell_size(self.min_precision)
+        geohashes = set()
+        for latitude, longitude in self.shop_index.coordinates:
+            latitude_delta = self.reach / KM_PER_DEGREE
+            longitude_delta = latitude_delta / max(math.cos(math.radians(latitude)), 0.01)
+            south, west = latitude - latitude_delta, longitude - longitude_delta
+            for row in range(math.ceil(2 * latitude_delta / height) + 1):
+                for column in range(math.ceil(2 * longitude_delta / width) + 1):
+                    geohashes.add(encode_geohash(min(south + row * height, 90),
+                                                 west + column * width, self.min_precision))
+        return sorted(geohashes)
+
+    def classify(self, geohash):
+        # Returns (shop position, price) tuple if they are the same in the
+        # whole cell, otherwise list of positions of shops which could be the
+        # nearest, or None if there are too many of them. False if nobody
+        # delivers there.
+        south, west, north, east = get_geohash_bounds(geohash)
+        center = ((south + north) / 2, (west + east) / 2)
+        half_diagonal = get_haversine_distance(center, (north, east))
+        candidates = self.shop_index.tree.query(to_unit_vector(*center), NEAREST_CANDIDATES)
+        candidates = sorted(
+            (get_haversine_distance(center, self.shop_index.coordinates[index]), index)
+            for squared, index in candidates
+        )
+        # Haversine differs from geodesic distance used by the exact lookup.
+        margins = [half_diagonal + HAVERSINE_ERROR * (distance_km + half_diagonal)
+                   for distance_km, index in candidates]
+        distance_km, index = candidates[0]
+        if distance_km - margins[0] > self.reach:
+            return False
+        farthest_nearest = distance_km + margins[0]
+        nearest = [index for (distance_km, index), margin in zip(candidates, margins)
+                   if distance_km - margin <= farthest_nearest]
+        if len(nearest) == len(candidates) and len(candidates) < len(self.shop_index.shops):
+            return
+        if len(nearest) > 1:
+            return nearest
+        radius = self.radiuses[index]
+        price = get_delivery_price(round(max(distance_km - margins[0], 0), 1), radius)
+        if price != get_delivery_price(round(distance_km + margins[0], 1), radius):
+            return [index]
+        return index, price
+
+    def add_cell(self, geohash):
+        zone = self.classify(geohash)
+        if zone is False:
+            return
+        if isinstance(zone, tuple):
+            self.cells[geohash] = zone
+        elif len(geohash) < self.max_precision:
+            for char in GEOHASH_ALPHABET:
+                self.add_cell(geohash + char)
+        elif zone is not None:
+            self.boundary[geohash] = tuple(zone)
+
+    def get_exact_zone(self, point, candidates):
+        # Like ShopIndex.nearest, but only for the candidates of the cell.
+        candidates = sorted((get_haversine_distance(point, self.shop_index.coordinates[index]), index)
+                            for index in candidates)
+        limit = candidates[0][0] * (1 + 2 * HAVERSINE_ERROR)
+        distance_km, index = min(
+            (distance.distance(point, self.shop_index.coordinates[index]).km, index)
+            for haversine, index in candidates if haversine <= limit
+        )
+        return (self.shop_index.shops[index], distance_km,
+                get_delivery_price(round(distance_km, 1), self.radiuses[index]))
+
+    def lookup(self, latitude, longitude):
+        # Returns shop, distance in km and price, or None if the point should
+        # be computed by shop index. Price of the cell allows for the haversine
+        # error, so haversine distance is enough to show.
+        point = (latitude, longitude)
+        geohash = encode_geohash(latitude, longitude, self.max_precision)
+        for precision in range(self.min_precision, self.max_precision + 1):
+            zone = self.cells.get(geohash[:precision])
+            if zone is not None:
+                index, price = zone
+                return (self.shop_index.shops[index],
+                        get_haversine_distance(point, self.shop_index.coordinates[index]), price)
+        candidates = self.boundary.get(geohash)
+        if candidates is not None:
+            return self.get_exact_zone(point, candidates)
+
+    def get_stats(self):
+        return {'version': self.version, 'shops': len(self.shop_index.shops),
+                'cells': len(self.cells), 'boundary_cells': len(self.boundary),
+                'build_time': round(self.build_time, 2)}
+
+    def get_geojson(self):
+        # Cells as polygons, boundary ones have the shops which could be the
+        # nearest instead of one shop and price.
+        features = []
+        cells = [(geohash, zone, True) for geohash, zone in self.cells.items()]
+        cells += [(geohash, candidates, False) for geohash, candidates in self.boundary.items()]
+        for geohash, zone, resolved in cells:
+            south, west, north, east = get_geohash_bounds(geohash)
+            if resolved:
+                index, price = zone
+                shop = self.shop_index.shops[index]
+                properties = {'shop_id': shop['id'], 'alias': shop.get('alias'),
+                              'delivery_price': price}
+            else:
+                properties = {'shop_ids': [self.shop_index.shops[index]['id']
+                                           for index in zone]}
+            properties.update({'geohash': geohash, 'boundary': not resolved})
+            features.append({
+                'type': 'Feature',
+                'geometry': {'type': 'Polygon', 'coordinates': [[
+                    [west, south], [east, south], [east, north], [west, north], [west, south]]]},
+                'properties': properties,
+            })
+        return {'type': 'FeatureCollection', 'features': features}
+
+
+def build_zone_map(shop_index):
+    global zone_map
+    try:
+        new_zone_map = ZoneMap(shop_index)
+    except Exception as e:
+        logging.error(f'Zone map is not built: {e}')
+        return
+    zone_map = new_zone_map
+    logging.info(f'Zone map is built: {zone_map.get_stats()}')
+
+
+def get_zone_map():
+    # Returns the zone map of the current shops or None while it's built in
+    # background after shops change.
+    shop_index = get_shop_index()
+    if zone_map is not None and zone_map.version == shop_index.version:
+        return zone_map
+    if zone_map_lock.acquire(blocking=False):
+        def build():
+            try:
+                build_zone_map(shop_index)
+            finally:
+                zone_map_lock.release()
+        Thread(target=build, name='zone_map', daemon=True).start()
+
+
+def find_nearest_shop(latitude, longitude):
+    # Same as shops.find_nearest_shop, but nearest shop and price come from
+    # the zone map while it's built for the current shops.
+    current_zone_map = get_zone_map()
+    zone = current_zone_map and current_zone_map.lookup(latitude, longitude)
+    if not zone:
+        return find_nearest_shop_exactly(latitude, longitude)
+    return zone